@@ -110,3 +110,5 @@ data = dict(
         pipeline=test_pipeline))
 
 evaluation = dict(interval=1, metric='keypoints')
+# 向量化的关键点评测, 结果不写json, 指标与COCOeval相同
+# evaluation = dict(interval=1, metric='keypoints', fast_eval=True, nproc=8)
@@ -76,6 +76,7 @@ train_pipeline = [
                     img_scale=[(400, 1400), (1400, 1400)],
                     multiscale_mode='range',
                     keep_ratio=True,
+                    allow_preset_scale=True,
                 )
             ],
             [
@@ -92,6 +93,8 @@ train_pipeline = [
                     crop_type='absolute_range',
                     crop_size=(384, 600),
                     allow_negative_crop=True,
+                    max_trials=10,
+                    allow_preset_scale=True,
                 ),
                 dict(
                     type='opera.AugResize',
@@ -99,6 +102,7 @@ train_pipeline = [
                     multiscale_mode='range',
                     override=True,
                     keep_ratio=True,
+                    allow_preset_scale=True,
                 )
             ]
         ]
@@ -209,10 +213,21 @@ data = dict(
 # data = dict(
 #     samples_per_gpu=2,
 #     workers_per_gpu=2,
+#     # 可选: 按宽高比分桶, 同一batch共享预先采样的resize尺度, 减少padding
+#     # dataset_ratio: 每个batch只来自同一个数据集, 配合
+#     # PETRHead3D(skip_empty_depth=True) 跳过COCO batch上的depth计算
+#     # train_dataloader=dict(
+#     #     bucket_sampler=dict(
+#     #         img_scale=[(400, 1400), (1400, 1400)],
+#     #         dataset_ratio=dict(COCO=1, MUCO=1))),
 #     train=dict(
 #         type=dataset_type,
 #         ann_file=[ann_coco_path, ann_muco_path],
 #         img_prefix=[data_coco_root, data_muco_root],
+#         # 可选: tools/dataset_converters/build_img_cache.py 生成的预缩放图像缓存
+#         # img_cache=[cache_coco_root, cache_muco_root],
+#         # 可选: 记录每个transform的耗时, 由PipelineProfilerHook输出
+#         # profile_pipeline=True,
 #         pipeline=train_pipeline
 #     ),
 #     val=dict(
@@ -226,4 +241,8 @@ data = dict(
 #     )
 # )
 
-evaluation = dict(interval=1, metric='keypoints')
\ No newline at end of file
+evaluation = dict(interval=1, metric='keypoints')
+# 后台评测: 权重快照由rank 0启动的独立进程评测, 训练不等待评测结束
+# evaluation = dict(
+#     interval=1, metric='keypoints', async_eval=True, async_device='cpu',
+#     async_queue_size=1, async_workers=2)
\ No newline at end of file
@@ -33,9 +33,11 @@ model = dict(
         sync_cls_avg_factor=True,
         with_kpt_refine=True,
         with_depth_refine=False,
+        # fused_loss=True,  # 所有decoder层的loss一起计算
         as_two_stage=True,
         transformer=dict(
             type='opera.PETRTransformer3D',
+            # with_cp=True,  # 或 ('encoder', 'decoder'), 以计算换显存
             encoder=dict(
                 type='mmcv.DetrTransformerEncoder',
                 num_layers=6,
@@ -144,6 +146,10 @@ model = dict(
     ),
     
     test_cfg=dict(max_per_img=100),  # eval时保留多少个候选目标
+    # 按分数过滤并压缩每张图像的结果(结构化数组, float16坐标), 减少测试结果的内存与IO:
+    # test_cfg=dict(
+    #     max_per_img=100,
+    #     compact_result=dict(score_thr=0.05, min_k=20, float16=True)),
 ) 
 
 # optimizer
@@ -170,3 +176,17 @@ auto_scale_lr = dict(enable=False, base_batch_size=16)
 lr_config = dict(policy='step', step=[10, 15])
 runner = dict(type='EpochBasedRunner', max_epochs=20)
 checkpoint_config = dict(interval=1, max_keep_ckpts=20)
+# 后台写入checkpoint, trainable_only时不保存冻结的参数:
+# checkpoint_config = dict(
+#     type='AsyncCheckpointHook', interval=1, max_keep_ckpts=20,
+#     trainable_only=True)
+
+# 每个epoch报告JointDataset中因为增强后没有gt而重试的次数
+custom_hooks = [
+    dict(type='NumClassCheckHook'),
+    dict(type='DatasetRetryHook'),
+    # 分阶段统计耗时/显存, trace_iters=(100, 105) 时导出chrome trace
+    # dict(type='StageProfilerHook', interval=50),
+    # 等待数据与计算的时间, 配合 data.train.profile_pipeline=True 输出各transform的耗时
+    # dict(type='PipelineProfilerHook', interval=50),
+]
@@ -0,0 +1,23 @@
+_base_ = './petr_r50_16x2_100e_3d.py'
+# 只训练PETRHead3D: backbone与neck冻结, 训练集为预先计算的neck特征, 每个
+# iteration不再运行backbone。先用同一个checkpoint生成特征缓存:
+#   python tools/dataset_converters/build_feat_cache.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py /path/to/petr.pth \
+#       /path/to/feat_cache --scale 1333 800 --flip
+# 缓存中只有固定尺度的原图与翻转两个视角, 适合head的消融实验与微调。
+# 验证集仍然使用图像, 与原来的配置相同。
+feat_cache_root = '/path/to/feat_cache'
+# 需要与生成缓存时的checkpoint相同, 否则缓存的特征与backbone不一致
+load_from = '/path/to/petr.pth'
+
+model = dict(
+    freeze_feat=True,
+    backbone=dict(init_cfg=None))
+
+data = dict(
+    samples_per_gpu=2,
+    workers_per_gpu=2,
+    train=dict(
+        _delete_=True,
+        type='opera.FeatCacheDataset',
+        cache_root=feat_cache_root))
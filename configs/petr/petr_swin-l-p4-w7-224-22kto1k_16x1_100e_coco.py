@@ -26,3 +26,5 @@ data = dict(
     workers_per_gpu=1)
 # optimizer
 optimizer = dict(lr=1e-4)
+# 分布式训练时按rank切分AdamW的状态, 或使用 tools/train.py --zero-optimizer
+# zero_optimizer = dict(enable=True)
@@ -145,6 +145,8 @@ optimizer = dict(
             'reference_points': dict(lr_mult=0.1)
         }))
 optimizer_config = dict(grad_clip=dict(max_norm=0.1, norm_type=2))
+# 分布式训练时按rank切分AdamW的状态, 或使用 tools/train.py --zero-optimizer
+# zero_optimizer = dict(enable=True)
 # learning policy
 lr_config = dict(policy='step', step=[80])
 runner = dict(type='EpochBasedRunner', max_epochs=100)
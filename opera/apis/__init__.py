@@ -1,11 +1,16 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
+from .dist_utils import (CPUDistributedDataParallel, build_zero_optimizer,
+                         init_dist_cpu)
 from .inference import (async_inference_detector, inference_detector,
                         init_detector, show_result_pyplot)
+from .result_shards import ResultShardWriter, ShardedResults
 from .test import multi_gpu_test, single_gpu_test, multi_gpu_test_3d
 from .train import init_random_seed, set_random_seed, train_model
 
 __all__ = [
     'async_inference_detector', 'inference_detector', 'init_detector',
     'show_result_pyplot', 'multi_gpu_test', 'single_gpu_test', 'multi_gpu_test_3d',
-    'init_random_seed', 'set_random_seed', 'train_model'
+    'init_random_seed', 'set_random_seed', 'train_model',
+    'ResultShardWriter', 'ShardedResults', 'init_dist_cpu',
+    'CPUDistributedDataParallel', 'build_zero_optimizer'
 ]
@@ -0,0 +1,106 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# CPU上的分布式环境
+#   mmcv.runner.init_dist 会按rank绑定GPU, 在没有GPU的节点上无法使用。
+#   这里使用gloo后端初始化进程组, 并按本机进程数划分线程。
+import os
+import subprocess
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from mmcv.parallel import MMDistributedDataParallel, scatter_kwargs
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+
+def _set_slurm_env(port=None):
+    """根据slurm的环境变量设置torch.distributed需要的环境变量"""
+    proc_id = int(os.environ['SLURM_PROCID'])
+    ntasks = int(os.environ['SLURM_NTASKS'])
+    num_nodes = int(os.environ.get('SLURM_NNODES', 1))
+    node_list = os.environ['SLURM_NODELIST']
+    addr = subprocess.getoutput(
+        f'scontrol show hostname {node_list} | head -n1')
+    if port is not None:
+        os.environ['MASTER_PORT'] = str(port)
+    elif 'MASTER_PORT' not in os.environ:
+        os.environ['MASTER_PORT'] = '29500'
+    if 'MASTER_ADDR' not in os.environ:
+        os.environ['MASTER_ADDR'] = addr
+    os.environ['WORLD_SIZE'] = str(ntasks)
+    os.environ['LOCAL_RANK'] = os.environ['SLURM_LOCALID']
+    os.environ['LOCAL_WORLD_SIZE'] = str(max(1, ntasks // num_nodes))
+    os.environ['RANK'] = str(proc_id)
+
+
+def init_dist_cpu(launcher,
+                  backend='gloo',
+                  num_threads=None,
+                  port=None,
+                  **kwargs):
+    """在CPU节点上初始化分布式环境。
+
+    Args:
+        launcher (str): 'pytorch' 即 torchrun 或 torch.distributed.launch 启动,
+            多机时由其设置 MASTER_ADDR 等环境变量; 'slurm' 即 srun 启动。
+        backend (str): 进程组的后端。Default: 'gloo'.
+        num_threads (int, optional): 每个进程的intra-op线程数, 默认为本机的
+            CPU核数除以本机的进程数。
+        port (int, optional): slurm启动时的master端口。
+    """
+    if mp.get_start_method(allow_none=True) is None:
+        mp.set_start_method('spawn')
+    if launcher == 'slurm':
+        _set_slurm_env(port)
+    elif launcher != 'pytorch':
+        raise ValueError(f'Invalid launcher type for CPU: {launcher}')
+    if num_threads is None:
+        local_world_size = int(
+            os.environ.get('LOCAL_WORLD_SIZE',
+                           os.environ.get('WORLD_SIZE', 1)))
+        num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    dist.init_process_group(backend=backend, **kwargs)
+
+
+class CPUDistributedDataParallel(MMDistributedDataParallel):
+    """在CPU上使用的MMDistributedDataParallel。
+
+    mmcv的实现只在 ``device_ids`` 非空时scatter DataContainer, 而CPU上的
+    DDP没有 ``device_ids``, 这里先按 ``[-1]`` scatter到CPU, 再交给
+    MMDistributedDataParallel做梯度同步。
+    """
+
+    def train_step(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().train_step(*inputs[0], **kwargs[0])
+
+    def val_step(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().val_step(*inputs[0], **kwargs[0])
+
+    def forward(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().forward(*inputs[0], **kwargs[0])
+
+
+def build_zero_optimizer(optimizer, **kwargs):
+    """将optimizer的状态按rank切分 (ZeRO stage 1)。
+
+    保留 ``optimizer`` 的param_groups (包括paramwise_cfg得到的lr_mult等),
+    每个rank只保存并更新自己那部分参数的状态, 更新后再广播参数。AdamW的
+    exp_avg/exp_avg_sq 占用的内存因此约为原来的 1/world_size。
+
+    Args:
+        optimizer (torch.optim.Optimizer): 由build_optimizer得到的优化器,
+            此时还没有状态。
+        kwargs: 传给 ZeroRedundancyOptimizer, 如 parameters_as_bucket_view。
+
+    Returns:
+        ZeroRedundancyOptimizer: 保存checkpoint之前需要所有rank一起调用
+            ``consolidate_state_dict()``, 见 ZeroOptimizerHook。
+    """
+    return ZeroRedundancyOptimizer(
+        optimizer.param_groups,
+        optimizer_class=type(optimizer),
+        **optimizer.defaults,
+        **kwargs)
@@ -7,10 +7,10 @@ import numpy as np
 import torch
 from mmcv.ops import RoIPool
 from mmcv.parallel import collate, scatter
-from mmcv.runner import load_checkpoint
 from mmdet.core import get_classes
 from mmdet.datasets.pipelines import Compose
 
+from opera.core import load_checkpoint_mmap
 from opera.datasets import replace_ImageToTensor
 from opera.models import build_model
 
@@ -43,7 +43,8 @@ def init_detector(config, checkpoint=None, device='cuda:0', cfg_options=None):
     config.model.train_cfg = None
     model = build_model(config.model, test_cfg=config.get('test_cfg'))
     if checkpoint is not None:
-        checkpoint = load_checkpoint(model, checkpoint, map_location='cpu')
+        # 本地文件通过mmap读取, 不读取optimizer的状态
+        checkpoint = load_checkpoint_mmap(model, checkpoint)
         if 'CLASSES' in checkpoint.get('meta', {}):
             model.CLASSES = checkpoint['meta']['CLASSES']
         else:
@@ -0,0 +1,174 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 分片保存测试结果
+#   每个rank在推理过程中将结果逐张追加到自己的shard文件, 不再在内存中保存全部结果,
+#   也不再pickle。结果由numpy数组组成的嵌套tuple/list构成, 结构与dtype在同一个
+#   shard中保持不变, 数组的shape可以不同。
+#       part_{rank}.bin   所有数组的原始字节
+#       part_{rank}.npz   offsets [n + 1], shapes [n, num_leaves, max_ndim],
+#                         结构spec(json)与每个数组的dtype
+#   DistributedSampler(shuffle=False)下数据集第i个结果为 shard[i % ws][i // ws]。
+import json
+import os
+import os.path as osp
+import shutil
+from collections.abc import Sequence
+
+import mmcv
+import numpy as np
+
+SHARD_VERSION = 1
+
+
+def _flatten(obj, leaves):
+    if isinstance(obj, (tuple, list)):
+        return [type(obj).__name__, [_flatten(o, leaves) for o in obj]]
+    leaves.append(np.asarray(obj))
+    return 'leaf'
+
+
+def _unflatten(spec, leaves):
+    if spec == 'leaf':
+        return next(leaves)
+    type_name, children = spec
+    objs = [_unflatten(child, leaves) for child in children]
+    return tuple(objs) if type_name == 'tuple' else objs
+
+
+class ResultShardWriter:
+    """将一个rank的结果逐个追加到shard文件。
+
+    Args:
+        tmpdir (str): 所有rank共享的目录。
+        rank (int): 当前rank。
+    """
+
+    def __init__(self, tmpdir, rank):
+        self.tmpdir = tmpdir
+        self.rank = rank
+        mmcv.mkdir_or_exist(tmpdir)
+        self._fp = open(osp.join(tmpdir, f'part_{rank}.bin'), 'wb')
+        self.spec = None
+        self.dtypes = None
+        self.offsets = [0]
+        self.shapes = []
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def add(self, result):
+        leaves = []
+        spec = _flatten(result, leaves)
+        dtypes = [leaf.dtype for leaf in leaves]
+        if self.spec is None:
+            self.spec, self.dtypes = spec, dtypes
+        assert spec == self.spec and dtypes == self.dtypes, \
+            'all results in a shard must share the same structure and dtypes'
+        size = 0
+        for leaf in leaves:
+            buf = np.ascontiguousarray(leaf).tobytes()
+            self._fp.write(buf)
+            size += len(buf)
+        self.offsets.append(self.offsets[-1] + size)
+        self.shapes.append([leaf.shape for leaf in leaves])
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        num_leaves = len(self.dtypes) if self.dtypes is not None else 0
+        max_ndim = max([len(s) for shapes in self.shapes for s in shapes],
+                       default=0)
+        # 不足max_ndim的维度用-1补齐
+        shapes = np.full((len(self.shapes), num_leaves, max_ndim), -1,
+                         dtype=np.int64)
+        for i, leaf_shapes in enumerate(self.shapes):
+            for j, shape in enumerate(leaf_shapes):
+                shapes[i, j, :len(shape)] = shape
+        # dtype以空数组保存, npy格式本身支持结构化dtype
+        arrays = {f'dtype_{j}': np.empty(0, dtype=dtype)
+                  for j, dtype in enumerate(self.dtypes or [])}
+        index_file = osp.join(self.tmpdir, f'part_{self.rank}.npz')
+        with open(index_file + '.tmp', 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(SHARD_VERSION),
+                spec=np.array(json.dumps(self.spec)),
+                offsets=np.asarray(self.offsets, dtype=np.int64),
+                shapes=shapes,
+                **arrays)
+        os.replace(index_file + '.tmp', index_file)
+
+
+class _ResultShard:
+
+    def __init__(self, tmpdir, rank):
+        index = np.load(osp.join(tmpdir, f'part_{rank}.npz'))
+        assert int(index['version']) == SHARD_VERSION, \
+            f"unsupported shard version: {int(index['version'])}"
+        self.spec = json.loads(str(index['spec']))
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.dtypes = [
+            index[f'dtype_{j}'].dtype for j in range(self.shapes.shape[1])
+        ]
+        data_file = osp.join(tmpdir, f'part_{rank}.bin')
+        self.data = np.memmap(data_file, dtype=np.uint8, mode='r') \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        offset = int(self.offsets[idx])
+        leaves = []
+        for shape, dtype in zip(self.shapes[idx], self.dtypes):
+            shape = tuple(int(s) for s in shape if s >= 0)
+            count = int(np.prod(shape))
+            size = count * dtype.itemsize
+            leaf = np.frombuffer(
+                self.data[offset:offset + size], dtype=dtype,
+                count=count).reshape(shape)
+            # 拷贝一份, 避免结果被修改时写回只读的memmap
+            leaves.append(leaf.copy())
+            offset += size
+        return _unflatten(self.spec, iter(leaves))
+
+
+class ShardedResults(Sequence):
+    """按数据集顺序懒加载分片结果, 可以直接传给 dataset.evaluate。
+
+    Args:
+        tmpdir (str): ResultShardWriter 的输出目录。
+        world_size (int): shard个数。
+        size (int): 数据集长度, 多出的结果为dataloader补齐的样本。
+    """
+
+    def __init__(self, tmpdir, world_size, size):
+        self.tmpdir = tmpdir
+        self.size = size
+        self.shards = [_ResultShard(tmpdir, i) for i in range(world_size)]
+        assert sum(len(s) for s in self.shards) >= size, \
+            'shards contain fewer results than the dataset'
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'index {idx} out of range')
+        world_size = len(self.shards)
+        return self.shards[idx % world_size][idx // world_size]
+
+    def cleanup(self):
+        """删除shard文件, 之后不能再访问结果"""
+        self.shards = []
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(tmpdir={self.tmpdir}, '
+                f'size={self.size}, num_shards={len(self.shards)})')
@@ -12,6 +12,8 @@ from mmcv.image import tensor2imgs
 from mmcv.runner import get_dist_info
 from mmdet.core import encode_mask_results
 
+from .result_shards import ResultShardWriter, ShardedResults
+
 SEG_ALG = ['SOIT', 'MaskRCNN', 'MaskScoringRCNN']
 
 
@@ -135,7 +137,12 @@ def multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
         results = collect_results_cpu(results, len(dataset), tmpdir)
     return results
 
-def multi_gpu_test_3d(model, data_loader, tmpdir=None, gpu_collect=False):
+def multi_gpu_test_3d(model,
+                      data_loader,
+                      tmpdir=None,
+                      gpu_collect=False,
+                      evaluator=None,
+                      timing=None):
     """Test model with multiple gpus.
 
     This method tests model with multiple gpus and collects the results
@@ -144,62 +151,123 @@ def multi_gpu_test_3d(model, data_loader, tmpdir=None, gpu_collect=False):
     collection. On cpu mode it saves the results on different gpus to 'tmpdir'
     and collects them by the rank 0 worker.
 
+    If ``evaluator`` is given, results are evaluated on the fly instead: every
+    rank matches its own predictions to the gt and accumulates the sufficient
+    statistics, which are all-reduced once inference finishes. No prediction
+    is kept in memory.
+
     Args:
         model (nn.Module): Model to be tested.
         data_loader (nn.Dataloader): Pytorch data loader.
         tmpdir (str): Path of directory to save the temporary results from
             different gpus under cpu mode.
         gpu_collect (bool): Option to use either gpu or cpu to collect results.
+        evaluator (MuPoTSEvaluator, optional): Streaming evaluator with
+            ``process(idx, result)``, ``all_reduce()`` and ``evaluate()``.
+            Default: None.
+        timing (dict, optional): If given, the wall time in seconds of the
+            inference loop (until every rank finishes it) is written to
+            ``timing['inference']``, excluding the start-up sleep and the
+            result collection. Default: None.
+
+    Without ``gpu_collect`` every rank appends its results to a shard file in
+    ``tmpdir`` as batches complete, and rank 0 returns a lazy
+    :obj:`ShardedResults` that reads them back in dataset order. Call its
+    ``cleanup()`` to remove the shards once they are no longer needed.
 
     Returns:
-        list: The prediction results.
+        list | ShardedResults | dict: The prediction results, or the metrics
+            returned by ``evaluator.evaluate()`` on every rank.
     """
     model.eval()
     results = []
     dataset = data_loader.dataset
     rank, world_size = get_dist_info()
+    writer = None
+    if evaluator is None and not gpu_collect:
+        writer = ResultShardWriter(get_dist_tmpdir(tmpdir), rank)
     if rank == 0:
         prog_bar = mmcv.ProgressBar(len(dataset))
-    time.sleep(2)  # This line can prevent deadlock problem in some cases.
+    if world_size > 1:
+        time.sleep(2)  # This line can prevent deadlock problem in some cases.
+    # 不打乱的DistributedSampler中, 本rank第k个样本的索引为 rank + k * world_size,
+    # 超出数据集长度的索引是补齐用的重复样本
+    num_processed = 0
+    start = time.perf_counter()
     for i, data in enumerate(data_loader):
         with torch.no_grad():
             result = model(return_loss=False, rescale=True, **data)
-            
-        results.extend(result)
+
+        if writer is not None:
+            for res in result:
+                writer.add(res)
+        elif evaluator is None:
+            results.extend(result)
+        else:
+            for res in result:
+                idx = rank + num_processed * world_size
+                num_processed += 1
+                if idx < len(dataset):
+                    evaluator.process(idx, res)
 
         if rank == 0:
             batch_size = len(result)
             for _ in range(batch_size * world_size):
                 prog_bar.update()
 
+    if timing is not None:
+        if world_size > 1:
+            dist.barrier()
+        timing['inference'] = time.perf_counter() - start
+
+    if evaluator is not None:
+        evaluator.all_reduce()
+        return evaluator.evaluate()
+
+    if writer is not None:
+        writer.close()
+        if world_size > 1:
+            dist.barrier()
+        if rank != 0:
+            return None
+        return ShardedResults(writer.tmpdir, world_size, len(dataset))
+
     # collect results from all ranks
-    if gpu_collect:
-        results = collect_results_gpu(results, len(dataset))
-    else:
-        results = collect_results_cpu(results, len(dataset), tmpdir)
+    results = collect_results_gpu(results, len(dataset))
     return results
 
 
+def get_dist_tmpdir(tmpdir=None):
+    """Create a tmp dir on rank 0 and broadcast its path to all ranks.
+
+    The path is broadcast on the device of the current backend, so it also
+    works with gloo on CPU-only machines.
+    """
+    rank, world_size = get_dist_info()
+    if tmpdir is not None:
+        mmcv.mkdir_or_exist(tmpdir)
+        return tmpdir
+    if world_size == 1:
+        mmcv.mkdir_or_exist('.dist_test')
+        return tempfile.mkdtemp(dir='.dist_test')
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    MAX_LEN = 512
+    # 32 is whitespace
+    dir_tensor = torch.full((MAX_LEN, ), 32, dtype=torch.uint8, device=device)
+    if rank == 0:
+        mmcv.mkdir_or_exist('.dist_test')
+        tmpdir = tempfile.mkdtemp(dir='.dist_test')
+        tmpdir = torch.tensor(
+            bytearray(tmpdir.encode()), dtype=torch.uint8, device=device)
+        dir_tensor[:len(tmpdir)] = tmpdir
+    dist.broadcast(dir_tensor, 0)
+    return dir_tensor.cpu().numpy().tobytes().decode().rstrip()
+
+
 def collect_results_cpu(result_part, size, tmpdir=None):
     rank, world_size = get_dist_info()
     # create a tmp dir if it is not specified
-    if tmpdir is None:
-        MAX_LEN = 512
-        # 32 is whitespace
-        dir_tensor = torch.full((MAX_LEN, ),
-                                32,
-                                dtype=torch.uint8,
-                                device='cuda')
-        if rank == 0:
-            mmcv.mkdir_or_exist('.dist_test')
-            tmpdir = tempfile.mkdtemp(dir='.dist_test')
-            tmpdir = torch.tensor(
-                bytearray(tmpdir.encode()), dtype=torch.uint8, device='cuda')
-            dir_tensor[:len(tmpdir)] = tmpdir
-        dist.broadcast(dir_tensor, 0)
-        tmpdir = dir_tensor.cpu().numpy().tobytes().decode().rstrip()
-    else:
-        mmcv.mkdir_or_exist(tmpdir)
+    tmpdir = get_dist_tmpdir(tmpdir)
     # dump the part result to the dir
     mmcv.dump(result_part, osp.join(tmpdir, f'part_{rank}.pkl'))
     dist.barrier()
@@ -225,16 +293,18 @@ def collect_results_cpu(result_part, size, tmpdir=None):
 
 def collect_results_gpu(result_part, size):
     rank, world_size = get_dist_info()
+    # gloo后端在CPU上通信
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
     # dump result part to tensor with pickle
     part_tensor = torch.tensor(
-        bytearray(pickle.dumps(result_part)), dtype=torch.uint8, device='cuda')
+        bytearray(pickle.dumps(result_part)), dtype=torch.uint8, device=device)
     # gather all result part tensor shape
-    shape_tensor = torch.tensor(part_tensor.shape, device='cuda')
+    shape_tensor = torch.tensor(part_tensor.shape, device=device)
     shape_list = [shape_tensor.clone() for _ in range(world_size)]
     dist.all_gather(shape_list, shape_tensor)
     # padding result part tensor to max length
     shape_max = torch.tensor(shape_list).max()
-    part_send = torch.zeros(shape_max, dtype=torch.uint8, device='cuda')
+    part_send = torch.zeros(shape_max, dtype=torch.uint8, device=device)
     part_send[:shape_tensor[0]] = part_tensor
     part_recv_list = [
         part_tensor.new_zeros(shape_max) for _ in range(world_size)
@@ -1,4 +1,5 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
+import copy
 import os
 import random
 
@@ -12,12 +13,14 @@ from mmdet.core import build_optimizer
 from mmdet.utils import (build_ddp, build_dp, compat_cfg,
                             find_latest_checkpoint, get_root_logger)
 
-from opera.core import DistEvalHook, EvalHook
+from opera.core import (DistEvalHook, EvalHook, ZeroOptimizerHook,
+                        load_frozen_params)
 from opera.datasets import (build_dataloader, build_dataset,
                             replace_ImageToTensor)
+from .dist_utils import CPUDistributedDataParallel, build_zero_optimizer
 
 
-def init_random_seed(seed=None, device='cuda'):
+def init_random_seed(seed=None, device=None):
     """Initialize random seed.
 
     If the seed is not set, the seed will be automatically randomized,
@@ -25,8 +28,8 @@ def init_random_seed(seed=None, device='cuda'):
 
     Args:
         seed (int, Optional): The seed. Default to None.
-        device (str): The device where the seed will be put on.
-            Default to 'cuda'.
+        device (str, optional): The device where the seed will be put on.
+            Defaults to 'cuda' for the nccl backend and 'cpu' otherwise.
 
     Returns:
         int: Seed to be used.
@@ -42,6 +45,8 @@ def init_random_seed(seed=None, device='cuda'):
     if world_size == 1:
         return seed
 
+    if device is None:
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
     if rank == 0:
         random_num = torch.tensor(seed, dtype=torch.int32, device=device)
     else:
@@ -152,7 +157,13 @@ def train_model(model,
     # print("dataloader 信息")
     # print(f"batch_size: {data_loaders[0].batch_size}")
     # put model on gpus
-    if distributed:
+    if distributed and cfg.device == 'cpu':
+        # gloo后端, build_ddp只支持cuda/mlu
+        model = CPUDistributedDataParallel(
+            model,
+            broadcast_buffers=False,
+            find_unused_parameters=cfg.get('find_unused_parameters', False))
+    elif distributed:
         find_unused_parameters = cfg.get('find_unused_parameters', False)
         # Sets the `find_unused_parameters` parameter in
         # torch.nn.parallel.DistributedDataParallel
@@ -168,6 +179,11 @@ def train_model(model,
     # build optimizer
     auto_scale_lr(cfg, distributed, logger)
     optimizer = build_optimizer(model, cfg.optimizer)
+    # 按rank切分optimizer状态, e.g. zero_optimizer = dict(enable=True)
+    zero_cfg = copy.deepcopy(cfg.get('zero_optimizer', {}))
+    use_zero = distributed and zero_cfg.pop('enable', False)
+    if use_zero:
+        optimizer = build_zero_optimizer(optimizer, **zero_cfg)
 
     runner = build_runner(
         cfg.runner,
@@ -204,6 +220,16 @@ def train_model(model,
     if distributed:
         if isinstance(runner, EpochBasedRunner):
             runner.register_hook(DistSamplerSeedHook())
+    if use_zero and cfg.checkpoint_config is not None:
+        # 在CheckpointHook之前汇总优化器状态, 保存之后在rank 0上释放
+        for release, priority in ((False, 'ABOVE_NORMAL'),
+                                  (True, 'BELOW_NORMAL')):
+            runner.register_hook(
+                ZeroOptimizerHook(
+                    interval=cfg.checkpoint_config.get('interval', -1),
+                    by_epoch=cfg.checkpoint_config.get('by_epoch', True),
+                    release=release),
+                priority=priority)
 
     # register eval hooks
     if validate:
@@ -241,9 +267,12 @@ def train_model(model,
     if resume_from is not None:
         cfg.resume_from = resume_from
 
+    # AsyncCheckpointHook(trainable_only=True)的checkpoint不包含冻结的参数
     if cfg.resume_from:
+        load_frozen_params(runner.model, cfg.resume_from)
         runner.resume(cfg.resume_from)
     elif cfg.load_from:
+        load_frozen_params(runner.model, cfg.load_from)
         runner.load_checkpoint(cfg.load_from)
         
     runner.run(data_loaders, cfg.workflow)
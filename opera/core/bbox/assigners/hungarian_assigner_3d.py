@@ -156,9 +156,12 @@ class PoseHungarianAssigner3D(BaseAssigner):
                                 'to install scipy first.')
         try:
             matched_row_inds, matched_col_inds = linear_sum_assignment(cost)  # [num_gts, ]
-        except:
-            print('Error in linear_sum_assignment')
-            import pdb;pdb.set_trace()
+        except ValueError as e:
+            # cost中有nan或inf时linear_sum_assignment无法匹配
+            raise ValueError(
+                f'linear_sum_assignment failed, the cost has '
+                f'{int(torch.isnan(cost).sum())} nan and '
+                f'{int(torch.isinf(cost).sum())} inf values') from e
         matched_row_inds = torch.from_numpy(matched_row_inds).to(
             kpt_pred.device)
         matched_col_inds = torch.from_numpy(matched_col_inds).to(
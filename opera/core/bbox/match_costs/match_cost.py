@@ -200,7 +200,8 @@ class DepthL1Cost(object):
             refer_cost = torch.abs(refer_depth_tmp - gt_aver_real_depth)  # [300, 1]
             # 计算关键点深度损失
             # gt_depth = torch.zeros_like(gt_keypoints_depth[i][..., 0])
-            gt_depth = torch.zeros((15, )).cuda()
+            gt_depth = gt_keypoints_depth.new_zeros(
+                (gt_keypoints_depth.size(1), ))  # [15, ]
             gt_depth[valid_flag] = gt_keypoints_depth[i][valid_flag][..., 0] / scale_w / \
                 gt_keypoints_depth[i][valid_flag][..., 1]  # Z * w / fx, [15, ]
             kpt_cost = torch.cdist(
@@ -214,9 +215,6 @@ class DepthL1Cost(object):
             kpt_depth_cost.append(kpt_cost)
         kpt_depth_cost = torch.cat(kpt_depth_cost, dim=1)
         refer_depth_cost = torch.cat(refer_depth_cost, dim=1)
-        num_nan_1 = torch.isnan(kpt_depth_cost).int().sum()
-        num_nan_2 = torch.isnan(refer_depth_cost).int().sum()
-        if num_nan_1 > 0 or num_nan_2 > 0:
-            import pdb;pdb.set_trace()
+        # cost中的nan由assigner中的linear_sum_assignment报错, 这里不再同步检查
         return refer_depth_cost * self.refer_depth_weight, \
                 kpt_depth_cost * self.kpt_depth_weight
\ No newline at end of file
@@ -1,4 +1,13 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
 from .eval_hooks import DistEvalHook, EvalHook
+from .keypoint_eval import (COCO_KEYPOINT_SIGMAS, CROWDPOSE_KEYPOINT_SIGMAS,
+                            KeypointCOCOeval, compute_oks)
+from .mupots import (MUPOTS_JOINT_NAMES, MuPoTSEvaluator, MuPoTSStats,
+                     evaluate_mupots, get_mupots_seq_id)
 
-__all__ = ['DistEvalHook', 'EvalHook']
+__all__ = [
+    'DistEvalHook', 'EvalHook', 'COCO_KEYPOINT_SIGMAS',
+    'CROWDPOSE_KEYPOINT_SIGMAS', 'KeypointCOCOeval', 'compute_oks',
+    'MUPOTS_JOINT_NAMES', 'MuPoTSEvaluator',
+    'MuPoTSStats', 'evaluate_mupots', 'get_mupots_seq_id'
+]
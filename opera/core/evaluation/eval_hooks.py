@@ -1,12 +1,20 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import atexit
 import bisect
+import copy
 import os.path as osp
+import queue
+from functools import partial
 
 import mmcv
+import torch
 import torch.distributed as dist
+import torch.multiprocessing as mp
+from mmcv.parallel import collate, is_module_wrapper, scatter
 from mmcv.runner import DistEvalHook as BaseDistEvalHook
 from mmcv.runner import EvalHook as BaseEvalHook
 from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.data import DataLoader
 
 
 def _calc_dynamic_intervals(start_interval, dynamic_interval_list):
@@ -21,11 +29,170 @@ def _calc_dynamic_intervals(start_interval, dynamic_interval_list):
     return dynamic_milestones, dynamic_intervals
 
 
-class EvalHook(BaseEvalHook):
+def _async_eval_worker(model, dataset, device, num_workers, eval_kwargs,
+                       in_queue, out_queue):
+    """评测进程: 依次读取快照, 在完整的验证集上推理并评测"""
+    device = torch.device(device)
+    device_id = -1 if device.type == 'cpu' else device.index or 0
+    if device.type == 'cuda':
+        torch.cuda.set_device(device_id)
+    model = model.to(device).eval()
+    # 与训练时的分布式划分无关, 在单个进程中评测完整的验证集
+    dataloader = DataLoader(
+        dataset,
+        batch_size=1,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=partial(collate, samples_per_gpu=1))
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        progress, state_dict = item
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+            results = []
+            with torch.no_grad():
+                for data in dataloader:
+                    data = scatter(data, [device_id])[0]
+                    results.extend(
+                        model(return_loss=False, rescale=True, **data))
+            eval_res = dataset.evaluate(results, **eval_kwargs)
+            out_queue.put((progress, eval_res, None))
+        except Exception as e:
+            out_queue.put((progress, None, repr(e)))
 
-    def __init__(self, *args, dynamic_intervals=None, **kwargs):
+
+class AsyncEvalMixin:
+    """Evaluate snapshots of the model in a background process.
+
+    At every evaluation point the weights are copied to CPU and put into a
+    bounded queue; training continues immediately. A separate process (spawn)
+    holds its own copy of the model on ``async_device``, runs inference over
+    the whole validation set and calls ``dataset.evaluate``, so it does not
+    compete with training for the GIL or the intra-op thread pool. If the
+    queue is full the evaluation point is skipped. In distributed training
+    only rank 0 evaluates.
+
+    Finished metrics are logged with ``eval_progress`` (the epoch or iter of
+    the snapshot) and added to ``runner.log_buffer.output``, so they are
+    written together with the next training log (json, tensorboard, ...).
+    ``eval_iter_num`` and ``log_buffer.ready`` are not touched, the training
+    log keeps its mode and iteration.
+
+    ``save_best`` is not supported in async mode since the best checkpoint
+    would have to be the snapshot rather than the current weights, and
+    ``latest_results`` is not set since the results stay in the process.
+    """
+
+    def _init_async(self, async_eval, async_device, async_queue_size,
+                    async_workers):
+        self.async_eval = async_eval
+        if not async_eval:
+            return
+        assert self.save_best is None, \
+            'save_best is not supported with async_eval'
+        self.async_device = torch.device(async_device)
+        self.async_queue_size = async_queue_size
+        self.async_workers = async_workers
+        self._async_process = None
+
+    def _start_async(self, runner, model):
+        ctx = mp.get_context('spawn')
+        self._async_queue = ctx.Queue(maxsize=self.async_queue_size)
+        self._async_results = ctx.Queue()
+        self._async_pending = 0
+        self._async_process = ctx.Process(
+            target=_async_eval_worker,
+            args=(copy.deepcopy(model).cpu(), self.dataloader.dataset,
+                  str(self.async_device), self.async_workers,
+                  self.eval_kwargs, self._async_queue, self._async_results))
+        # 评测进程的dataloader需要创建worker, 因此不能为daemon;
+        # 训练异常退出时after_run不会被调用, 退出前通知评测进程结束
+        self._async_process.start()
+        atexit.register(self._stop_async)
+
+    def _stop_async(self):
+        if self._async_process is not None:
+            self._async_queue.put(None)
+            self._async_process.join()
+            self._async_process = None
+
+    def _submit_async(self, runner):
+        model = runner.model.module if is_module_wrapper(runner.model) \
+            else runner.model
+        if self._async_process is None:
+            self._start_async(runner, model)
+        progress = runner.epoch + 1 if self.by_epoch else runner.iter + 1
+        if self._async_pending >= self.async_queue_size:
+            runner.logger.warning(
+                f'async evaluation queue is full, skip evaluation at '
+                f'{"epoch" if self.by_epoch else "iter"} {progress}')
+            return
+        state_dict = {
+            k: v.detach().to('cpu', copy=True)
+            for k, v in model.state_dict().items()
+        }
+        self._async_queue.put((progress, state_dict))
+        # 包括正在评测的快照
+        self._async_pending += 1
+
+    def _publish_async(self, runner, block=False):
+        """输出已经完成的评测结果"""
+        if not self.async_eval or self._async_process is None:
+            return
+        while self._async_pending > 0:
+            try:
+                progress, eval_res, error = self._async_results.get(
+                    block=block, timeout=10 if block else None)
+            except queue.Empty:
+                # 评测进程异常退出时不再等待
+                if block and self._async_process.is_alive():
+                    continue
+                break
+            self._async_pending -= 1
+            if error is not None:
+                runner.logger.error(
+                    f'async evaluation at {progress} failed: {error}')
+                continue
+            runner.logger.info(
+                f'async evaluation at {progress}: ' +
+                ', '.join(f'{k}: {v}' for k, v in eval_res.items()))
+            # 随下一次训练日志写入, 不改变训练日志的mode与iter
+            runner.log_buffer.output.update(eval_res)
+            runner.log_buffer.output['eval_progress'] = progress
+
+    def after_train_iter(self, runner):
+        super().after_train_iter(runner)
+        self._publish_async(runner)
+
+    def after_train_epoch(self, runner):
+        super().after_train_epoch(runner)
+        self._publish_async(runner)
+
+    def after_run(self, runner):
+        """等待剩余的评测完成"""
+        if self.async_eval and self._async_process is not None:
+            self._publish_async(runner, block=True)
+            self._stop_async()
+        super().after_run(runner)
+
+
+class EvalHook(AsyncEvalMixin, BaseEvalHook):
+
+    def __init__(self,
+                 *args,
+                 dynamic_intervals=None,
+                 async_eval=False,
+                 async_device='cpu',
+                 async_queue_size=1,
+                 async_workers=2,
+                 **kwargs):
         super(EvalHook, self).__init__(*args, **kwargs)
         self.latest_results = None
+        self._init_async(async_eval, async_device, async_queue_size,
+                         async_workers)
 
         self.use_dynamic_intervals = dynamic_intervals is not None
         if self.use_dynamic_intervals:
@@ -53,6 +220,10 @@ class EvalHook(BaseEvalHook):
         if not self._should_evaluate(runner):
             return
 
+        if self.async_eval:
+            self._submit_async(runner)
+            return
+
         from opera.apis import single_gpu_test
 
         # Changed results to self.results so that MMDetWandbHook can access
@@ -70,11 +241,20 @@ class EvalHook(BaseEvalHook):
 # Note: Considering that MMCV's EvalHook updated its interface in V1.3.16,
 # in order to avoid strong version dependency, we did not directly
 # inherit EvalHook but BaseDistEvalHook.
-class DistEvalHook(BaseDistEvalHook):
+class DistEvalHook(AsyncEvalMixin, BaseDistEvalHook):
 
-    def __init__(self, *args, dynamic_intervals=None, **kwargs):
+    def __init__(self,
+                 *args,
+                 dynamic_intervals=None,
+                 async_eval=False,
+                 async_device='cpu',
+                 async_queue_size=1,
+                 async_workers=2,
+                 **kwargs):
         super(DistEvalHook, self).__init__(*args, **kwargs)
         self.latest_results = None
+        self._init_async(async_eval, async_device, async_queue_size,
+                         async_workers)
 
         self.use_dynamic_intervals = dynamic_intervals is not None
         if self.use_dynamic_intervals:
@@ -115,6 +295,12 @@ class DistEvalHook(BaseDistEvalHook):
         if not self._should_evaluate(runner):
             return
 
+        if self.async_eval:
+            # 只在rank 0上评测, 其它rank直接继续训练
+            if runner.rank == 0:
+                self._submit_async(runner)
+            return
+
         tmpdir = self.tmpdir
         if tmpdir is None:
             tmpdir = osp.join(runner.work_dir, '.eval_hook')
@@ -0,0 +1,500 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# COCO / CrowdPose 关键点评测
+#   pycocotools 与 xtcocotools 的 COCOeval 需要先将预测转成逐个检测的字典,
+#   并对每一对(dt, gt)用python循环计算OKS。这里直接使用数组形式的预测:
+#       1. 每张图像的所有(dt, gt)对一次性向量化计算OKS;
+#       2. 贪心匹配只在检测上循环, 所有IoU阈值同时计算;
+#       3. 图像之间相互独立, 可以用进程池并行;
+#       4. accumulate 的插值与查表也向量化。
+#   所有步骤的计算顺序与 COCOeval 保持一致, 得到的AP/AR完全相同。
+from multiprocessing import Pool
+
+import numpy as np
+
+COCO_KEYPOINT_SIGMAS = np.array([
+    .26, .25, .25, .35, .35, .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87,
+    .87, .89, .89
+]) / 10.0
+CROWDPOSE_KEYPOINT_SIGMAS = np.array([
+    .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87, .87, .89, .89, .79, .79
+]) / 10.0
+
+
+class KeypointEvalParams:
+    """与 COCOeval.params 相同的关键点评测参数"""
+
+    def __init__(self, iou_type='keypoints'):
+        self.iouType = iou_type
+        self.imgIds = []
+        self.catIds = []
+        self.iouThrs = np.linspace(
+            .5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(
+            .0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+        self.maxDets = [20]
+        self.areaRng = [[0**2, 1e5**2], [32**2, 96**2], [96**2, 1e5**2]]
+        self.areaRngLbl = ['all', 'medium', 'large']
+        self.useCats = 1
+
+
+def compute_oks(dt_kpts, gt_kpts, gt_bboxes, gt_areas, sigmas):
+    """计算一张图像中所有(dt, gt)对的OKS, 与 COCOeval.computeOks 相同。
+
+    Args:
+        dt_kpts (np.ndarray): [num_dts, K, 3]。
+        gt_kpts (np.ndarray): [num_gts, K, 3]。
+        gt_bboxes (np.ndarray): [num_gts, 4], xywh。
+        gt_areas (np.ndarray): [num_gts], 计算OKS使用的面积。
+        sigmas (np.ndarray): [K]。
+    Returns:
+        np.ndarray: [num_dts, num_gts]
+    """
+    num_dts, num_gts = len(dt_kpts), len(gt_kpts)
+    if num_dts == 0 or num_gts == 0:
+        return np.zeros((num_dts, num_gts))
+    variances = (sigmas * 2)**2
+    num_kpts = len(sigmas)
+    xg, yg, vg = gt_kpts[..., 0], gt_kpts[..., 1], gt_kpts[..., 2]
+    vis = vg > 0
+    k1 = np.count_nonzero(vis, axis=1)
+    # 没有可见关键点的gt, 计算到两倍gt框的距离
+    x0 = (gt_bboxes[:, 0] - gt_bboxes[:, 2])[None, :, None]
+    x1 = (gt_bboxes[:, 0] + gt_bboxes[:, 2] * 2)[None, :, None]
+    y0 = (gt_bboxes[:, 1] - gt_bboxes[:, 3])[None, :, None]
+    y1 = (gt_bboxes[:, 1] + gt_bboxes[:, 3] * 2)[None, :, None]
+    xd = dt_kpts[:, None, :, 0]
+    yd = dt_kpts[:, None, :, 1]
+    has_vis = (k1 > 0)[None, :, None]
+    dx = np.where(has_vis, xd - xg[None],
+                  np.maximum(0, x0 - xd) + np.maximum(0, xd - x1))
+    dy = np.where(has_vis, yd - yg[None],
+                  np.maximum(0, y0 - yd) + np.maximum(0, yd - y1))
+    e = (dx**2 + dy**2) / variances / (gt_areas[None, :, None] +
+                                       np.spacing(1)) / 2
+    # [num_dts, num_gts, K]
+    oks = np.exp(-e)
+    ious = np.zeros((num_dts, num_gts))
+    for j in range(num_gts):
+        # 先取出可见关键点再求和, 与逐对计算的求和顺序一致
+        if k1[j] > 0:
+            ious[:, j] = np.sum(oks[:, j][:, vis[j]], axis=1) / k1[j]
+        else:
+            ious[:, j] = np.sum(oks[:, j], axis=1) / num_kpts
+    return ious
+
+
+def _last_argmax(vals):
+    """最后一个最大值的索引以及是否存在有限的最大值"""
+    num = vals.shape[-1]
+    last = num - 1 - np.argmax(vals[..., ::-1], axis=-1)
+    return last, np.isfinite(vals.max(axis=-1))
+
+
+def _match(ious, gt_ignore, gt_iscrowd, iou_thrs):
+    """COCOeval.evaluateImg 中的贪心匹配, 多张图像与所有阈值同时计算。
+
+    每一行(一张图像的一个面积范围)的gt已经按ignore排序(不忽略的在前),
+    dt按分数从高到低排序。补齐的dt与gt的iou为-1, 不会被匹配。
+
+    Args:
+        ious (np.ndarray): [N, D, G]。
+        gt_ignore (np.ndarray): [N, G]。
+        gt_iscrowd (np.ndarray): [N, G]。
+        iou_thrs (np.ndarray): [T]。
+    Returns:
+        np.ndarray: [N, T, D], 匹配到的gt索引, 未匹配为-1。
+    """
+    num_rows, num_dts, num_gts = ious.shape
+    num_thrs = len(iou_thrs)
+    dt_match = np.full((num_rows, num_thrs, num_dts), -1, dtype=np.int64)
+    if num_rows == 0 or num_dts == 0 or num_gts == 0:
+        return dt_match
+    thrs = np.minimum(iou_thrs, 1 - 1e-10)[None, :, None]
+    valid_gt = (gt_ignore == 0)[:, None]
+    gt_available = np.ones((num_rows, num_thrs, num_gts), dtype=bool)
+    for d in range(num_dts):
+        iou = ious[:, d][:, None]
+        # crowd gt可以被重复匹配
+        cand = (iou >= thrs) & gt_available
+        # 匹配到不忽略的gt后不再考虑忽略的gt, 相同的iou取最后一个
+        last, found = _last_argmax(np.where(cand & valid_gt, iou, -np.inf))
+        last_ig, found_ig = _last_argmax(
+            np.where(cand & ~valid_gt, iou, -np.inf))
+        match = np.where(found, last, np.where(found_ig, last_ig, -1))
+        dt_match[:, :, d] = match
+        rows, thr_inds = np.nonzero(match >= 0)
+        gt_inds = match[rows, thr_inds]
+        gt_available[rows, thr_inds, gt_inds] = gt_iscrowd[rows, gt_inds]
+    return dt_match
+
+
+def _evaluate_imgs(tasks, cfg):
+    """评测多张图像, 每张图像的一个类别为一项。
+
+    Returns:
+        list[list[tuple] | None]: 每一项对应每个面积范围的
+            (dt_scores [D], dt_matched [T, D], dt_ignore [T, D], num_pos),
+            gt与dt都为空时为None。
+    """
+    max_det = cfg['max_det']
+    items = []
+    for gt, (scores, kpts, areas) in tasks:
+        if len(gt['ids']) == 0 and len(scores) == 0:
+            items.append(None)
+            continue
+        inds = np.argsort(-scores, kind='mergesort')[:max_det]
+        scores, kpts, areas = scores[inds], kpts[inds], areas[inds]
+        ious = compute_oks(kpts, gt['keypoints'], gt['bboxes'],
+                           gt['oks_areas'], cfg['sigmas'])
+        items.append((scores, areas, ious, gt))
+    valid = [item for item in items if item is not None]
+    if len(valid) == 0:
+        return items
+
+    # 补齐到相同的dt与gt个数, 每张图像的每个面积范围为一行
+    lo, hi = np.array(cfg['area_rngs'], dtype=np.float64).T
+    N, A, T = len(valid), len(lo), len(cfg['iou_thrs'])
+    D = max(len(item[0]) for item in valid)
+    G = max(max(len(item[3]['ids']) for item in valid), 1)
+    ious = np.full((N, D, G), -1.)
+    dt_areas = np.zeros((N, D))
+    gt_ignore = np.full((N, A, G), 2, dtype=np.int64)
+    gt_iscrowd = np.zeros((N, G), dtype=bool)
+    gt_ids = np.ones((N, G), dtype=np.int64)
+    for n, (scores, areas, item_ious, gt) in enumerate(valid):
+        num_dts, num_gts = item_ious.shape
+        ious[n, :num_dts, :num_gts] = item_ious
+        dt_areas[n, :num_dts] = areas
+        rng_areas = gt['rng_areas'][None]
+        gt_ignore[n, :, :num_gts] = gt['ignore'][None] | \
+            (rng_areas < lo[:, None]) | (rng_areas > hi[:, None])
+        gt_iscrowd[n, :num_gts] = gt['iscrowd']
+        gt_ids[n, :num_gts] = gt['ids']
+
+    # 补齐的gt的ignore为2, 稳定排序后排在最后, 不改变真实gt的顺序
+    gtind = np.argsort(gt_ignore, axis=-1, kind='stable')
+    gt_ignore = np.take_along_axis(gt_ignore, gtind, -1)
+    gt_iscrowd = np.take_along_axis(gt_iscrowd[:, None], gtind, -1)
+    gt_ids = np.take_along_axis(gt_ids[:, None], gtind, -1)
+    ious = np.take_along_axis(ious[:, None], gtind[:, :, None], -1)
+    dt_match = _match(
+        ious.reshape(N * A, D, G), gt_ignore.reshape(N * A, G),
+        gt_iscrowd.reshape(N * A, G), cfg['iou_thrs']).reshape(N, A, T, D)
+
+    matched = dt_match >= 0
+    gt_inds = np.maximum(dt_match, 0).reshape(N, A, T * D)
+    dt_ignore = matched & (np.take_along_axis(gt_ignore, gt_inds, -1) >
+                           0).reshape(N, A, T, D)
+    if cfg['zero_id_unmatched']:
+        # pycocotools 用gt id是否为0判断是否匹配
+        matched &= (np.take_along_axis(gt_ids, gt_inds, -1) != 0).reshape(
+            N, A, T, D)
+    out_of_rng = (dt_areas[:, None] < lo[None, :, None]) | \
+        (dt_areas[:, None] > hi[None, :, None])
+    dt_ignore |= ~matched & out_of_rng[:, :, None]
+    num_pos = np.count_nonzero(gt_ignore == 0, axis=-1)
+
+    results = iter(range(N))
+    for i, item in enumerate(items):
+        if item is None:
+            continue
+        n = next(results)
+        num_dts = len(item[0])
+        items[i] = [(item[0], matched[n, a, :, :num_dts],
+                     dt_ignore[n, a, :, :num_dts], int(num_pos[n, a]))
+                    for a in range(A)]
+    return items
+
+
+def _evaluate_chunk(args):
+    tasks, cfg = args
+    return _evaluate_imgs(tasks, cfg)
+
+
+class KeypointCOCOeval:
+    """向量化的关键点 COCOeval, 接口与 COCOeval 相同。
+
+    ``evaluate()``, ``accumulate()``, ``summarize()`` 之后得到与 pycocotools
+    (``xtcocotools=False``) 或 xtcocotools 的 COCOeval 完全相同的
+    ``eval`` 与 ``stats``。
+
+    Args:
+        coco_gt (COCO): gt, pycocotools 或 xtcocotools 的COCO对象。
+        results (dict): (image_id, category_id) -> (scores [n],
+            keypoints [n, K, 3]), 每张图像内的顺序与结果json中的顺序相同。
+        iou_type (str): 'keypoints' 或 'keypoints_crowd'。
+        sigmas (np.ndarray, optional): 关键点的sigma。Default: None, 使用COCO的
+            17个关键点。
+        use_area (bool): 与xtcocotools相同, False时使用gt框面积的0.53倍。
+            Default: True.
+        xtcocotools (bool): 与xtcocotools的实现保持一致, 否则与pycocotools
+            一致。'keypoints_crowd' 只有xtcocotools支持。Default: False.
+        nproc (int): 进程数, 大于1时按图像分块并行评测。Default: 1.
+    """
+
+    def __init__(self,
+                 coco_gt,
+                 results,
+                 iou_type='keypoints',
+                 sigmas=None,
+                 use_area=True,
+                 xtcocotools=False,
+                 nproc=1):
+        assert iou_type in ('keypoints', 'keypoints_crowd')
+        assert xtcocotools or iou_type == 'keypoints', \
+            "'keypoints_crowd' is only supported by xtcocotools"
+        self.coco_gt = coco_gt
+        self.sigmas = COCO_KEYPOINT_SIGMAS if sigmas is None else \
+            np.asarray(sigmas, dtype=np.float64)
+        self.use_area = use_area
+        self.xtcocotools = xtcocotools
+        self.nproc = nproc
+        self.params = KeypointEvalParams(iou_type)
+        self.params.imgIds = sorted(coco_gt.getImgIds())
+        self.params.catIds = sorted(coco_gt.getCatIds())
+        gt_img_ids = set(coco_gt.getImgIds())
+        assert all(img_id in gt_img_ids for img_id, _ in results), \
+            'Results do not correspond to current coco set'
+        self.results = results
+        self.evalImgs = {}
+        self.eval = {}
+        self.stats = []
+
+    def _prepare_gt(self, img_id, cat_id):
+        num_kpts = len(self.sigmas)
+        anns = [
+            ann for ann in self.coco_gt.imgToAnns.get(img_id, [])
+            if ann['category_id'] == cat_id
+        ]
+        keypoints = np.array([ann['keypoints'] for ann in anns],
+                             dtype=np.float64).reshape(-1, num_kpts, 3)
+        bboxes = np.array([ann['bbox'] for ann in anns],
+                          dtype=np.float64).reshape(-1, 4)
+        iscrowd = np.array([bool(ann.get('iscrowd', 0)) for ann in anns],
+                           dtype=bool)
+        if not self.xtcocotools or self.params.iouType == 'keypoints_crowd':
+            num_vis = np.array([ann['num_keypoints'] for ann in anns],
+                               dtype=np.int64)
+        else:
+            num_vis = np.count_nonzero(keypoints[..., 2] > 0, axis=1)
+        bbox_areas = bboxes[:, 2] * bboxes[:, 3] * 0.53
+        if self.use_area:
+            oks_areas = np.array([ann['area'] for ann in anns],
+                                 dtype=np.float64)
+            rng_areas = np.array([
+                ann['area'] if 'area' in ann or not self.xtcocotools else
+                bbox_areas[i] for i, ann in enumerate(anns)
+            ], dtype=np.float64)
+        else:
+            oks_areas = rng_areas = bbox_areas
+        return dict(
+            ids=np.array([ann['id'] for ann in anns], dtype=np.int64),
+            keypoints=keypoints,
+            bboxes=bboxes,
+            oks_areas=oks_areas,
+            rng_areas=rng_areas.reshape(-1),
+            iscrowd=iscrowd,
+            ignore=iscrowd | (num_vis == 0))
+
+    def _prepare_dt(self, img_id, cat_id):
+        num_kpts = len(self.sigmas)
+        scores, kpts = self.results.get((img_id, cat_id),
+                                        (np.zeros(0), np.zeros((0, num_kpts,
+                                                                3))))
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        kpts = np.asarray(kpts, dtype=np.float64).reshape(-1, num_kpts, 3)
+        if self.xtcocotools:
+            # xtcocotools 忽略所有关键点都不可见的检测
+            keep = np.count_nonzero(kpts[..., 2] > 0, axis=1) > 0
+            scores, kpts = scores[keep], kpts[keep]
+        # 与 COCO.loadRes 相同, 面积为关键点外接框的面积
+        areas = (kpts[..., 0].max(1) - kpts[..., 0].min(1)) * \
+            (kpts[..., 1].max(1) - kpts[..., 1].min(1))
+        return scores, kpts, areas
+
+    def _type_img_ids(self, first=0.2, second=0.8):
+        """按crowdIndex将图像分为easy, medium, hard"""
+        easy, mid, hard = [], [], []
+        for img in self.coco_gt.dataset['images']:
+            if img['crowdIndex'] < first:
+                easy.append(img['id'])
+            elif img['crowdIndex'] < second:
+                mid.append(img['id'])
+            else:
+                hard.append(img['id'])
+        return [sorted(set(ids)) for ids in (easy, mid, hard)]
+
+    def evaluate(self):
+        """对每张图像做匹配, 结果保存在 self.evalImgs 中"""
+        p = self.params
+        p.imgIds = sorted(set(p.imgIds))
+        p.catIds = sorted(set(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        img_ids = list(p.imgIds)
+        if p.iouType == 'keypoints_crowd':
+            extra = set().union(*self._type_img_ids()) - set(img_ids)
+            img_ids += sorted(extra)
+        cfg = dict(
+            sigmas=self.sigmas,
+            iou_thrs=np.asarray(p.iouThrs, dtype=np.float64),
+            area_rngs=[tuple(rng) for rng in p.areaRng],
+            max_det=p.maxDets[-1],
+            zero_id_unmatched=not self.xtcocotools)
+        keys = [(img_id, cat_id) for cat_id in p.catIds for img_id in img_ids]
+        tasks = [(self._prepare_gt(*key), self._prepare_dt(*key))
+                 for key in keys]
+        # 每块内的图像补齐后一起计算, 块的大小限制补齐带来的内存开销
+        chunk_size = max(
+            min(int(np.ceil(len(tasks) / (self.nproc * 4))), 1024), 1)
+        chunks = [(tasks[i:i + chunk_size], cfg)
+                  for i in range(0, len(tasks), chunk_size)]
+        outputs = []
+        if self.nproc <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                outputs.extend(_evaluate_chunk(chunk))
+        else:
+            with Pool(min(self.nproc, len(chunks))) as pool:
+                for chunk_outputs in pool.imap(_evaluate_chunk, chunks):
+                    outputs.extend(chunk_outputs)
+        self.evalImgs = dict(zip(keys, outputs))
+        self._paramsEval = p
+
+    def _accumulate(self, img_ids):
+        p = self.params
+        T = len(p.iouThrs)
+        R = len(p.recThrs)
+        K = len(p.catIds)
+        A = len(p.areaRng)
+        M = len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+        rec_thrs = np.asarray(p.recThrs)
+        for k, cat_id in enumerate(p.catIds):
+            E = [self.evalImgs[img_id, cat_id] for img_id in img_ids]
+            E = [e for e in E if e is not None]
+            if len(E) == 0:
+                continue
+            for a in range(A):
+                E_a = [e[a] for e in E]
+                npig = sum(e[3] for e in E_a)
+                if npig == 0:
+                    continue
+                for m, max_det in enumerate(p.maxDets):
+                    dt_scores = np.concatenate([e[0][:max_det] for e in E_a])
+                    inds = np.argsort(-dt_scores, kind='mergesort')
+                    dt_scores_sorted = dt_scores[inds]
+                    dtm = np.concatenate([e[1][:, :max_det] for e in E_a],
+                                         axis=1)[:, inds]
+                    dt_ig = np.concatenate([e[2][:, :max_det] for e in E_a],
+                                           axis=1)[:, inds]
+                    tps = dtm & ~dt_ig
+                    fps = ~dtm & ~dt_ig
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+                    # 从右往左取最大值, 得到单调递减的precision
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        pis = np.searchsorted(rc[t], rec_thrs, side='left')
+                        valid = pis < nd
+                        q = np.zeros((R, ))
+                        ss = np.zeros((R, ))
+                        q[valid] = pr[t, pis[valid]]
+                        ss[valid] = dt_scores_sorted[pis[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+        return dict(
+            params=p,
+            counts=[T, R, K, A, M],
+            precision=precision,
+            recall=recall,
+            scores=scores)
+
+    def accumulate(self):
+        """累加所有图像的匹配结果, 保存在 self.eval 中"""
+        if not self.evalImgs:
+            print('Please run evaluate() first')
+        self.eval = self._accumulate(self.params.imgIds)
+
+    def _summarize(self, ap=1, iouThr=None, areaRng='all', maxDets=100):
+        p = self.params
+        if self.xtcocotools:
+            iStr = (' {:<18} {} @[ IoU={:<9} | area={:>6s} | '
+                    'maxDets={:>3d} ] = {: 0.3f}')
+        else:
+            iStr = (' {:<18} {} @[ IoU={:<9} | area={:>6s} | '
+                    'maxDets={:>3d} ] = {:0.3f}')
+        titleStr = 'Average Precision' if ap == 1 else 'Average Recall'
+        typeStr = '(AP)' if ap == 1 else '(AR)'
+        iouStr = '{:0.2f}:{:0.2f}'.format(p.iouThrs[0], p.iouThrs[-1]) \
+            if iouThr is None else '{:0.2f}'.format(iouThr)
+        aind = [i for i, aRng in enumerate(p.areaRngLbl) if aRng == areaRng]
+        mind = [i for i, mDet in enumerate(p.maxDets) if mDet == maxDets]
+        if ap == 1:
+            s = self.eval['precision']
+            if iouThr is not None:
+                t = np.where(iouThr == p.iouThrs)[0]
+                s = s[t]
+            s = s[:, :, :, aind, mind]
+        else:
+            s = self.eval['recall']
+            if iouThr is not None:
+                t = np.where(iouThr == p.iouThrs)[0]
+                s = s[t]
+            s = s[:, :, aind, mind]
+        if len(s[s > -1]) == 0:
+            mean_s = -1
+        else:
+            mean_s = np.mean(s[s > -1])
+        print(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets,
+                          mean_s))
+        return mean_s
+
+    def _summarize_kps(self):
+        stats = np.zeros((10, ))
+        stats[0] = self._summarize(1, maxDets=20)
+        stats[1] = self._summarize(1, maxDets=20, iouThr=.5)
+        stats[2] = self._summarize(1, maxDets=20, iouThr=.75)
+        stats[3] = self._summarize(1, maxDets=20, areaRng='medium')
+        stats[4] = self._summarize(1, maxDets=20, areaRng='large')
+        stats[5] = self._summarize(0, maxDets=20)
+        stats[6] = self._summarize(0, maxDets=20, iouThr=.5)
+        stats[7] = self._summarize(0, maxDets=20, iouThr=.75)
+        stats[8] = self._summarize(0, maxDets=20, areaRng='medium')
+        stats[9] = self._summarize(0, maxDets=20, areaRng='large')
+        return stats
+
+    def _summarize_kps_crowd(self):
+        stats = np.zeros((9, ))
+        stats[0] = self._summarize(1, maxDets=20)
+        stats[1] = self._summarize(1, maxDets=20, iouThr=.5)
+        stats[2] = self._summarize(1, maxDets=20, iouThr=.75)
+        stats[3] = self._summarize(0, maxDets=20)
+        stats[4] = self._summarize(0, maxDets=20, iouThr=.5)
+        stats[5] = self._summarize(0, maxDets=20, iouThr=.75)
+        # 与xtcocotools相同, -1也参与平均
+        type_result = [
+            round(np.mean(self._accumulate(ids)['precision'][:, :, :, 0, :]),
+                  4) for ids in self._type_img_ids(first=0.2, second=0.8)
+        ]
+        p = self.params
+        iStr = (' {:<18} {} @[ IoU={:<9} | type={:>6s} | '
+                'maxDets={:>3d} ] = {:0.3f}')
+        iouStr = '{:0.2f}:{:0.2f}'.format(p.iouThrs[0], p.iouThrs[-1])
+        for name, value in zip(('easy', 'medium', 'hard'), type_result):
+            print(iStr.format('Average Precision', '(AP)', iouStr, name, 20,
+                              value))
+        stats[6:9] = type_result
+        return stats
+
+    def summarize(self):
+        if not self.eval:
+            raise Exception('Please run accumulate() first')
+        if self.params.iouType == 'keypoints_crowd':
+            self.stats = self._summarize_kps_crowd()
+        else:
+            self.stats = self._summarize_kps()
@@ -0,0 +1,290 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# MuPoTS-3D 评测
+#   直接根据 JointDataset.evaluate 生成的 3d_pairs 计算 PCK3D / AUC / MPJPE,
+#   替代原先 pose3d.mat -> MATLAB 脚本的流程。
+#   所有人与关节一次性向量化计算, 统计量可以累加与合并, 便于按序列并行或分布式规约。
+import re
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from mmcv.runner import get_dist_info
+
+MUPOTS_JOINT_NAMES = ('neck', 'head', 'pelvis', 'l_shoulder', 'l_elbow',
+                      'l_wrist', 'l_hip', 'l_knee', 'l_ankle', 'r_shoulder',
+                      'r_elbow', 'r_wrist', 'r_hip', 'r_knee', 'r_ankle')
+MUPOTS_ROOT_IDX = 2
+MUPOTS_NUM_SEQS = 20
+# 与MuPoTS官方脚本一致, 单位mm
+MUPOTS_PCK_THR = 150.
+MUPOTS_AUC_THRS = np.arange(0., 151., 5.)
+
+_SEQ_PATTERN = re.compile(r'TS(\d+)')
+
+
+def get_mupots_seq_id(img_path):
+    """根据图像路径中的'TS<k>'得到序列编号(从0开始)"""
+    match = _SEQ_PATTERN.search(img_path)
+    assert match is not None, f'can not find sequence name in {img_path}'
+    return int(match.group(1)) - 1
+
+
+class MuPoTSStats:
+    """MuPoTS-3D 评测的充分统计量。
+
+    对每个序列、每个关节记录有效关节数、误差之和以及各阈值下的命中数,
+    root-relative 与 absolute 两种设定分别统计。统计量可以直接相加,
+    因此可以按图像流式累加, 也可以在进程之间合并。
+
+    Args:
+        num_seqs (int): 序列个数。Default: 20.
+        thrs (np.ndarray): PCK阈值(mm), AUC为各阈值下PCK的平均值。
+            Default: 0, 5, ..., 150.
+        pck_thr (float): 报告的PCK阈值(mm), 需要包含在thrs中。Default: 150.
+        unit (float): 3d_pairs中的坐标换算到mm的比例, 坐标单位为cm。
+            Default: 10.
+        exclude_root (bool): root-relative指标是否去掉根节点(对齐后误差恒为0)。
+            Default: True.
+    """
+
+    def __init__(self,
+                 num_seqs=MUPOTS_NUM_SEQS,
+                 thrs=MUPOTS_AUC_THRS,
+                 pck_thr=MUPOTS_PCK_THR,
+                 unit=10.,
+                 exclude_root=True):
+        self.num_seqs = num_seqs
+        self.thrs = np.asarray(thrs, dtype=np.float64)
+        self.pck_idx = int(np.flatnonzero(np.isclose(self.thrs, pck_thr))[0])
+        self.unit = unit
+        self.exclude_root = exclude_root
+        num_joints = len(MUPOTS_JOINT_NAMES)
+        # 0: root-relative, 1: absolute
+        self.counts = np.zeros((2, num_seqs, num_joints), np.int64)
+        self.err_sums = np.zeros((2, num_seqs, num_joints), np.float64)
+        self.hits = np.zeros((2, num_seqs, len(self.thrs), num_joints),
+                             np.int64)
+
+    def update(self, pred_3d, gt_3d, seq_id, valid=None):
+        """累加一组(同一序列)已匹配的人。
+
+        Args:
+            pred_3d (np.ndarray): [num_gts, 15, >=3], 预测的 X, Y, Z。
+            gt_3d (np.ndarray): [num_gts, >=15, >=3], gt的 X, Y, Z。
+            seq_id (int): 序列编号。
+            valid (np.ndarray, optional): [num_gts, 15], 参与评测的关节。
+                Default: None, 所有关节都参与。
+        """
+        num_joints = len(MUPOTS_JOINT_NAMES)
+        pred = np.asarray(pred_3d, np.float64).reshape(
+            -1, num_joints, np.shape(pred_3d)[-1])[..., :3] * self.unit
+        gt = np.asarray(gt_3d, np.float64)
+        gt = gt.reshape(-1, gt.shape[-2], gt.shape[-1])[
+            :, :num_joints, :3] * self.unit
+        if len(pred) == 0:
+            return
+        if valid is None:
+            valid = np.ones(pred.shape[:2], dtype=bool)
+        valid = np.asarray(valid, dtype=bool).reshape(pred.shape[:2])
+
+        root = MUPOTS_ROOT_IDX
+        err_abs = np.linalg.norm(pred - gt, axis=-1)
+        err_rel = np.linalg.norm(
+            (pred - pred[:, root:root + 1]) - (gt - gt[:, root:root + 1]),
+            axis=-1)
+        valid_rel = valid & valid[:, root:root + 1]
+        if self.exclude_root:
+            valid_rel = valid_rel.copy()
+            valid_rel[:, root] = False
+
+        for k, (err, mask) in enumerate(
+                ((err_rel, valid_rel), (err_abs, valid))):
+            err = np.where(mask, err, 0.)
+            self.counts[k, seq_id] += mask.sum(0)
+            self.err_sums[k, seq_id] += err.sum(0)
+            # [num_gts, num_thrs, 15]
+            hit = (err[:, None] <= self.thrs[None, :, None]) & mask[:, None]
+            self.hits[k, seq_id] += hit.sum(0)
+
+    def update_pairs(self, pairs, vis_only=False):
+        """累加 JointDataset.evaluate 生成的 3d_pairs"""
+        for pair in pairs:
+            gt_2d = np.asarray(pair['gt_2d'], np.float64)
+            valid = gt_2d[:, :len(MUPOTS_JOINT_NAMES), 3] > 0 \
+                if vis_only else None
+            self.update(pair['pred_3d'], pair['gt_3d'],
+                        get_mupots_seq_id(pair['image_path']), valid)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.err_sums += other.err_sums
+        self.hits += other.hits
+        return self
+
+    def to_array(self):
+        """展平为一个float64数组, 便于all_reduce"""
+        return np.concatenate([
+            self.counts.ravel().astype(np.float64), self.err_sums.ravel(),
+            self.hits.ravel().astype(np.float64)
+        ])
+
+    def from_array(self, array):
+        array = np.asarray(array, np.float64)
+        sizes = np.cumsum([self.counts.size, self.err_sums.size])
+        counts, err_sums, hits = np.split(array, sizes)
+        self.counts = np.rint(counts).astype(np.int64).reshape(
+            self.counts.shape)
+        self.err_sums = err_sums.reshape(self.err_sums.shape)
+        self.hits = np.rint(hits).astype(np.int64).reshape(self.hits.shape)
+        return self
+
+    @staticmethod
+    def _safe_div(a, b):
+        return np.where(b > 0, a / np.maximum(b, 1), np.nan)
+
+    def _metrics(self, counts, err_sums, hits):
+        """counts: [...], hits: [..., num_thrs]"""
+        pcks = self._safe_div(hits, counts[..., None]) * 100
+        return (pcks[..., self.pck_idx], pcks.mean(-1),
+                self._safe_div(err_sums, counts))
+
+    def summary(self, per_sequence=True, per_joint=True):
+        """计算最终指标。
+
+        与官方脚本一致, 整体的PCK/AUC/MPJPE为各序列结果的平均值,
+        另外给出所有关节直接平均的结果(`*_all`)。
+
+        Returns:
+            OrderedDict: 指标名 -> float, PCK与AUC为百分比, MPJPE单位为mm。
+        """
+        eval_results = OrderedDict()
+        seq_valid = self.counts.sum(-1) > 0  # [2, num_seqs]
+        for k, name in enumerate(('rel', 'abs')):
+            counts = self.counts[k]
+            err_sums = self.err_sums[k]
+            hits = self.hits[k].transpose(0, 2, 1)  # [num_seqs, 15, thrs]
+            seq_pck, seq_auc, seq_mpjpe = self._metrics(
+                counts.sum(-1), err_sums.sum(-1), hits.sum(1))
+            valid = seq_valid[k]
+            if valid.any():
+                eval_results[f'pck_{name}'] = float(seq_pck[valid].mean())
+                eval_results[f'auc_{name}'] = float(seq_auc[valid].mean())
+                eval_results[f'mpjpe_{name}'] = float(seq_mpjpe[valid].mean())
+            else:
+                eval_results[f'pck_{name}'] = float('nan')
+                eval_results[f'auc_{name}'] = float('nan')
+                eval_results[f'mpjpe_{name}'] = float('nan')
+            pck, auc, mpjpe = self._metrics(
+                counts.sum(), err_sums.sum(), hits.sum((0, 1)))
+            eval_results[f'pck_{name}_all'] = float(pck)
+            eval_results[f'auc_{name}_all'] = float(auc)
+            eval_results[f'mpjpe_{name}_all'] = float(mpjpe)
+
+            if per_sequence:
+                for i in np.flatnonzero(valid):
+                    eval_results[f'TS{i + 1}_pck_{name}'] = float(seq_pck[i])
+                    eval_results[f'TS{i + 1}_mpjpe_{name}'] = \
+                        float(seq_mpjpe[i])
+            if per_joint:
+                joint_pck, _, joint_mpjpe = self._metrics(
+                    counts.sum(0), err_sums.sum(0), hits.sum(0))
+                for j, joint in enumerate(MUPOTS_JOINT_NAMES):
+                    if counts[:, j].sum() == 0:
+                        continue
+                    eval_results[f'{joint}_pck_{name}'] = float(joint_pck[j])
+                    eval_results[f'{joint}_mpjpe_{name}'] = \
+                        float(joint_mpjpe[j])
+        return eval_results
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(num_seqs={self.num_seqs}, '
+                f'num_joints={int(self.counts[1].sum())})')
+
+
+class MuPoTSEvaluator:
+    """流式的MuPoTS-3D评测器。
+
+    每得到一张图像的输出就与gt匹配并累加到 MuPoTSStats 中, 不再保存网络的
+    全部输出。分布式测试时各个rank分别累加, 最后只对统计量做一次all_reduce。
+
+    Args:
+        dataset (JointDataset): 测试集, 需要提供 data_infos 与 _match_single。
+        vis_only (bool): 只评测gt_2d中可见的关节。Default: False.
+        writer (Pose3DResultWriter, optional): 给定时同时逐张图像写入匹配
+            后的结果, 在 all_reduce 时关闭。Default: None.
+        stats_kwargs: 传给 MuPoTSStats 的参数。
+    """
+
+    def __init__(self, dataset, vis_only=False, writer=None, **stats_kwargs):
+        self.dataset = dataset
+        self.vis_only = vis_only
+        self.writer = writer
+        self.stats = MuPoTSStats(**stats_kwargs)
+        self.num_samples = 0
+
+    def process(self, idx, result):
+        """累加数据集中第idx张图像的输出"""
+        pair = self.dataset._match_single(self.dataset.data_infos[idx],
+                                          result)
+        self.num_samples += 1
+        if pair is not None:
+            self.stats.update_pairs([pair], vis_only=self.vis_only)
+            if self.writer is not None:
+                self.writer.add(pair)
+
+    def all_reduce(self):
+        """将所有rank的统计量求和, 每个rank都得到完整的结果"""
+        # 推理已经结束, 结果文件不再写入
+        if self.writer is not None:
+            self.writer.close()
+        _, world_size = get_dist_info()
+        if world_size == 1:
+            return self
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        array = np.append(self.stats.to_array(), self.num_samples)
+        tensor = torch.from_numpy(array).to(device)
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        array = tensor.cpu().numpy()
+        self.stats.from_array(array[:-1])
+        self.num_samples = int(round(array[-1]))
+        return self
+
+    def evaluate(self, **kwargs):
+        return self.stats.summary(**kwargs)
+
+
+def _eval_sequence(args):
+    pairs, vis_only, stats_kwargs = args
+    stats = MuPoTSStats(**stats_kwargs)
+    stats.update_pairs(pairs, vis_only=vis_only)
+    return stats
+
+
+def evaluate_mupots(pairs, nproc=1, vis_only=False, **stats_kwargs):
+    """计算MuPoTS-3D指标。
+
+    Args:
+        pairs (list[dict]): JointDataset.evaluate 生成的 3d_pairs。
+        nproc (int): 进程数, 大于1时每个序列分别在子进程中计算。Default: 1.
+        vis_only (bool): 只评测gt_2d中可见的关节。Default: False.
+        stats_kwargs: 传给 MuPoTSStats 的参数。
+    Returns:
+        MuPoTSStats: 调用summary()得到最终指标。
+    """
+    if nproc <= 1:
+        stats = MuPoTSStats(**stats_kwargs)
+        stats.update_pairs(pairs, vis_only=vis_only)
+        return stats
+
+    seq_pairs = OrderedDict()
+    for pair in pairs:
+        seq_pairs.setdefault(
+            get_mupots_seq_id(pair['image_path']), []).append(pair)
+    tasks = [(p, vis_only, stats_kwargs) for p in seq_pairs.values()]
+    stats = MuPoTSStats(**stats_kwargs)
+    with Pool(min(nproc, max(len(tasks), 1))) as pool:
+        for seq_stats in pool.imap_unordered(_eval_sequence, tasks):
+            stats.merge(seq_stats)
+    return stats
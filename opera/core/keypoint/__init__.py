@@ -1,11 +1,16 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
 from .transforms import (distance2keypoint, transpose_and_gather_feat,
                          gaussian_radius, draw_umich_gaussian,
-                         draw_short_range_offset, bbox_kpt2result,
-                         bbox_kpt2result_3d, kpt_mapping_back)
+                         draw_umich_gaussians, draw_short_range_offset,
+                         bbox_kpt2result,
+                         bbox_kpt2result_3d, bbox_kpt2result_3d_compact,
+                         compact_result2arrays, get_compact_result_dtype,
+                         is_compact_result, kpt_mapping_back)
 
 __all__ = [
     'distance2keypoint', 'transpose_and_gather_feat', 'gaussian_radius',
-    'draw_umich_gaussian', 'draw_short_range_offset', 'bbox_kpt2result',
-    'kpt_mapping_back'
+    'draw_umich_gaussian', 'draw_umich_gaussians', 'draw_short_range_offset',
+    'bbox_kpt2result',
+    'kpt_mapping_back', 'bbox_kpt2result_3d_compact', 'compact_result2arrays',
+    'get_compact_result_dtype', 'is_compact_result'
 ]
@@ -58,7 +58,8 @@ def gaussian_radius(det_size, min_overlap=0.7):
     c3 = (min_overlap - 1) * width * height
     sq3 = torch.sqrt(b3 ** 2 - 4 * a3 * c3)
     r3 = (b3 + sq3) / 2
-    return min(r1, r2, r3)
+    # 逐元素取最小值, 支持批量的det_size, 且不需要在host上比较
+    return torch.min(torch.stack([r1, r2, r3]), dim=0)[0]
 
 
 def gaussian2D(shape, sigma=1):
@@ -95,6 +96,37 @@ def draw_umich_gaussian(heatmap, center, radius, k=1):
     return heatmap
 
 
+def draw_umich_gaussians(heatmap, centers, radius, valid=None, k=1):
+    """批量版本的 draw_umich_gaussian, 结果与逐点调用一致。
+
+    所有实例的高斯分布在整张heatmap上一次性计算, 不需要将坐标同步到host。
+
+    Args:
+        heatmap (Tensor): [K, H, W], 原地更新。
+        centers (Tensor): 取整后的关键点坐标 (x, y), [G, K, 2]。
+        radius (Tensor): 每个实例的高斯半径, [G]。
+        valid (Tensor, optional): 需要绘制的关键点, [G, K]。
+    """
+    if centers.size(0) == 0:
+        return heatmap
+    height, width = heatmap.shape[1:]
+    xs = torch.arange(width, dtype=torch.float32, device=heatmap.device)
+    ys = torch.arange(height, dtype=torch.float32, device=heatmap.device)
+    x = (xs - centers[..., 0:1].float())[:, :, None, :]  # [G, K, 1, W]
+    y = (ys - centers[..., 1:2].float())[:, :, :, None]  # [G, K, H, 1]
+    radius = radius.float()[:, None, None, None]
+    sigma = (2 * radius + 1) / 6
+    gaussian = torch.exp(-(x * x + y * y) / (2 * sigma * sigma))
+    # 与gaussian2D一致, 高斯分布的最大值为1
+    inside = (x.abs() <= radius) & (y.abs() <= radius) & \
+        (gaussian >= float(np.finfo(np.float32).eps))
+    if valid is not None:
+        inside = inside & valid[:, :, None, None]
+    gaussian = torch.where(inside, gaussian * k, gaussian.new_zeros(()))
+    heatmap.copy_(torch.max(heatmap, gaussian.max(dim=0)[0]))
+    return heatmap
+
+
 def draw_short_range_offset(offset_map, mask_map, gt_kp, radius):
     gt_kp_int = torch.floor(gt_kp)
     x_coord = gt_kp[0] - \
@@ -184,6 +216,92 @@ def bbox_kpt2result_3d(bboxes, labels, kpts, depths, scale_factor, num_classes):
             [depths[labels == i, :] for i in range(num_classes)], \
             [scale_factor]
 
+def get_compact_result_dtype(num_kpts=15, num_depths=16, float16=True):
+    """Structured dtype of the compact 3D result of one detection.
+
+    Coordinates (bbox, kpt) can be stored in float16, scores and depths are
+    kept in float32 since depths are multiplied by the focal length in
+    evaluation. The image-level scale_factor is stored in every row so that
+    the whole result of an image is a single array.
+    """
+    coord = np.float16 if float16 else np.float32
+    return np.dtype([('bbox', coord, (4, )), ('score', np.float32),
+                     ('label', np.int16), ('kpt', coord, (num_kpts, 2)),
+                     ('depth', np.float32, (num_depths, )),
+                     ('scale_factor', np.float32, (4, ))])
+
+
+def bbox_kpt2result_3d_compact(bboxes,
+                               labels,
+                               kpts,
+                               depths,
+                               scale_factor,
+                               score_thr=0.05,
+                               min_k=20,
+                               float16=True):
+    """Convert detection results to a compact structured array.
+
+    Detections with score lower than ``score_thr`` are dropped, but the
+    ``min_k`` highest-scoring ones are always kept. ``min_k`` should be no
+    less than the max number of people in an image, otherwise evaluation
+    has to match gts to zero-padded predictions.
+
+    Args:
+        bboxes (torch.Tensor | np.ndarray): shape (n, 5).
+        labels (torch.Tensor | np.ndarray): shape (n, ).
+        kpts (torch.Tensor | np.ndarray): shape (n, K, 2).
+        depths (torch.Tensor | np.ndarray): shape (n, 16).
+        scale_factor (np.ndarray): shape (4, ).
+        score_thr (float): Score threshold. Default: 0.05.
+        min_k (int): Minimum number of detections to keep. Default: 20.
+        float16 (bool): Store coordinates in float16. Default: True.
+
+    Returns:
+        np.ndarray: Structured array sorted by score in descending order,
+            see :func:`get_compact_result_dtype`.
+    """
+    if isinstance(bboxes, torch.Tensor):
+        bboxes = bboxes.detach().cpu().numpy()
+        labels = labels.detach().cpu().numpy()
+        kpts = kpts.detach().cpu().numpy()
+        depths = depths.detach().cpu().numpy()
+    scores = bboxes[:, 4]
+    order = np.argsort(-scores, kind='stable')
+    num_keep = max(int((scores >= score_thr).sum()), min(min_k, len(order)))
+    keep = order[:num_keep]
+    result = np.zeros(
+        num_keep,
+        dtype=get_compact_result_dtype(kpts.shape[1], depths.shape[1],
+                                       float16))
+    result['bbox'] = bboxes[keep, :4]
+    result['score'] = scores[keep]
+    result['label'] = labels[keep]
+    result['kpt'] = kpts[keep, :, :2]
+    result['depth'] = depths[keep]
+    result['scale_factor'] = np.asarray(scale_factor, dtype=np.float32)
+    return result
+
+
+def is_compact_result(result):
+    return isinstance(result, np.ndarray) and result.dtype.names is not None
+
+
+def compact_result2arrays(result):
+    """Convert a compact result back to float32 arrays.
+
+    Returns:
+        tuple: bboxes (n, 5), labels (n, ), kpts (n, K, 2), depths (n, 16)
+            and scale_factor (4, ). scale_factor is None if no detection
+            is kept.
+    """
+    bboxes = np.concatenate(
+        [result['bbox'].astype(np.float32), result['score'][:, None]], -1)
+    scale_factor = result['scale_factor'][0] if len(result) else None
+    return (bboxes, result['label'].astype(np.int64),
+            result['kpt'].astype(np.float32),
+            result['depth'].astype(np.float32), scale_factor)
+
+
 def kpt_flip(kpts, img_shape, flip_pairs, direction):
     """Flip keypoints horizontally.
 
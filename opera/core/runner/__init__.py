@@ -1 +1,13 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
+from .async_checkpoint import (AsyncCheckpointHook, load_checkpoint_mmap,
+                               load_frozen_params)
+from .pipeline_profiler import PipelineProfilerHook
+from .retry_hook import DatasetRetryHook
+from .stage_profiler import StageProfiler, StageProfilerHook, profile_stage
+from .zero_hook import ZeroOptimizerHook
+
+__all__ = [
+    'DatasetRetryHook', 'ZeroOptimizerHook', 'StageProfiler',
+    'StageProfilerHook', 'profile_stage', 'PipelineProfilerHook',
+    'AsyncCheckpointHook', 'load_checkpoint_mmap', 'load_frozen_params'
+]
@@ -0,0 +1,254 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 后台写入checkpoint
+#   checkpoint_config = dict(
+#       type='AsyncCheckpointHook', interval=1, max_keep_ckpts=20,
+#       trainable_only=True)
+import os
+import os.path as osp
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import mmcv
+import torch
+from mmcv.parallel import is_module_wrapper
+from mmcv.runner import (HOOKS, CheckpointHook, get_state_dict,
+                         load_checkpoint, load_state_dict)
+from mmcv.runner.dist_utils import master_only
+from mmcv.utils import digit_version
+
+# trainable_only时冻结的参数只在out_dir中保存一次。不以.pth结尾,
+# auto_resume的find_latest_checkpoint会解析所有*.pth文件名中的epoch
+FROZEN_PARAMS = 'frozen_params.pth.frozen'
+
+
+def _to_cpu(obj):
+    """递归地将tensor拷贝到CPU, 之后的训练不会修改快照"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # load_state_dict根据_metadata中的版本兼容旧的BN等参数
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _torch_load(filename):
+    """torch>=2.1时使用mmap, 只读取实际用到的tensor, 例如推理时跳过
+    optimizer的状态"""
+    if digit_version(torch.__version__) >= digit_version('2.1.0'):
+        try:
+            return torch.load(filename, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # torch 1.6之前的旧格式不支持mmap
+            pass
+    return torch.load(filename, map_location='cpu')
+
+
+def _load_frozen_params(checkpoint, filename):
+    meta = checkpoint.get('meta', {}) if isinstance(checkpoint, dict) else {}
+    if not meta.get('trainable_only', False):
+        return OrderedDict()
+    return _torch_load(osp.join(osp.dirname(filename), meta['frozen_params']))
+
+
+def load_frozen_params(model, filename):
+    """AsyncCheckpointHook(trainable_only=True)保存的checkpoint不包含冻结的
+    参数, 在runner.resume或runner.load_checkpoint之前从同一目录补充。
+
+    只检查同一目录中是否有冻结参数的文件, 不读取checkpoint本身(torch<2.1时
+    读取meta需要加载整个checkpoint)。完整的checkpoint随后加载时会覆盖这些
+    参数, 因此对其它checkpoint没有影响。
+    """
+    frozen_path = osp.join(osp.dirname(filename), FROZEN_PARAMS)
+    if not osp.isfile(frozen_path):
+        return
+    frozen = _torch_load(frozen_path)
+    if frozen:
+        model = model.module if is_module_wrapper(model) else model
+        model.load_state_dict(frozen, strict=False)
+
+
+def load_checkpoint_mmap(model, filename, logger=None):
+    """与 ``load_checkpoint(model, filename, map_location='cpu')`` 相同,
+    本地文件使用mmap读取, 并支持trainable_only的checkpoint。
+
+    Returns:
+        dict: checkpoint, 其中的tensor可能为mmap的只读视图。
+    """
+    if not osp.isfile(filename):
+        return load_checkpoint(
+            model, filename, map_location='cpu', logger=logger)
+    checkpoint = _torch_load(filename)
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    state_dict = OrderedDict(
+        (k[7:] if k.startswith('module.') else k, v)
+        for k, v in (*_load_frozen_params(checkpoint, filename).items(),
+                     *state_dict.items()))
+    load_state_dict(model, state_dict, strict=False, logger=logger)
+    return checkpoint
+
+
+@HOOKS.register_module()
+class AsyncCheckpointHook(CheckpointHook):
+    """在后台线程中写入checkpoint的CheckpointHook。
+
+    保存时rank 0只需要将模型与optimizer的状态拷贝到内存, 序列化与写入由
+    后台线程完成, 其它rank不再等待写文件。文件先写入 ``*.tmp`` 再重命名,
+    中断时不会留下不完整的checkpoint; latest.pth的更新与旧checkpoint的删除
+    也在写入完成之后进行。同时最多有 ``queue_size`` 个快照等待写入,
+    超过时训练等待前一个写完。
+
+    文件为torch默认的zipfile格式, torch>=2.1时 :func:`load_checkpoint_mmap`
+    (init_detector使用)通过mmap读取, 推理时不会读取optimizer的状态。
+
+    使用ZeroRedundancyOptimizer时与CheckpointHook一样由ZeroOptimizerHook
+    在保存之前汇总状态。只支持本地目录, 其它存储后端与CheckpointHook相同。
+
+    Args:
+        trainable_only (bool): 只保存requires_grad的参数(以及所有buffer)和
+            optimizer状态, 冻结的参数(frozen_stages, freeze_feat)在第一次保存
+            时写入out_dir中的frozen_params.pth.frozen。加载时需要使用
+            :func:`load_checkpoint_mmap` 或先调用 :func:`load_frozen_params`,
+            tools/train.py与init_detector已经处理。Default: False.
+        queue_size (int): 等待写入的快照个数上限。Default: 1.
+        **kwargs: 与CheckpointHook相同。
+    """
+
+    def __init__(self, *args, trainable_only=False, queue_size=1, **kwargs):
+        super(AsyncCheckpointHook, self).__init__(*args, **kwargs)
+        self.trainable_only = trainable_only
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._frozen_saved = False
+
+    @master_only
+    def _save_checkpoint(self, runner):
+        if self.file_client.name != 'HardDiskBackend':
+            return super(AsyncCheckpointHook, self)._save_checkpoint(runner)
+
+        if self.by_epoch:
+            name, current = 'epoch_{}.pth', runner.epoch + 1
+        else:
+            name, current = 'iter_{}.pth', runner.iter + 1
+        filename_tmpl = self.args.get('filename_tmpl', name)
+        filepath = osp.join(self.out_dir, filename_tmpl.format(current))
+        checkpoint, frozen = self._snapshot(runner)
+
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._worker, args=(runner, ), daemon=True)
+            self._thread.start()
+        start = time.perf_counter()
+        self._queue.put((filepath, checkpoint, frozen,
+                         self._get_redundant_ckpts(filename_tmpl, current)))
+        wait = time.perf_counter() - start
+        if wait > 1:
+            runner.logger.info(
+                f'waited {wait:.1f}s for the previous checkpoint to be '
+                f'written before saving {filepath}')
+
+        if runner.meta is not None:
+            runner.meta.setdefault('hook_msgs', dict())
+            runner.meta['hook_msgs']['last_ckpt'] = filepath
+
+    def _snapshot(self, runner):
+        """与runner.save_checkpoint相同的内容, tensor拷贝到CPU"""
+        model = runner.model.module if is_module_wrapper(runner.model) \
+            else runner.model
+        meta = dict(self.args.get('meta', None) or {})
+        if runner.meta is not None:
+            meta.update(runner.meta)
+        meta.update(
+            epoch=runner.epoch + 1,
+            iter=runner.iter if self.by_epoch else runner.iter + 1,
+            mmcv_version=mmcv.__version__,
+            time=time.asctime())
+        if getattr(model, 'CLASSES', None) is not None:
+            meta.update(CLASSES=model.CLASSES)
+
+        state_dict = get_state_dict(model)
+        frozen = None
+        frozen_names = {
+            name
+            for name, param in model.named_parameters()
+            if not param.requires_grad
+        } if self.trainable_only else None
+        if frozen_names:
+            if not self._frozen_saved:
+                frozen = _to_cpu(
+                    OrderedDict((k, v) for k, v in state_dict.items()
+                                if k in frozen_names))
+                self._frozen_saved = True
+            state_dict = OrderedDict(
+                (k, v) for k, v in state_dict.items()
+                if k not in frozen_names)
+            meta.update(trainable_only=True, frozen_params=FROZEN_PARAMS)
+        checkpoint = dict(meta=meta, state_dict=_to_cpu(state_dict))
+
+        if self.save_optimizer and runner.optimizer is not None:
+            if isinstance(runner.optimizer, dict):
+                checkpoint['optimizer'] = {
+                    name: _to_cpu(optim.state_dict())
+                    for name, optim in runner.optimizer.items()
+                }
+            else:
+                checkpoint['optimizer'] = _to_cpu(
+                    runner.optimizer.state_dict())
+        return checkpoint, frozen
+
+    def _get_redundant_ckpts(self, filename_tmpl, current):
+        """与CheckpointHook相同, 需要删除的旧checkpoint, 写入完成后删除"""
+        if self.max_keep_ckpts <= 0:
+            return []
+        return [
+            osp.join(self.out_dir, filename_tmpl.format(step))
+            for step in range(current - self.max_keep_ckpts * self.interval,
+                              0, -self.interval)
+        ]
+
+    @staticmethod
+    def _write(checkpoint, filepath):
+        tmp_path = filepath + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+
+    def _worker(self, runner):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            filepath, checkpoint, frozen, redundant_ckpts = item
+            try:
+                if frozen is not None:
+                    self._write(frozen, osp.join(self.out_dir, FROZEN_PARAMS))
+                self._write(checkpoint, filepath)
+                if self.args.get('create_symlink', True):
+                    link = osp.join(self.out_dir, 'latest.pth')
+                    tmp_link = link + '.tmp'
+                    if osp.lexists(tmp_link):
+                        os.remove(tmp_link)
+                    os.symlink(osp.basename(filepath), tmp_link)
+                    os.replace(tmp_link, link)
+                for ckpt_path in redundant_ckpts:
+                    if not osp.isfile(ckpt_path):
+                        break
+                    os.remove(ckpt_path)
+            except Exception as e:
+                runner.logger.error(
+                    f'failed to write checkpoint {filepath}: {e!r}')
+
+    def after_run(self, runner):
+        """等待剩余的checkpoint写入完成"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
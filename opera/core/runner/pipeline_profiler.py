@@ -0,0 +1,110 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 判断训练是否受限于数据加载, 以及pipeline中哪个transform最耗时
+#   data = dict(train=dict(..., profile_pipeline=True))
+#   custom_hooks = [dict(type='PipelineProfilerHook', interval=50)]
+import time
+from collections import OrderedDict
+
+import numpy as np
+from mmcv.runner import HOOKS, Hook
+
+from .retry_hook import _get_datasets
+
+
+def _has_instrumented_pipeline(dataset):
+    return hasattr(getattr(dataset, 'pipeline', None), 'collect')
+
+
+@HOOKS.register_module()
+class PipelineProfilerHook(Hook):
+    """定期报告每个iteration等待数据与计算的时间, 以及pipeline各阶段的耗时。
+
+    等待数据的时间为上一个iteration结束到这个iteration开始之间的时间,
+    与IterTimerHook的data_time相同; 计算时间包括前向、反向与优化器更新。
+    各阶段的统计来自数据集的InstrumentedCompose (``profile_pipeline=True``),
+    由dataloader的worker写入共享内存, 这里只负责读取和汇总, 不会同步CUDA,
+    可以在正式训练中一直开启。
+
+    Args:
+        interval (int): 输出统计的间隔 (iteration)。Default: 50.
+    """
+
+    def __init__(self, interval=50):
+        self.interval = interval
+        self._data_start = None
+        self._iter_start = None
+        self._wait = []
+        self._compute = []
+
+    def before_train_epoch(self, runner):
+        self._data_start = time.perf_counter()
+
+    def before_train_iter(self, runner):
+        now = time.perf_counter()
+        if self._data_start is not None:
+            self._wait.append(now - self._data_start)
+        self._iter_start = now
+
+    def after_train_iter(self, runner):
+        now = time.perf_counter()
+        self._compute.append(now - self._iter_start)
+        if self.every_n_iters(runner, self.interval):
+            runner.logger.info(self._report(runner))
+            self._wait, self._compute = [], []
+        self._data_start = time.perf_counter()
+
+    def _report(self, runner):
+        wait = np.mean(self._wait) * 1000 if self._wait else 0.
+        compute = np.mean(self._compute) * 1000
+        lines = [
+            f'Data pipeline of the last {len(self._compute)} iters: '
+            f'data wait {wait:.1f} ms, compute {compute:.1f} ms per iter '
+            f'({wait / max(wait + compute, 1e-6):.1%} waiting for data)'
+        ]
+        stages, num_samples, num_lost = self._collect_stages(runner)
+        if num_samples > 0:
+            lines.append(self._format_stages(stages))
+            lines.append(f'{num_samples} samples from the workers' + (
+                f', {num_lost} samples overwritten before being read, '
+                f'increase the capacity of InstrumentedCompose'
+                if num_lost else ''))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _collect_stages(runner):
+        """合并各数据集中同名阶段的记录, 返回 {name: [耗时ms, 输出字节数]}"""
+        stages = OrderedDict()
+        num_samples = num_lost = 0
+        for dataset in _get_datasets(runner.data_loader.dataset,
+                                     _has_instrumented_pipeline):
+            pipeline = dataset.pipeline
+            records, lost = pipeline.collect()
+            num_samples += len(records)
+            num_lost += lost
+            for i, name in enumerate(pipeline.stage_names):
+                record = records[:, i]
+                stages.setdefault(name, []).append(record[record[:, 0] >= 0])
+        stages = OrderedDict((name, np.concatenate(records))
+                             for name, records in stages.items())
+        return stages, num_samples, num_lost
+
+    @staticmethod
+    def _format_stages(stages):
+        # 嵌套的阶段 (AutoAugment/p0.AugResize) 同时计入外层阶段, 不参与总和
+        total = sum(records[:, 0].sum() for name, records in stages.items()
+                    if '/' not in name)
+        width = max(len(name) for name in stages) + 2
+        lines = [
+            f'{"stage":<{width}}{"count":>8}{"mean(ms)":>11}{"p90(ms)":>11}'
+            f'{"share":>9}{"out(MB)":>10}'
+        ]
+        for name, records in stages.items():
+            if len(records) == 0:
+                continue
+            times = records[:, 0]
+            lines.append(
+                f'{name:<{width}}{len(times):>8}{times.mean():>11.2f}'
+                f'{np.percentile(times, 90):>11.2f}'
+                f'{times.sum() / max(total, 1e-6):>9.1%}'
+                f'{records[:, 1].mean() / 1024**2:>10.2f}')
+        return '\n'.join(lines)
@@ -0,0 +1,41 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+from mmcv.runner import HOOKS, Hook
+
+
+def _has_retry_counts(dataset):
+    return hasattr(dataset, 'get_retry_counts')
+
+
+def _get_datasets(dataset, predicate=_has_retry_counts):
+    """展开ConcatDataset/RepeatDataset等包装, 返回所有满足predicate的数据集,
+    默认返回带retry计数的数据集"""
+    if hasattr(dataset, 'datasets'):
+        datasets = []
+        for d in dataset.datasets:
+            datasets.extend(_get_datasets(d, predicate))
+        return datasets
+    if hasattr(dataset, 'dataset'):
+        return _get_datasets(dataset.dataset, predicate)
+    return [dataset] if predicate(dataset) else []
+
+
+@HOOKS.register_module()
+class DatasetRetryHook(Hook):
+    """在每个epoch结束时报告JointDataset.__getitem__中的重试次数。
+
+    重试意味着整条解码+数据增强的pipeline被浪费,
+    该比例可以用来检查有效样本索引以及裁剪预检查是否生效。
+    """
+
+    def before_train_epoch(self, runner):
+        for dataset in _get_datasets(runner.data_loader.dataset):
+            dataset.reset_retry_counts()
+
+    def after_train_epoch(self, runner):
+        for dataset in _get_datasets(runner.data_loader.dataset):
+            num_samples, num_retries = dataset.get_retry_counts()
+            ratio = num_retries / max(num_samples, 1)
+            runner.logger.info(
+                f'Epoch {runner.epoch}: {dataset.__class__.__name__} '
+                f'({dataset.ann_file}) sampled {num_samples} images with '
+                f'{num_retries} retries ({ratio:.2%})')
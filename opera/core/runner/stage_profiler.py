@@ -0,0 +1,275 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 分阶段统计每个iteration的耗时与显存
+#   模型中用 profile_stage('encoder') 标记阶段, 没有激活的StageProfiler时
+#   返回nullcontext, 几乎没有开销。训练时使用StageProfilerHook:
+#   custom_hooks = [dict(type='StageProfilerHook', interval=50)]
+import contextlib
+import os.path as osp
+import time
+from collections import OrderedDict, deque
+
+import mmcv
+import numpy as np
+import torch
+from mmcv.runner import HOOKS, Hook, get_dist_info
+
+_NULL_CONTEXT = contextlib.nullcontext()
+_ACTIVE_PROFILER = None
+
+
+def profile_stage(name):
+    """标记模型中的一个阶段, 由当前激活的 :obj:`StageProfiler` 记录。
+
+    阶段可以嵌套, 同一个iteration中多次进入的阶段 (例如每个decoder层的
+    assigner) 耗时累加。
+
+    Args:
+        name (str): 阶段名称。
+
+    Returns:
+        contextmanager: 没有激活的profiler时为nullcontext。
+    """
+    if _ACTIVE_PROFILER is None:
+        return _NULL_CONTEXT
+    return _ACTIVE_PROFILER.stage(name)
+
+
+class StageProfiler:
+    """记录各阶段的耗时 (ms) 与显存, 并给出滑动窗口内的分位数。
+
+    在CUDA上异步执行的kernel需要同步之后计时才准确, ``sync=True`` 时在
+    每个阶段的开始与结束调用 ``torch.cuda.synchronize()``, 因此开启后的
+    总耗时会略高于实际训练。
+
+    Args:
+        window (int): 计算分位数的iteration个数。Default: 200.
+        sync (bool): 是否在阶段边界同步CUDA。Default: True.
+        record_memory (bool): 是否记录CUDA显存, 每个阶段记录结束与开始时
+            已分配显存之差 (MB), 每个iteration记录峰值。Default: True.
+
+    Example:
+        >>> profiler = StageProfiler()
+        >>> with profiler:
+        >>>     for data in data_loader:
+        >>>         model(return_loss=False, **data)
+        >>>         profiler.step()
+        >>> profiler.summary()
+    """
+
+    def __init__(self, window=200, sync=True, record_memory=True):
+        self.window = window
+        self.use_cuda = torch.cuda.is_available()
+        self.sync = sync and self.use_cuda
+        self.record_memory = record_memory and self.use_cuda
+        self.history = OrderedDict()  # name -> deque[(ms, MB)]
+        self._current = OrderedDict()  # name -> [ms, MB], 当前iteration
+        self._previous = None
+        self.record_function = False  # torch.profiler运行时在trace中标记阶段
+
+    def __enter__(self):
+        global _ACTIVE_PROFILER
+        self._previous = _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self
+        return self
+
+    def __exit__(self, *args):
+        global _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self._previous
+        self._previous = None
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.record_function:
+            with torch.profiler.record_function(name):
+                with self._timed(name):
+                    yield
+        else:
+            with self._timed(name):
+                yield
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self._current.setdefault(name, [0., 0.])  # 按进入的顺序输出
+        self.synchronize()
+        memory = torch.cuda.memory_allocated() if self.record_memory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.add(name, (time.perf_counter() - start) * 1000,
+                     (torch.cuda.memory_allocated() - memory) / 1024**2
+                     if self.record_memory else 0.)
+
+    def add(self, name, ms, memory=0.):
+        """累加当前iteration中某个阶段的耗时 (ms) 与显存 (MB)"""
+        record = self._current.setdefault(name, [0., 0.])
+        record[0] += ms
+        record[1] += memory
+
+    def step(self):
+        """结束当前iteration, 将各阶段的记录放入滑动窗口"""
+        for name, record in self._current.items():
+            if name not in self.history:
+                self.history[name] = deque(maxlen=self.window)
+            self.history[name].append(tuple(record))
+        self._current = OrderedDict()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """返回各阶段滑动窗口内的统计。
+
+        Returns:
+            OrderedDict[str, dict]: 每个阶段的 ``count`` (iteration数),
+                ``mean`` 与 ``p{q}`` (ms), 以及 ``memory`` (平均MB)。
+        """
+        results = OrderedDict()
+        for name, records in self.history.items():
+            times = np.array([r[0] for r in records])
+            stats = dict(count=len(times), mean=float(times.mean()))
+            for q, value in zip(percentiles,
+                                np.percentile(times, percentiles)):
+                stats[f'p{q}'] = float(value)
+            stats['memory'] = float(np.mean([r[1] for r in records]))
+            results[name] = stats
+        return results
+
+    def format_summary(self, percentiles=(50, 90, 99)):
+        summary = self.summary(percentiles)
+        if not summary:
+            return ''
+        width = max(len(name) for name in summary) + 2
+        header = f'{"stage":<{width}}' + ''.join(
+            f'{f"p{q}(ms)":>11}' for q in percentiles) + \
+            f'{"mean(ms)":>11}'
+        if self.record_memory:
+            header += f'{"mem(MB)":>10}'
+        lines = [header]
+        for name, stats in summary.items():
+            line = f'{name:<{width}}' + ''.join(
+                f'{stats[f"p{q}"]:>11.2f}' for q in percentiles) + \
+                f'{stats["mean"]:>11.2f}'
+            if self.record_memory:
+                line += f'{stats["memory"]:>10.1f}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+@HOOKS.register_module()
+class StageProfilerHook(Hook):
+    """训练时分阶段统计耗时与显存, 并定期输出滑动窗口内的分位数。
+
+    除了模型中 ``profile_stage`` 标记的阶段, 还记录:
+
+    - ``data``: 等待dataloader的时间, 与IterTimerHook的data_time相同
+    - ``iter``: 一个iteration的总时间 (不含data)
+    - ``backward_step``: ``iter`` 减去 ``forward``, 即反向传播与优化器更新
+
+    可选地在 ``trace_iters`` 的iteration范围内运行torch.profiler并导出
+    chrome trace, 此时各阶段也会出现在trace中。
+
+    Args:
+        interval (int): 输出统计的间隔 (iteration)。Default: 50.
+        window (int): 计算分位数的iteration个数。Default: 200.
+        percentiles (tuple[int]): Default: (50, 90, 99).
+        sync (bool): 是否在阶段边界同步CUDA。Default: True.
+        record_memory (bool): 是否记录CUDA显存。Default: True.
+        trace_iters (tuple[int], optional): ``(start, end)``, 导出第
+            [start, end) 个iteration的chrome trace。Default: None.
+        trace_dir (str, optional): trace的保存目录, 默认为work_dir。
+    """
+
+    def __init__(self,
+                 interval=50,
+                 window=200,
+                 percentiles=(50, 90, 99),
+                 sync=True,
+                 record_memory=True,
+                 trace_iters=None,
+                 trace_dir=None):
+        self.interval = interval
+        self.percentiles = tuple(percentiles)
+        self.profiler = StageProfiler(
+            window=window, sync=sync, record_memory=record_memory)
+        if trace_iters is not None:
+            assert len(trace_iters) == 2 and \
+                trace_iters[0] < trace_iters[1], \
+                f'trace_iters should be (start, end), got {trace_iters}'
+        self.trace_iters = trace_iters
+        self.trace_dir = trace_dir
+        self._torch_profiler = None
+        self._data_start = None
+        self._iter_start = None
+
+    def before_run(self, runner):
+        self.profiler.__enter__()
+
+    def after_run(self, runner):
+        self._stop_trace(runner)
+        self.profiler.__exit__()
+
+    def before_train_epoch(self, runner):
+        self._data_start = time.perf_counter()
+
+    def before_train_iter(self, runner):
+        if self.trace_iters is not None and \
+                runner.iter == self.trace_iters[0]:
+            self._start_trace()
+        self.profiler.synchronize()
+        now = time.perf_counter()
+        if self._data_start is not None:
+            self.profiler.add('data', (now - self._data_start) * 1000)
+        if self.profiler.record_memory:
+            torch.cuda.reset_peak_memory_stats()
+        self._iter_start = now
+
+    def after_train_iter(self, runner):
+        self.profiler.synchronize()
+        iter_ms = (time.perf_counter() - self._iter_start) * 1000
+        peak_memory = torch.cuda.max_memory_allocated() / 1024**2 \
+            if self.profiler.record_memory else 0.
+        self.profiler.add('iter', iter_ms, peak_memory)
+        forward = self.profiler._current.get('forward')
+        if forward is not None:
+            self.profiler.add('backward_step', iter_ms - forward[0])
+        self.profiler.step()
+
+        if self._torch_profiler is not None and \
+                runner.iter + 1 >= self.trace_iters[1]:
+            self._stop_trace(runner)
+        if self.every_n_iters(runner, self.interval):
+            memory_note = ', mem of iter is the peak memory' \
+                if self.profiler.record_memory else ''
+            runner.logger.info(
+                f'Stage profile of the last '
+                f'{min(runner.iter + 1, self.profiler.window)} iters'
+                f'{memory_note}:\n' +
+                self.profiler.format_summary(self.percentiles))
+        self._data_start = time.perf_counter()
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._torch_profiler = torch.profiler.profile(
+            activities=activities, profile_memory=True)
+        self._torch_profiler.__enter__()
+        self.profiler.record_function = True
+
+    def _stop_trace(self, runner):
+        if self._torch_profiler is None:
+            return
+        self._torch_profiler.__exit__(None, None, None)
+        self.profiler.record_function = False
+        rank, _ = get_dist_info()
+        trace_dir = self.trace_dir or runner.work_dir
+        mmcv.mkdir_or_exist(trace_dir)
+        start, end = self.trace_iters
+        trace_file = osp.join(trace_dir,
+                              f'trace_iter{start}-{end}_rank{rank}.json')
+        self._torch_profiler.export_chrome_trace(trace_file)
+        runner.logger.info(f'torch.profiler trace saved to {trace_file}')
+        self._torch_profiler = None
@@ -0,0 +1,47 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+from mmcv.runner import HOOKS, Hook
+
+
+@HOOKS.register_module()
+class ZeroOptimizerHook(Hook):
+    """在保存checkpoint之前汇总ZeroRedundancyOptimizer的状态。
+
+    切分后每个rank只有部分状态, ``state_dict()`` 之前需要所有rank一起调用
+    ``consolidate_state_dict()`` 汇总到rank 0。CheckpointHook只在rank 0保存,
+    所以这里按相同的间隔在所有rank上汇总, 优先级需要高于CheckpointHook。
+
+    汇总后rank 0保存着所有rank的完整状态, 不释放的话rank 0的显存/内存不再
+    随rank数减少。``release=True`` 的实例在保存之后释放汇总的状态, 优先级
+    需要低于CheckpointHook, train_detector中两个实例一起注册。
+
+    Args:
+        interval (int): 与checkpoint_config的interval相同。
+        by_epoch (bool): 与checkpoint_config的by_epoch相同。Default: True.
+        release (bool): 释放而不是汇总状态。Default: False.
+    """
+
+    def __init__(self, interval=-1, by_epoch=True, release=False):
+        self.interval = interval
+        self.by_epoch = by_epoch
+        self.release = release
+
+    def _step(self, runner):
+        if self.release:
+            # state_dict()之前需要重新consolidate_state_dict()
+            runner.optimizer._all_state_dicts = []
+        else:
+            runner.optimizer.consolidate_state_dict(to=0)
+
+    def after_train_epoch(self, runner):
+        if not self.by_epoch:
+            return
+        if self.every_n_epochs(runner, self.interval) or \
+                self.is_last_epoch(runner):
+            self._step(runner)
+
+    def after_train_iter(self, runner):
+        if self.by_epoch:
+            return
+        if self.every_n_iters(runner, self.interval) or \
+                self.is_last_iter(runner):
+            self._step(runner)
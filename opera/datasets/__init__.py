@@ -3,6 +3,7 @@ from .builder import DATASETS, PIPELINES, build_dataset, build_dataloader
 from .coco_pose import CocoPoseDataset
 from .crowd_pose import CrowdPoseDataset
 from .coco_muco_pose_3d import JointDataset
+from .feat_cache_dataset import FeatCacheDataset
 from .pipelines import *
 from .smap_utils import *
 from .utils import replace_ImageToTensor
@@ -11,5 +12,5 @@ from .utils import replace_ImageToTensor
 __all__ = [
     'DATASETS', 'PIPELINES', 'build_dataset', 'build_dataloader',
     'CocoPoseDataset', 'CrowdPoseDataset', 'replace_ImageToTensor',
-    'JointDataset', 
+    'JointDataset', 'FeatCacheDataset',
 ]
@@ -1,5 +1,6 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
 import copy
+import os.path as osp
 import platform
 import random
 import warnings
@@ -14,11 +15,14 @@ from mmdet.datasets.samplers import (GroupSampler, DistributedSampler,
                                         DistributedGroupSampler,
                                         InfiniteBatchSampler,
                                         InfiniteGroupBatchSampler)
-from mmdet.datasets import (ConcatDataset, RepeatDataset,
-                            ClassBalancedDataset, MultiImageMixDataset)
+from mmdet.datasets import (RepeatDataset, ClassBalancedDataset,
+                            MultiImageMixDataset)
 from mmdet.datasets import DATASETS as MMDET_DATASETS
 from mmdet.datasets import PIPELINES as MMDET_PIPELINEs
 
+from .dataset_wrappers import ConcatDataset
+from .samplers import BucketBatchSampler
+
 
 if platform.system() != 'Windows':
     # https://github.com/pytorch/pytorch/issues/973
@@ -38,6 +42,8 @@ def _concat_dataset(cfg, default_args=None):
     img_prefixes = cfg.get('img_prefix', None)
     seg_prefixes = cfg.get('seg_prefix', None)
     proposal_files = cfg.get('proposal_file', None)
+    img_caches = cfg.get('img_cache', None)
+    valid_index_files = cfg.get('valid_index_file', None)
     separate_eval = cfg.get('separate_eval', True)
 
     datasets = []
@@ -54,6 +60,14 @@ def _concat_dataset(cfg, default_args=None):
             data_cfg['seg_prefix'] = seg_prefixes[i]
         if isinstance(proposal_files, (list, tuple)):
             data_cfg['proposal_file'] = proposal_files[i]
+        if isinstance(img_caches, (list, tuple)):
+            data_cfg['img_cache'] = img_caches[i]
+        if isinstance(valid_index_files, (list, tuple)):
+            data_cfg['valid_index_file'] = valid_index_files[i]
+        elif valid_index_files is not None and num_dset > 1:
+            # 每个数据集的有效索引不同, 不能共用一个文件
+            root, ext = osp.splitext(valid_index_files)
+            data_cfg['valid_index_file'] = f'{root}_{i}{ext}'
         datasets.append(build_dataset(data_cfg, default_args))
 
     return ConcatDataset(datasets, separate_eval)
@@ -94,6 +108,7 @@ def build_dataloader(dataset,
                         seed=None,
                         runner_type='EpochBasedRunner',
                         persistent_workers=False,
+                        bucket_sampler=None,
                         **kwargs):
     """Build PyTorch DataLoader.
 
@@ -116,6 +131,11 @@ def build_dataloader(dataset,
             the worker processes after a dataset has been consumed once.
             This allows to maintain the workers `Dataset` instances alive.
             This argument is only valid when PyTorch>=1.7.0. Default: False.
+        bucket_sampler (dict, optional): Arguments of
+            :class:`BucketBatchSampler`. If set, samples are bucketed by
+            aspect ratio and each batch shares a pre-sampled resize scale.
+            Only used with shuffled `EpochBasedRunner` training.
+            Default: None.
         kwargs: any keyword argument to be used to initialize DataLoader
 
     Returns:
@@ -153,6 +173,16 @@ def build_dataloader(dataset,
                 shuffle=False)
         batch_size = 1
         sampler = None
+    elif bucket_sampler is not None and shuffle:
+        batch_sampler = BucketBatchSampler(
+            dataset,
+            batch_size,
+            num_replicas=world_size if dist else 1,
+            rank=rank if dist else 0,
+            seed=seed,
+            **bucket_sampler)
+        batch_size = 1
+        sampler = None
     else:
         if dist:
             # DistributedGroupSampler will definitely shuffle the data to
@@ -1,14 +1,25 @@
 # Document function description
 #   模仿SMAP的数据格式，加载已经修改格式之后的COCO和MuCo数据集。
+import os
+import os.path as osp
 import warnings
 from mmdet.datasets import CustomDataset
 import mmcv
+from mmcv.runner import get_dist_info
+from mmcv.utils import print_log
 import numpy as np
+import torch
+import torch.distributed as dist
 import json
 import scipy.io as scio
 from scipy.optimize import linear_sum_assignment
 
+from opera.core.evaluation import MuPoTSEvaluator, evaluate_mupots
+from opera.core.keypoint import compact_result2arrays, is_compact_result
 from .builder import DATASETS
+from .pipelines import InstrumentedCompose
+from .smap_utils.img_cache import ImgShardReader, rescale_ann_info
+from .smap_utils.pose3d_result import Pose3DResultWriter
 
 
 @DATASETS.register_module()
@@ -50,8 +61,43 @@ class JointDataset(CustomDataset):
     
     def __init__(self, 
                     *args,
+                    img_cache=None,
+                    valid_index_file=None,
+                    profile_pipeline=False,
+                    retry_max_workers=32,
                     **kwargs):
+        """
+        Args:
+            img_cache (str, optional): tools/dataset_converters/build_img_cache.py
+                生成的预缩放图像缓存目录。设置后图像从shard文件中读取,
+                注释中的坐标与相机内参按照缓存的缩放比例进行修改。
+                Default: None.
+            valid_index_file (str, optional): 保存_filter_imgs得到的有效样本索引,
+                存在时直接加载, 避免每次启动时重新遍历注释。多个ann_file时
+                可以为list, 每个数据集使用各自的文件。Default: None.
+            profile_pipeline (bool | dict): 使用InstrumentedCompose记录每个
+                transform的耗时与输出大小, 由PipelineProfilerHook汇总。
+                dict为InstrumentedCompose的参数。Default: False.
+            retry_max_workers (int): 重试计数的缓冲个数, 每个dataloader
+                worker只累加自己的一行, 超过时worker按id取模共用一行,
+                计数可能偏少。Default: 32.
+        """
+        # load_annotations 和 _filter_imgs 在父类的__init__中调用, 需要提前构建
+        self.img_cache = ImgShardReader(img_cache) \
+            if img_cache is not None else None
+        self.valid_index_file = valid_index_file
+        # [主进程 + worker, (取样次数, 重试次数)], 放在共享内存中。
+        # 共享内存上的 += 不是原子操作, 每个worker只写自己的一行, 读取时求和
+        self.retry_max_workers = retry_max_workers
+        self.retry_counts = torch.zeros(
+            (retry_max_workers + 1, 2), dtype=torch.int64).share_memory_()
+        self._retry_row = None
         super(JointDataset, self).__init__(*args, **kwargs)
+        if profile_pipeline:
+            profile_cfg = profile_pipeline \
+                if isinstance(profile_pipeline, dict) else dict()
+            self.pipeline = InstrumentedCompose(self.pipeline.transforms,
+                                                **profile_cfg)
     
     def load_annotations(self, ann_file):
         """加载注释文件, 注意这里使用的注释文件为SMAP提出的注释格式
@@ -60,7 +106,13 @@ class JointDataset(CustomDataset):
         Returns:
             annos(dict): 注释文件内容
         """
-        return mmcv.load(ann_file)['root']
+        data_infos = mmcv.load(ann_file)['root']
+        if self.img_cache is not None:
+            data_infos = [
+                rescale_ann_info(info,
+                                 *self.img_cache.get_scale(info['img_paths']))
+                for info in data_infos]
+        return data_infos
     
     def get_ann_info(self, idx):
         """获取注释文件信息
@@ -97,10 +149,12 @@ class JointDataset(CustomDataset):
         self.pre_pipeline(results)
         return self.pipeline(results)
 
-    def prepare_train_img(self, idx):
+    def prepare_train_img(self, idx, preset_scale=None):
         """获取管道后的训练数据和注释文件
         Args:
             idx (int): 数据索引
+            preset_scale (tuple, optional): BucketBatchSampler预先采样的resize尺度,
+                由AugResize(allow_preset_scale=True)使用。
         anno_info :['dataset', 'img_paths', 'img_width', 'img_height', 
             'image_id', 'cam_id', 'bodys', 'bboxs', 'num_keypoints', 
             'iscrowd', 'segmentation', 'isValidation'])
@@ -109,6 +163,8 @@ class JointDataset(CustomDataset):
         """
         ann_info = self.get_ann_info(idx) 
         results = dict(ann_info=ann_info)
+        if preset_scale is not None:
+            results['preset_scale'] = preset_scale
         self.pre_pipeline(results=results)
         return self.pipeline(results)
     
@@ -120,12 +176,14 @@ class JointDataset(CustomDataset):
         results['bbox_fields'] = []
         results['mask_fields'] = []
         results['keypoint_fields'] = []
+        results['img_cache'] = self.img_cache
     
     def __getitem__(self, idx):
         """Get training/test data after pipeline.
 
         Args:
-            idx (int): Index of data.
+            idx (int | tuple): Index of data, or (index, preset_scale)
+                yielded by BucketBatchSampler.
 
         Returns:
             dict:
@@ -139,30 +197,130 @@ class JointDataset(CustomDataset):
                 "ann_info":
                 "dataset":
         """
+        preset_scale = None
+        if isinstance(idx, tuple):
+            idx, preset_scale = idx
         if self.test_mode:
             return self.prepare_test_img(idx)
+        retry_row = self._get_retry_row()
+        retry_row[0] += 1
         while True:
-            data = self.prepare_train_img(idx)
+            data = self.prepare_train_img(idx, preset_scale)
             if data is None:
+                retry_row[1] += 1
                 idx = self._rand_another(idx)
                 continue
             elif data['gt_bboxes']._data.shape[0] == 0:
                 # print(f"长度为0")
+                retry_row[1] += 1
                 idx = self._rand_another(idx) 
                 continue
             
             return data
+
+    def __getstate__(self):
+        # spawn的worker中重新建立共享内存的numpy视图
+        state = self.__dict__.copy()
+        state['_retry_row'] = None
+        return state
+
+    def _get_retry_row(self):
+        """当前进程在retry_counts中的一行(numpy视图), 主进程为第0行"""
+        pid = os.getpid()
+        if self._retry_row is None or self._retry_row[0] != pid:
+            worker_info = torch.utils.data.get_worker_info()
+            slot = 0 if worker_info is None else \
+                worker_info.id % self.retry_max_workers + 1
+            self._retry_row = (pid, self.retry_counts.numpy()[slot])
+        return self._retry_row[1]
+
+    def get_retry_counts(self):
+        """返回(取样次数, 因为数据增强后没有gt而重试的次数), 所有worker求和"""
+        num_samples, num_retries = self.retry_counts.sum(0).tolist()
+        return num_samples, num_retries
+
+    def reset_retry_counts(self):
+        self.retry_counts.zero_()
+
+    @staticmethod
+    def _has_valid_gt(img_info):
+        """判断图片中是否至少有一个有效的人(vis>0且area>0)。
+
+        与LoadAnnosFromFile和AugPostProcess中的规则保持一致:
+            COCO的area来自注释, MuCo的area为bbox面积。
+        """
+        bodys = np.asarray(img_info['bodys'], dtype=np.float32)
+        if bodys.size == 0:
+            return False
+        bodys = bodys.reshape(-1, 15, 11)
+        bboxs = np.asarray(img_info['bboxs'], dtype=np.float32).reshape(-1, 4)
+        widths, heights = np.abs(bboxs[:, 2]), np.abs(bboxs[:, 3])
+        if img_info['dataset'].upper() == 'COCO':
+            areas = np.asarray(img_info['areas'], dtype=np.float32)
+        else:
+            areas = widths * heights
+        valid = (bodys[..., 3] > 0).any(-1) & (areas > 0) & \
+            (widths > 0) & (heights > 0)
+        return bool(valid.any())
         
     def _filter_imgs(self, min_size=32):
-        # if self.filter_empty_gt:
-        #     warnings.warn(
-        #         'CustomDataset does not support filtering empty gt images.')
+        """过滤尺寸过小以及没有有效gt的图片, 结果可以保存为索引文件。
+
+        分布式训练时只有rank 0检查与写入索引文件, 其它rank等待写入完成后读取。
+        """
+        if self.valid_index_file is None:
+            return self._get_valid_inds(min_size)
+        rank, world_size = get_dist_info()
+        if rank == 0:
+            valid_inds = self._load_valid_index(min_size)
+            if valid_inds is None:
+                valid_inds = self._get_valid_inds(min_size)
+                self._save_valid_index(valid_inds, min_size)
+        if world_size > 1:
+            dist.barrier()
+        if rank != 0:
+            valid_inds = self._load_valid_index(min_size, warn=False)
+            if valid_inds is None:
+                valid_inds = self._get_valid_inds(min_size)
+        return valid_inds
+
+    def _get_valid_inds(self, min_size):
         valid_inds = []
         for i, img_info in enumerate(self.data_infos):
-            if min(img_info['img_width'], img_info['img_height']) >= min_size:
-                valid_inds.append(i)
+            if min(img_info['img_width'], img_info['img_height']) < min_size:
+                continue
+            if self.filter_empty_gt and not self._has_valid_gt(img_info):
+                continue
+            valid_inds.append(i)
         return valid_inds
 
+    def _load_valid_index(self, min_size, warn=True):
+        """索引文件不存在或与注释不一致时返回None"""
+        if not osp.isfile(self.valid_index_file):
+            return None
+        index = np.load(self.valid_index_file)
+        if int(index['num_infos']) == len(self.data_infos) and \
+                int(index['min_size']) == min_size and \
+                bool(index['filter_empty_gt']) == self.filter_empty_gt:
+            return index['valid_inds'].tolist()
+        if warn:
+            warnings.warn(f'{self.valid_index_file} does not match the '
+                            'annotations, rebuild the valid index.')
+        return None
+
+    def _save_valid_index(self, valid_inds, min_size):
+        # 先写入临时文件再重命名, 其它进程不会读到不完整的文件;
+        # np.savez 会自动添加后缀, 这里使用文件对象保持文件名不变
+        tmp_file = self.valid_index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(
+                f,
+                valid_inds=np.asarray(valid_inds, dtype=np.int64),
+                num_infos=len(self.data_infos),
+                min_size=min_size,
+                filter_empty_gt=self.filter_empty_gt)
+        os.replace(tmp_file, self.valid_index_file)
+
     def _set_group_flag(self):
         self.flag = np.zeros(len(self), dtype=np.uint8)
         for i in range(len(self)):
@@ -178,31 +336,49 @@ class JointDataset(CustomDataset):
             bbox2 (_type_): 
                 [top_left_x, top_left_y, bottom_right_x, bottom_right_y]
         """
-        x1_min, y1_min, x1_max, y1_max = bbox1[0], bbox1[1], bbox1[2], bbox1[3]
-        x2_min, y2_min, x2_max, y2_max = bbox2[0], bbox2[1], bbox2[2], bbox2[3]
-        assert x1_min < x1_max and y1_min < y1_max and \
-            x2_min < x2_max and y2_min < y2_max, \
-            f"error. bbox 中坐标范围不合理"
-        # 计算两个矩形框面积
-        area1 = (x1_max - x1_min + 1) * (y1_max - y1_min + 1)
-        area2 = (x2_max - x2_min + 1) * (y2_max - y2_min + 1)
-        # 计算交点的坐标（xleft, yleft, xright, yright)
-        xmin = np.max([x1_min, x2_min])
-        ymin = np.max([y1_min, y2_min])
-        xmax = np.min([x1_max, x2_max])
-        ymax = np.min([y1_max, y2_max])
-        inter_bbox = [xmin, ymin, xmax, ymax]
-        # 计算交集面积
-        inter_area = np.max([0, xmax - xmin]) * np.max([0, ymax - ymin])  # 可能没有交集，此时面积为0
-        if inter_area == 0:
+        iou = self._calc_iou_matrix(np.asarray(bbox1)[None, :4],
+                                    np.asarray(bbox2)[None, :4])[0, 0]
+        if iou == 0:
             return None, 0
-        # 计算iou
-        # A = area(bbox1), B = area(bbox2), C = （area(bbox1) ∩ area(bbox2）
-        # iou = C / (A + B - C)
-        iou = inter_area / (area1 + area2 - inter_area + 1e-6)  # 防止分母为零
-
+        inter_bbox = [max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]),
+                        min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])]
         return inter_bbox, iou
 
+    @staticmethod
+    def _calc_iou_matrix(bboxes1, bboxes2):
+        """向量化计算两组bbox之间的iou, 规则与_calc_iou一致:
+            面积使用 +1 的约定, 交集面积不使用 +1, 没有交集时iou为0。
+
+        Args:
+            bboxes1 (numpy.ndarray): [N, 4],
+                [top_left_x, top_left_y, bottom_right_x, bottom_right_y]
+            bboxes2 (numpy.ndarray): [M, 4]
+        Returns:
+            numpy.ndarray: [N, M]
+        """
+        assert (bboxes1[:, 0] < bboxes1[:, 2]).all() and \
+            (bboxes1[:, 1] < bboxes1[:, 3]).all() and \
+            (bboxes2[:, 0] < bboxes2[:, 2]).all() and \
+            (bboxes2[:, 1] < bboxes2[:, 3]).all(), \
+            f"error. bbox 中坐标范围不合理"
+        # 面积在各自的精度下计算, 之后再统一为float64
+        area1 = ((bboxes1[:, 2] - bboxes1[:, 0] + 1) *
+                    (bboxes1[:, 3] - bboxes1[:, 1] + 1)).astype(np.float64)
+        area2 = ((bboxes2[:, 2] - bboxes2[:, 0] + 1) *
+                    (bboxes2[:, 3] - bboxes2[:, 1] + 1)).astype(np.float64)
+        bboxes1 = bboxes1.astype(np.float64)
+        bboxes2 = bboxes2.astype(np.float64)
+        # 交集的坐标 [N, M]
+        xmin = np.maximum(bboxes1[:, None, 0], bboxes2[None, :, 0])
+        ymin = np.maximum(bboxes1[:, None, 1], bboxes2[None, :, 1])
+        xmax = np.minimum(bboxes1[:, None, 2], bboxes2[None, :, 2])
+        ymax = np.minimum(bboxes1[:, None, 3], bboxes2[None, :, 3])
+        inter_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
+        # iou = C / (A + B - C), 防止分母为零
+        union = area1[:, None] + area2[None, :] - inter_area + 1e-6
+        iou = np.where(inter_area == 0, 0., inter_area / union)
+        return iou
+
     def _get_pred_indexs_by_iou(self, gt_bboxs, pred_bboxs):
         """根据iou来计算与gt最为匹配的输出
         可能存在问题: 
@@ -216,40 +392,41 @@ class JointDataset(CustomDataset):
                 pred bboxs, [num_preds, 5]
                 [top_left_x, top_left_y, bottom_right_x, bottom_right_y, scores]
         """
+        iou_matrix = self._calc_iou_matrix(gt_bboxs, pred_bboxs[:, :4])
+        used = np.zeros(len(pred_bboxs), dtype=bool)
         pred_indexs = []
         for i in range(len(gt_bboxs)):
-            index = -1
-            iou = 0.
-            for j in range(len(pred_bboxs)):
-                _, iou_tmp = self._calc_iou(gt_bboxs[i], pred_bboxs[j][:4])
-                if (iou_tmp != 0 and iou_tmp > iou and j not in pred_indexs):
-                    iou = iou_tmp
-                    index = j
-            if index == -1:
+            # 已经匹配的pred不再参与, 取第一个最大值
+            ious = np.where(used, 0., iou_matrix[i])
+            index = int(np.argmax(ious)) if len(ious) else 0
+            if len(ious) == 0 or ious[index] <= 0:
                 # TODO bug 待修复
                 # print(f"index == -1")
                 index = 0
             # assert index != -1, f"没有一个bbox与之匹配"
             pred_indexs.append(index)
+            used[index] = True
             
         return pred_indexs
 
-    def _get_pred_indexs_by_scores(self, gt_bboxs, pred_bboxs):
+    def _get_pred_indexs_by_scores(self, gt_bboxs, pred_bboxs, num_preds=None):
         """
         首先选取置信度最高的前num_gts个, 然后根据iou进行匹配   
         前提是返回的置信度需要从高到底排列    
+
+        num_preds: pred_bboxs中实际预测的个数, 之后为补齐的全零行,
+            这些行与任何gt的iou都为0, 不参与iou计算
         """
         num_gts = len(gt_bboxs)
-        # 选取前num_gts个
-        pred_bboxs_tmp = pred_bboxs[:num_gts, :4].copy()
-        # 进行iou匹配
+        if num_preds is None:
+            num_preds = len(pred_bboxs)
+        num_preds = min(num_preds, num_gts)
+        # 选取前num_gts个, 进行iou匹配
         iou_matrix = np.zeros((num_gts, num_gts))
-        for i in range(num_gts):
-            for j in range(num_gts):
-                _, iou_tmp = self._calc_iou(gt_bboxs[i], pred_bboxs_tmp[j])
-                assert iou_tmp <= 1 and iou_tmp >= 0, \
-                    f"iou 应该在0-1范围内"
-                iou_matrix[i][j] = iou_tmp
+        iou_matrix[:, :num_preds] = self._calc_iou_matrix(
+            gt_bboxs, pred_bboxs[:num_preds, :4])
+        assert ((iou_matrix <= 1) & (iou_matrix >= 0)).all(), \
+            f"iou 应该在0-1范围内"
 
         not_iou_matrix = 1 - iou_matrix
         matched_row_inds, matched_col_inds = linear_sum_assignment(not_iou_matrix)
@@ -265,12 +442,15 @@ class JointDataset(CustomDataset):
         """
         num_gts = gt_bodys.shape[0]
         new_gt_bodys = np.zeros((num_gts, 16, 11))
-        for i in range(num_gts):
-            new_gt_bodys[i][:15, :] = gt_bodys[i][:, :]
-            valid_index = gt_bodys[i][:, 3] > 0
-            if valid_index.sum() != 0:
-                tmp = gt_bodys[i][valid_index]  # [valid_index.sum(), 11]
-                new_gt_bodys[i][15] = np.sum(tmp, 0) / valid_index.sum()
+        if num_gts == 0:
+            return new_gt_bodys
+        new_gt_bodys[:, :15, :] = gt_bodys
+        valid_index = gt_bodys[..., 3] > 0  # [num_gts, 15]
+        num_valid = valid_index.sum(-1)  # [num_gts, ]
+        valid_sum = np.where(valid_index[..., None], gt_bodys, 0.).sum(1)
+        has_valid = num_valid != 0
+        new_gt_bodys[has_valid, 15] = \
+            valid_sum[has_valid] / num_valid[has_valid][:, None]
         
         return new_gt_bodys 
     
@@ -301,32 +481,29 @@ class JointDataset(CustomDataset):
         num_gts = len(pred_depths)
         root_idx = 2  # 骨盆点
         pred_bodys_2d = np.zeros((num_gts, 15, 4))
-        pred_rdepths = np.zeros((num_gts, ))  # (骨盆点深度, )
-        for i in range(num_gts):
-            center_abs_depth = pred_depths[i][0]
-            kpt_abs_depth = pred_depths[i][1:] + pred_depths[i][0]
-            # 根据smap公式计算Z
-            # kpt_abs_depth = kpt_abs_depth * scale_dict['f_x'] / scale_dict['img_w']
-            kpt_abs_depth = kpt_abs_depth * scale_dict['f_x'] * scale_dict['scale_w']
-            # 骨盆点深度
-            root_abs_depth = kpt_abs_depth[root_idx]
-            # 其余点相对于骨盆点的深度
-            kpt_rel_root_depth = kpt_abs_depth - kpt_abs_depth[root_idx]
-            
-            pred_bodys_2d[i][:, :2] = pred_kpts[i]
-            pred_bodys_2d[i][:, 2] = kpt_rel_root_depth
-            pred_bodys_2d[i][:, 3] = pred_scores[i]
-            pred_rdepths[i] = root_abs_depth
+        kpt_abs_depth = pred_depths[:, 1:] + pred_depths[:, :1]
+        # 根据smap公式计算Z
+        # kpt_abs_depth = kpt_abs_depth * scale_dict['f_x'] / scale_dict['img_w']
+        kpt_abs_depth = kpt_abs_depth * scale_dict['f_x'] * scale_dict['scale_w']
+        # 骨盆点深度, (骨盆点深度, )
+        pred_rdepths = np.zeros((num_gts, ))
+        pred_rdepths[:] = kpt_abs_depth[:, root_idx]
+        # 其余点相对于骨盆点的深度
+        kpt_rel_root_depth = kpt_abs_depth - kpt_abs_depth[:, root_idx:root_idx + 1]
+        
+        pred_bodys_2d[:, :, :2] = pred_kpts
+        pred_bodys_2d[:, :, 2] = kpt_rel_root_depth
+        pred_bodys_2d[:, :, 3] = pred_scores
             
         return pred_bodys_2d, pred_rdepths
     
     def _back_projection(self, x, d, K):
         """
         Back project 2D points x(2xN) to the camera coordinate and ignore distortion parameters.
-        :param x: 2*N
-        :param d: real depth of every point
+        :param x: [..., 2]
+        :param d: real depth of every point, [...]
         :param K: camera intrinsics
-        :return: X (2xN), points in 3D
+        :return: X [..., 3], points in 3D
         P3D.x = (x_2d - cx_d) * depth(x_2d,y_2d) / fx_d
         P3D.y = (y_2d - cy_d) * depth(x_2d,y_2d) / fy_d
         P3D.z = depth(x_2d,y_2d)
@@ -336,18 +513,18 @@ class JointDataset(CustomDataset):
             tmp2d = np.array(x[i][0], x[i][1], 1]).reshape([3,1])
             (d * iK @ tmp2d)
         """
-        X = np.zeros((len(d), 3), np.float)
-        X[:, 0] = (x[:, 0] - K[0, 2]) * d / K[0, 0]
-        X[:, 1] = (x[:, 1] - K[1, 2]) * d / K[1, 1]
-        X[:, 2] = d
+        X = np.zeros(d.shape + (3, ), np.float64)
+        X[..., 0] = (x[..., 0] - K[0, 2]) * d / K[0, 0]
+        X[..., 1] = (x[..., 1] - K[1, 2]) * d / K[1, 1]
+        X[..., 2] = d
         return X
 
     def _get_3d_points(self, pred_bodys, root_depth, K, root_n=2):
-        bodys_3d = np.zeros(pred_bodys.shape, np.float)
+        bodys_3d = np.zeros(pred_bodys.shape, np.float64)
         bodys_3d[:, :, 3] = pred_bodys[:, :, 3]
-        for i in range(len(pred_bodys)):
-            pred_bodys[i][:, 2] += root_depth[i]
-            bodys_3d[i][:, :3] = self._back_projection(pred_bodys[i][:, :2], pred_bodys[i][:, 2], K)
+        pred_bodys[:, :, 2] += root_depth[:, None]
+        bodys_3d[:, :, :3] = self._back_projection(
+            pred_bodys[:, :, :2], pred_bodys[:, :, 2], K)
         return bodys_3d
 
     def _proc_3d(self, pred_bodys_2d, pred_rdepths, scale):
@@ -365,20 +542,129 @@ class JointDataset(CustomDataset):
         pred_bodys_3d = self._get_3d_points(coords_2d, root_depth, K)
         return pred_bodys_3d
         
+    def _match_single(self, anno, result):
+        """将一张图片的预测结果与gt匹配, 生成3d_pairs中的一项。
+
+        Args:
+            anno (dict): data_infos中的一项。
+            result (tuple | np.ndarray): 网络输出结果, (bboxs, kpts, depths, scale_factor)
+                或 bbox_kpt2result_3d_compact 生成的结构化数组。
+        Returns:
+            dict | None: 3d_pairs中的一项(值为numpy数组), 没有有效gt时返回None。
+        """
+        # 取出result中对应数据
+        if is_compact_result(result):
+            # test_cfg.compact_result 生成的结构化数组, 已按分数从高到低排列
+            bboxs, _, kpts, depths, scale_factor = \
+                compact_result2arrays(result)
+            assert scale_factor is not None, \
+                f"{anno['img_paths']} 没有保留任何预测, 请设置 min_k > 0"
+        else:
+            bboxs, kpts, depths, scale_factor = result[0][0], result[1][0], result[2][0], result[3][0]
+            assert bboxs.shape == (100, 5), \
+                f"error. bboxs.shape:{bboxs.shape}"
+        assert kpts.shape == (len(bboxs), 15, 2), \
+            f"error. kpts.shape:{kpts.shape}"
+        assert depths.shape == (len(bboxs), 16), \
+            f"error. depths.shape:{depths.shape}"
+        assert len(scale_factor) == 4, \
+            f"errot. scale_factor.length:{len(scale_factor)}"
+        # gt 处理
+        gt_bodys = []
+        gt_bboxs = []
+        anno_bodys = np.array(anno['bodys'])
+        for j in range(len(anno_bodys)):
+            valid_num = anno_bodys[j][:, 3] > 0  # [15, ]
+            if valid_num.sum() > 0:
+                gt_bodys.append(anno['bodys'][j])
+                gt_bboxs.append(anno['bboxs'][j])
+            else:
+                print(f"{anno['img_paths']} 中包含有无效bbox和body")
+        
+        gt_bodys = np.array(gt_bodys)  # [num_gts, 15, 11]
+        gt_bodys = self._proc_gt_bodys(gt_bodys)  # [num_gts, 16, 11]
+        assert gt_bodys.shape[-2:] == (16, 11) , f"gt_bodys.shape: {gt_bodys.shape}"
+        gt_bboxs = np.array(gt_bboxs).reshape(-1, 4)
+        gt_bboxs = self._proc_gt_bboxs(gt_bboxs)
+        assert gt_bboxs.shape[-1] == 4, f"gt_bboxs.shape: {gt_bboxs.shape}"
+
+        num_gts = len(gt_bboxs)
+        if num_gts == 0:
+            print(f"{anno['img_paths']} 中gt个数为0")
+            return None
+
+        scale_dict = dict()
+        scale_dict['img_w'] = anno['img_width']
+        scale_dict['img_h'] = anno['img_height']
+        scale_dict['f_x'] = gt_bodys[0, 0, 7]
+        scale_dict['f_y'] = gt_bodys[0, 0, 8]
+        scale_dict['cx'] = gt_bodys[0, 0, 9]
+        scale_dict['cy'] = gt_bodys[0, 0, 10]
+        scale_dict['scale_w'] = scale_factor[0]
+        # 获取与gt数目相等的preds
+        # FIXME 两种方法：
+        # 利用 iou 与 利用置信度 存在差别
+        num_preds = len(bboxs)
+        if num_preds < num_gts:
+            # 保留的预测少于gt个数时用0补齐, 与未检测到的人等价
+            num_pad = num_gts - num_preds
+            bboxs = np.concatenate([bboxs, np.zeros((num_pad, 5), bboxs.dtype)])
+            kpts = np.concatenate([kpts, np.zeros((num_pad, 15, 2), kpts.dtype)])
+            depths = np.concatenate([depths, np.zeros((num_pad, 16), depths.dtype)])
+        pred_indexs = self._get_pred_indexs_by_scores(
+            gt_bboxs, bboxs, num_preds)
+        pred_indexs = np.array(pred_indexs)
+        assert len(pred_indexs) == len(gt_bboxs), \
+            f"error. Unequal length."
+        pred_bboxes, pred_scores = bboxs[pred_indexs][:, :4], bboxs[pred_indexs][:, 4][:, None]  # [num_gts, 4], [num_gts, 1]
+        pred_kpts = kpts[pred_indexs]  # [num_gts, 15, 2]
+        pred_depths = depths[pred_indexs]  # [num_gts, 16]
+        # 对2d坐标和3d坐标进行处理
+        pred_bodys_2d, pred_rdepths = self._proc_2d(pred_kpts, pred_depths, pred_scores, scale_dict)  
+        # pred_bodys_2d: (x, y, relative depth, scores), pred_rdepths: (absolute depth) 骨盆点的绝对深度
+        pred_bodys_3d = self._proc_3d(pred_bodys_2d, pred_rdepths, scale_dict)  # (X, Y, absolute depth, scores)
+        # 检验长度
+        assert len(gt_bodys) == num_gts
+        assert pred_bodys_2d.shape == (num_gts, 15, 4)
+        assert pred_bodys_3d.shape == (num_gts, 15, 4)
+        assert pred_rdepths.shape[0] == num_gts
+
+        # 值为numpy数组, 只有保存json时才转换为list
+        pair = dict()
+        pair['pred_2d'] = pred_bodys_2d
+        pair['pred_3d'] = pred_bodys_3d
+        pair['root_d'] = pred_rdepths
+        pair['image_path'] = anno['img_paths']
+        pair['gt_3d'] = gt_bodys[:, :, 4:]
+        pair['gt_2d'] = gt_bodys[:, :, :4]
+
+        return pair
+
     def evaluate(self, 
                 results, 
-                output_save_path,
-                mat_save_path,
+                output_save_path=None,
+                mat_save_path=None,
                 save_json=True,
-                save_mat=True,):
-        """生成用于进行eval的json文件, 参考SMAP。
+                save_mat=True,
+                result_format='bin',
+                float16=False,
+                nproc=1,
+                vis_only=False,
+                logger=None,
+                **kwargs):
+        """生成用于进行eval的json文件, 参考SMAP, 并直接计算MuPoTS-3D指标。
 
         Args:
             results (_type_): 网络输出结果
-            output_save_path: json保存路径
-            mat_save_path:  mat保存路径
-            save_json: 是否保存json
+            output_save_path: json保存路径, None时不保存
+            mat_save_path:  mat保存路径, None时不保存
+            save_json: 是否保存结果
             save_mat: 是否保存mat
+            result_format: 'bin'时保存为 output.pose3d 目录(见 Pose3DResultWriter),
+                'json'时保存为原先的 output.json
+            float16: 'bin'格式时预测值是否保存为float16
+            nproc: 计算指标的进程数, 大于1时按序列并行
+            vis_only: 只评测gt中可见的关节
 
             3d_pairs has items like{'pred_2d':[[x,y,detZ,score]...], 
                                     'gt_2d':[[x,y,Z,visual_type]...],
@@ -386,98 +672,86 @@ class JointDataset(CustomDataset):
                                     'gt_3d':[[X,Y,Z]...],
                                     'root_d': (abs depth of root (float value) pred by network),
                                     'image_path': relative image path}
+        Returns:
+            OrderedDict: MuPoTS-3D指标, 见 MuPoTSStats.summary
         """
         assert len(self.data_infos) == len(results), \
-            f"len(anno) != len(results), length of anno is {len(anno)}"
+            f"len(anno) != len(results), length of anno is {len(self.data_infos)}"
+        assert result_format in ('bin', 'json'), \
+            f"unsupported result_format: {result_format}"
         output = dict()
         output['model_pattern'] = self.__class__.__name__
         output['3d_pairs'] = []
+        writer = None
+        if save_json and output_save_path is not None \
+                and result_format == 'bin':
+            # 逐张图像写入, 不再生成缩进的json
+            writer = Pose3DResultWriter(
+                output_save_path + 'output.pose3d',
+                float16=float16,
+                model_pattern=output['model_pattern'])
         # TODO 查看eval时是否看顺序读取数据集，否则下面代码逻辑错误
         for i in range(len(results)):
-            anno = self.data_infos[i]
-            result = results[i]
-            # 取出result中对应数据
-            bboxs, kpts, depths, scale_factor = result[0][0], result[1][0], result[2][0], result[3][0]
-            assert bboxs.shape == (100, 5), \
-                f"error. bboxs.shape:{bboxs.shape}"
-            assert kpts.shape == (100, 15, 2), \
-                f"error. kpts.shape:{kpts.shape}"
-            assert depths.shape == (100, 16), \
-                f"error. depths.shape:{depths.shape}"
-            assert len(scale_factor) == 4, \
-                f"errot. scale_factor.length:{len(scale_factor)}"
-            # gt 处理
-            gt_bodys = []
-            gt_bboxs = []
-            anno_bodys = np.array(anno['bodys'])
-            for j in range(len(anno_bodys)):
-                valid_num = anno_bodys[j][:, 3] > 0  # [15, ]
-                if valid_num.sum() > 0:
-                    gt_bodys.append(anno['bodys'][j])
-                    gt_bboxs.append(anno['bboxs'][j])
-                else:
-                    print(f"{anno['img_paths']} 中包含有无效bbox和body")
-            
-            gt_bodys = np.array(gt_bodys)  # [num_gts, 15, 11]
-            gt_bodys = self._proc_gt_bodys(gt_bodys)  # [num_gts, 16, 11]
-            assert gt_bodys.shape[-2:] == (16, 11) , f"gt_bodys.shape: {gt_bodys.shape}"
-            gt_bboxs = np.array(gt_bboxs)
-            gt_bboxs = self._proc_gt_bboxs(gt_bboxs)
-            assert gt_bboxs.shape[-1] == 4, f"gt_bboxs.shape: {gt_bboxs.shape}"
-
-            num_gts = len(gt_bboxs)
-            if num_gts == 0:
-                print(f"{anno['img_paths']} 中gt个数为0")
-                continue
-
-            scale_dict = dict()
-            scale_dict['img_w'] = anno['img_width']
-            scale_dict['img_h'] = anno['img_height']
-            scale_dict['f_x'] = gt_bodys[0, 0, 7]
-            scale_dict['f_y'] = gt_bodys[0, 0, 8]
-            scale_dict['cx'] = gt_bodys[0, 0, 9]
-            scale_dict['cy'] = gt_bodys[0, 0, 10]
-            scale_dict['scale_w'] = scale_factor[0]
-            # 获取与gt数目相等的preds
-            # FIXME 两种方法：
-            # 利用 iou 与 利用置信度 存在差别
-            pred_indexs = self._get_pred_indexs_by_scores(gt_bboxs, bboxs)
-            pred_indexs = np.array(pred_indexs)
-            assert len(pred_indexs) == len(gt_bboxs), \
-                f"error. Unequal length."
-            pred_bboxes, pred_scores = bboxs[pred_indexs][:, :4], bboxs[pred_indexs][:, 4][:, None]  # [num_gts, 4], [num_gts, 1]
-            pred_kpts = kpts[pred_indexs]  # [num_gts, 15, 2]
-            pred_depths = depths[pred_indexs]  # [num_gts, 16]
-            # 对2d坐标和3d坐标进行处理
-            pred_bodys_2d, pred_rdepths = self._proc_2d(pred_kpts, pred_depths, pred_scores, scale_dict)  
-            # pred_bodys_2d: (x, y, relative depth, scores), pred_rdepths: (absolute depth) 骨盆点的绝对深度
-            pred_bodys_3d = self._proc_3d(pred_bodys_2d, pred_rdepths, scale_dict)  # (X, Y, absolute depth, scores)
-            # 检验长度
-            assert len(gt_bodys) == num_gts
-            assert pred_bodys_2d.shape == (num_gts, 15, 4)
-            assert pred_bodys_3d.shape == (num_gts, 15, 4)
-            assert pred_rdepths.shape[0] == num_gts
-
-            pair = dict()
-            pair['pred_2d'] = pred_bodys_2d.tolist()
-            pair['pred_3d'] = pred_bodys_3d.tolist()
-            pair['root_d'] = pred_rdepths.tolist()
-            pair['image_path'] = anno['img_paths']
-            pair['gt_3d'] = gt_bodys[:, :, 4:].tolist()
-            pair['gt_2d'] = gt_bodys[:, :, :4].tolist()
-
-            output['3d_pairs'].append(pair)
-
-        if save_json:
+            pair = self._match_single(self.data_infos[i], results[i])
+            if pair is not None:
+                output['3d_pairs'].append(pair)
+                if writer is not None:
+                    writer.add(pair)
+
+        if writer is not None:
+            writer.close()
+            print(f"\n output结果写入至: {writer.path}")
+        elif save_json and output_save_path is not None:
             file_path = output_save_path + 'output.json'
+            # pair中的值为numpy数组, 保存json时转换为list
+            json_output = dict(model_pattern=output['model_pattern'])
+            json_output['3d_pairs'] = [{
+                k: v.tolist() if isinstance(v, np.ndarray) else v
+                for k, v in pair.items()
+            } for pair in output['3d_pairs']]
             with open(file_path, 'w+') as fp:
-                json.dump(output, fp, indent=4)
+                json.dump(json_output, fp, indent=4)
             print(f"\n output结果写入至: {file_path}")
 
-        if save_mat:
+        if save_mat and mat_save_path is not None:
             self._save_result_to_mat(output, mat_save_path)
-        return
+
+        stats = evaluate_mupots(
+            output['3d_pairs'], nproc=nproc, vis_only=vis_only)
+        eval_results = stats.summary()
+        print_log(
+            'MuPoTS-3D: ' + ', '.join(
+                f'{k}: {eval_results[k]:.2f}' for k in
+                ('pck_rel', 'auc_rel', 'mpjpe_rel', 'pck_abs', 'auc_abs',
+                 'mpjpe_abs')),
+            logger=logger)
+        return eval_results
     
+    def get_evaluator(self,
+                      vis_only=False,
+                      result_path=None,
+                      float16=False,
+                      **kwargs):
+        """返回流式评测器, 用于 multi_gpu_test_3d(evaluator=...)
+
+        Args:
+            result_path (str, optional): 给定时推理过程中逐张图像写入
+                output.pose3d格式的结果, 分布式测试时每个rank写入
+                ``result_path/rank_{rank}``, Pose3DResultReader 读取时合并。
+            float16 (bool): 同 evaluate。
+        """
+        writer = None
+        if result_path is not None:
+            rank, world_size = get_dist_info()
+            if world_size > 1:
+                result_path = osp.join(result_path, f'rank_{rank}')
+            writer = Pose3DResultWriter(
+                result_path,
+                float16=float16,
+                model_pattern=self.__class__.__name__)
+        return MuPoTSEvaluator(
+            self, vis_only=vis_only, writer=writer, **kwargs)
+
     def _save_result_to_mat(self, output, mat_save_path):
         """
             将eval的结果存储为mat格式进行保存
@@ -13,6 +13,7 @@ from terminaltables import AsciiTable
 
 from mmdet.datasets.api_wrappers import COCOeval
 from mmdet.datasets import CocoDataset
+from opera.core.evaluation import KeypointCOCOeval
 from .builder import DATASETS
 
 
@@ -149,30 +150,49 @@ class CocoPoseDataset(CocoDataset):
             img_id = self.img_ids[idx]
             det, kpt = results[idx]
             for label in range(len(det)):
-                # bbox results
                 bboxes = det[label]
-                for i in range(bboxes.shape[0]):
-                    data = dict()
-                    data['image_id'] = img_id
-                    data['bbox'] = self.xyxy2xywh(bboxes[i])
-                    data['score'] = float(bboxes[i][4])
-                    data['category_id'] = self.cat_ids[label]
-                    bbox_json_results.append(data)
-
-                # kpt results
+                if bboxes.shape[0] == 0:
+                    continue
+                category_id = self.cat_ids[label]
+                # 一次转换整个数组, 与逐个xyxy2xywh的结果相同
+                xywh = bboxes[:, :4].astype(np.float64)
+                xywh[:, 2:] -= xywh[:, :2]
                 # some detectors use different scores for bbox and kpt
-                kpts = kpt[label]
-                kpt_score = [bbox[4] for bbox in bboxes]
-                for i in range(bboxes.shape[0]):
-                    data = dict()
-                    data['image_id'] = img_id
-                    data['score'] = float(kpt_score[i])
-                    data['category_id'] = self.cat_ids[label]
-                    i_kpt = kpts[i].reshape(-1)
-                    data['keypoints'] = i_kpt.tolist()
-                    kpt_json_results.append(data)
+                scores = bboxes[:, 4].tolist()
+                kpts = kpt[label].reshape(bboxes.shape[0], -1).tolist()
+                for bbox, score, i_kpt in zip(xywh.tolist(), scores, kpts):
+                    bbox_json_results.append(
+                        dict(
+                            image_id=img_id,
+                            bbox=bbox,
+                            score=score,
+                            category_id=category_id))
+                    kpt_json_results.append(
+                        dict(
+                            image_id=img_id,
+                            score=score,
+                            category_id=category_id,
+                            keypoints=i_kpt))
         return bbox_json_results, kpt_json_results
 
+    def _kpt2arrays(self, results):
+        """将关键点结果整理为 KeypointCOCOeval 的输入, 不经过json。
+
+        Returns:
+            dict: (image_id, category_id) -> (scores [n], keypoints [n, K, 3])
+        """
+        kpt_results = dict()
+        for idx in range(len(self)):
+            img_id = self.img_ids[idx]
+            det, kpt = results[idx]
+            for label in range(len(det)):
+                bboxes = det[label]
+                if bboxes.shape[0] == 0:
+                    continue
+                kpt_results[img_id, self.cat_ids[label]] = (bboxes[:, 4],
+                                                            kpt[label])
+        return kpt_results
+
     def results2json(self, results, outfile_prefix):
         """Dump the detection results to a COCO style json file.
 
@@ -258,7 +278,9 @@ class CocoPoseDataset(CocoDataset):
                     classwise=False,
                     proposal_nums=(100, 300, 1000),
                     iou_thrs=None,
-                    metric_items=None):
+                    metric_items=None,
+                    fast_eval=False,
+                    nproc=1):
         """Evaluation in COCO protocol.
 
         Args:
@@ -286,6 +308,9 @@ class CocoPoseDataset(CocoDataset):
                 used when ``metric=='proposal'``, ``['mAP', 'mAP_50', 'mAP_75',
                 'mAP_s', 'mAP_m', 'mAP_l']`` will be used when
                 ``metric=='bbox' or metric=='segm'``.
+            fast_eval (bool): 'keypoints' 使用 KeypointCOCOeval 直接评测数组形式
+                的结果, 指标与COCOeval相同。Default: False.
+            nproc (int): fast_eval 的进程数。Default: 1.
 
         Returns:
             dict[str, float]: COCO style evaluation metric.
@@ -305,7 +330,12 @@ class CocoPoseDataset(CocoDataset):
             if not isinstance(metric_items, list):
                 metric_items = [metric_items]
 
-        result_files, tmp_dir = self.format_results(results, jsonfile_prefix)
+        if fast_eval and jsonfile_prefix is None and metrics == ['keypoints']:
+            # 快速评测不需要json文件
+            result_files, tmp_dir = dict(), None
+        else:
+            result_files, tmp_dir = self.format_results(
+                results, jsonfile_prefix)
 
         eval_results = OrderedDict()
         cocoGt = self.coco
@@ -327,34 +357,46 @@ class CocoPoseDataset(CocoDataset):
                 continue
 
             iou_type = 'bbox' if metric == 'proposal' else metric
-            if metric not in result_files:
+            if metric == 'keypoints' and fast_eval:
+                kpt_results = self._kpt2arrays(results)
+                if len(kpt_results) == 0:
+                    print_log(
+                        'The testing results of the whole dataset is empty.',
+                        logger=logger,
+                        level=logging.ERROR)
+                    break
+                cocoEval = KeypointCOCOeval(
+                    cocoGt, kpt_results, iou_type, nproc=nproc)
+            elif metric not in result_files:
                 raise KeyError(f'{metric} is not in results')
-            try:
-                predictions = mmcv.load(result_files[metric])  # num_imgs * 100
-                if iou_type == 'segm':
-                    # Refer to https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/coco.py#L331  # noqa
-                    # When evaluating mask AP, if the results contain bbox,
-                    # cocoapi will use the box area instead of the mask area
-                    # for calculating the instance area. Though the overall AP
-                    # is not affected, this leads to different
-                    # small/medium/large mask AP results.
-                    for x in predictions:
-                        x.pop('bbox')
-                    warnings.simplefilter('once')
-                    warnings.warn(
-                        'The key "bbox" is deleted for more accurate mask AP '
-                        'of small/medium/large instances since v2.12.0. This '
-                        'does not change the overall mAP calculation.',
-                        UserWarning)
-                cocoDt = cocoGt.loadRes(predictions)
-            except IndexError:
-                print_log(
-                    'The testing results of the whole dataset is empty.',
-                    logger=logger,
-                    level=logging.ERROR)
-                break
-
-            cocoEval = COCOeval(cocoGt, cocoDt, iou_type)
+            else:
+                try:
+                    predictions = mmcv.load(result_files[metric])  # num_imgs * 100
+                    if iou_type == 'segm':
+                        # Refer to https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/coco.py#L331  # noqa
+                        # When evaluating mask AP, if the results contain
+                        # bbox, cocoapi will use the box area instead of the
+                        # mask area for calculating the instance area. Though
+                        # the overall AP is not affected, this leads to
+                        # different small/medium/large mask AP results.
+                        for x in predictions:
+                            x.pop('bbox')
+                        warnings.simplefilter('once')
+                        warnings.warn(
+                            'The key "bbox" is deleted for more accurate mask '
+                            'AP of small/medium/large instances since v2.12.0. '
+                            'This does not change the overall mAP '
+                            'calculation.',
+                            UserWarning)
+                    cocoDt = cocoGt.loadRes(predictions)
+                except IndexError:
+                    print_log(
+                        'The testing results of the whole dataset is empty.',
+                        logger=logger,
+                        level=logging.ERROR)
+                    break
+
+                cocoEval = COCOeval(cocoGt, cocoDt, iou_type)
             cocoEval.params.catIds = self.cat_ids
             cocoEval.params.imgIds = self.img_ids
             if metric != 'keypoints':
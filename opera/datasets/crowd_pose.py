@@ -13,6 +13,7 @@ except ImportError:
     COCO = None
     COCOeval = None
 
+from opera.core.evaluation import CROWDPOSE_KEYPOINT_SIGMAS, KeypointCOCOeval
 from .builder import DATASETS
 from .coco_pose import CocoPoseDataset
 
@@ -209,7 +210,9 @@ class CrowdPoseDataset(CocoPoseDataset):
                  classwise=False,
                  proposal_nums=(100, 300, 1000),
                  iou_thrs=None,
-                 metric_items=None):
+                 metric_items=None,
+                 fast_eval=False,
+                 nproc=1):
         """Evaluation in COCO protocol.
 
         Args:
@@ -236,6 +239,9 @@ class CrowdPoseDataset(CocoPoseDataset):
                 used when ``metric=='proposal'``, ``['mAP', 'mAP_50', 'mAP_75',
                 'mAP_s', 'mAP_m', 'mAP_l']`` will be used when
                 ``metric=='bbox' or metric=='segm'``.
+            fast_eval (bool): 使用 KeypointCOCOeval 直接评测数组形式的结果,
+                指标与xtcocotools的COCOeval相同。Default: False.
+            nproc (int): fast_eval 的进程数。Default: 1.
 
         Returns:
             dict[str, float]: COCO style evaluation metric.
@@ -250,7 +256,12 @@ class CrowdPoseDataset(CocoPoseDataset):
             if not isinstance(metric_items, list):
                 metric_items = [metric_items]
 
-        result_files, tmp_dir = self.format_results(results, jsonfile_prefix)
+        if fast_eval and jsonfile_prefix is None:
+            # 快速评测不需要json文件
+            result_files, tmp_dir = dict(), None
+        else:
+            result_files, tmp_dir = self.format_results(
+                results, jsonfile_prefix)
 
         eval_results = OrderedDict()
         cocoGt = self.coco
@@ -260,33 +271,44 @@ class CrowdPoseDataset(CocoPoseDataset):
                 msg = '\n' + msg
             print_log(msg, logger=logger)
 
-            iou_type = metric
-            if metric not in result_files:
-                raise KeyError(f'{metric} is not in results')
-            try:
-                predictions = mmcv.load(result_files[metric])
-                cocoDt = cocoGt.loadRes(predictions)
-            except IndexError:
-                print_log(
-                    'The testing results of the whole dataset is empty.',
-                    logger=logger,
-                    level=logging.ERROR)
-                break
-
-            sigmas = np.array([
-                .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87, .87, .89, .89,
-                .79, .79
-            ]) / 10.0
-
-            if COCOeval is None:
-                raise RuntimeError('xtcocotools is not installed')
-            cocoEval = COCOeval(
-                cocoGt,
-                cocoDt,
-                'keypoints_crowd',
-                sigmas,
-                use_area=False)
-            cocoEval.params.useSegm = None
+            if fast_eval:
+                kpt_results = self._kpt2arrays(results)
+                if len(kpt_results) == 0:
+                    print_log(
+                        'The testing results of the whole dataset is empty.',
+                        logger=logger,
+                        level=logging.ERROR)
+                    break
+                cocoEval = KeypointCOCOeval(
+                    cocoGt,
+                    kpt_results,
+                    'keypoints_crowd',
+                    CROWDPOSE_KEYPOINT_SIGMAS,
+                    use_area=False,
+                    xtcocotools=True,
+                    nproc=nproc)
+            else:
+                if metric not in result_files:
+                    raise KeyError(f'{metric} is not in results')
+                try:
+                    predictions = mmcv.load(result_files[metric])
+                    cocoDt = cocoGt.loadRes(predictions)
+                except IndexError:
+                    print_log(
+                        'The testing results of the whole dataset is empty.',
+                        logger=logger,
+                        level=logging.ERROR)
+                    break
+
+                if COCOeval is None:
+                    raise RuntimeError('xtcocotools is not installed')
+                cocoEval = COCOeval(
+                    cocoGt,
+                    cocoDt,
+                    'keypoints_crowd',
+                    CROWDPOSE_KEYPOINT_SIGMAS,
+                    use_area=False)
+                cocoEval.params.useSegm = None
             cocoEval.evaluate()
             cocoEval.accumulate()
             cocoEval.summarize()
@@ -0,0 +1,26 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import bisect
+
+from mmdet.datasets import ConcatDataset as MMDetConcatDataset
+
+
+class ConcatDataset(MMDetConcatDataset):
+    """ConcatDataset that also accepts ``(idx, *extra)`` indices.
+
+    Samplers such as :class:`BucketBatchSampler` pass extra per-sample
+    arguments together with the index. The global index is mapped to the
+    sub dataset and the extra arguments are forwarded unchanged.
+    """
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            return super(ConcatDataset, self).__getitem__(idx)
+        idx, *extra = idx
+        if idx < 0:
+            idx = len(self) + idx
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        if dataset_idx == 0:
+            sample_idx = idx
+        else:
+            sample_idx = idx - self.cumulative_sizes[dataset_idx - 1]
+        return self.datasets[dataset_idx][(sample_idx, *extra)]
@@ -0,0 +1,81 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 直接提供neck特征的训练集, 用于backbone与neck冻结时只训练PETRHead3D
+#   python tools/dataset_converters/build_feat_cache.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py xxx.pth /path/to/feat_cache --flip
+#   data = dict(train=dict(type='opera.FeatCacheDataset',
+#                          cache_root='/path/to/feat_cache'))
+import numpy as np
+import torch
+from mmcv.parallel import DataContainer as DC
+from mmdet.datasets.pipelines.formatting import to_tensor
+from torch.utils.data import Dataset
+
+from .builder import DATASETS
+from .smap_utils.feat_cache import FeatShardReader
+
+
+@DATASETS.register_module()
+class FeatCacheDataset(Dataset):
+    """读取build_feat_cache.py生成的特征缓存, 每个样本的 ``img`` 为各层
+    neck特征组成的list, 由PETR3D直接送入head。
+
+    缓存中每张图像只有固定的几个视角(原图, 以及可选的水平翻转), 训练时
+    随机选择一个, 没有其它数据增强。gt与img_metas在生成缓存时已经按照
+    对应视角的pipeline处理好。特征只对生成缓存时的backbone与neck权重有效,
+    模型需要设置 ``freeze_feat=True`` 并加载相同的权重。
+    不支持BucketBatchSampler。
+
+    Args:
+        cache_root (str): build_feat_cache.py 的输出目录。
+        random_view (bool): 训练时是否在缓存的视角中随机选择, 否则总是使用
+            第一个视角(原图)。Default: True.
+        test_mode (bool): 与CustomDataset相同, 为True时总是使用原图。
+            Default: False.
+    """
+    CLASSES = ('person', )
+
+    def __init__(self, cache_root, random_view=True, test_mode=False):
+        self.reader = FeatShardReader(cache_root)
+        self.samples = self.reader.samples
+        self.views = self.reader.index['views']
+        self.random_view = random_view
+        self.test_mode = test_mode
+        self._set_group_flag()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _set_group_flag(self):
+        """与CustomDataset相同, 按宽高比分组, 供GroupSampler使用"""
+        self.flag = np.zeros(len(self), dtype=np.uint8)
+        for i, sample in enumerate(self.samples):
+            img_h, img_w = sample['views'][0]['img_meta']['img_shape'][:2]
+            if img_w / img_h > 1:
+                self.flag[i] = 1
+
+    def __getitem__(self, idx):
+        views = self.samples[idx]['views']
+        if self.random_view and not self.test_mode and len(views) > 1:
+            view = views[np.random.randint(len(views))]
+        else:
+            view = views[0]
+        # 从memmap中拷贝出来, 保持float16, 在模型中转换类型
+        feats = [
+            torch.from_numpy(np.array(feat))
+            for feat in self.reader.get(view['feat'])
+        ]
+        # forward_train会修改img_meta, 这里使用拷贝
+        data = dict(
+            img=DC(feats, stack=False),
+            img_metas=DC(dict(view['img_meta']), cpu_only=True))
+        for key, value in view.items():
+            if key in ('feat', 'img_meta'):
+                continue
+            data[key] = DC(to_tensor(value)) \
+                if isinstance(value, np.ndarray) else value
+        return data
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(cache_root='
+                f'{self.reader.cache_root}, num_samples={len(self)}, '
+                f'views={self.views})')
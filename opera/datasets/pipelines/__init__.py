@@ -1,9 +1,10 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
+from .compose import InstrumentedCompose
 from .formatting import DefaultFormatBundle
 from .loading import LoadAnnotations
 from .transforms import (Resize, RandomFlip, RandomCrop, KeypointRandomAffine)
 
 __all__ = [
     'DefaultFormatBundle', 'LoadAnnotations', 'Resize', 'RandomFlip',
-    'RandomCrop', 'KeypointRandomAffine'
+    'RandomCrop', 'KeypointRandomAffine', 'InstrumentedCompose'
 ]
@@ -0,0 +1,4 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+from .bucket_sampler import BucketBatchSampler
+
+__all__ = ['BucketBatchSampler']
@@ -0,0 +1,175 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import math
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def _get_data_infos(dataset):
+    """按照全局索引顺序返回data_infos, 兼容ConcatDataset"""
+    if hasattr(dataset, 'datasets'):
+        data_infos = []
+        for d in dataset.datasets:
+            data_infos.extend(_get_data_infos(d))
+        return data_infos
+    return dataset.data_infos
+
+
+class BucketBatchSampler(Sampler):
+    """Bucket samples by the predicted shape after augmentation.
+
+    Samples are grouped by aspect ratio and each batch shares one scale
+    pre-sampled here. The scale is passed to the pipeline together with the
+    index, i.e. ``dataset[(idx, scale)]``, and consumed by ``AugResize``
+    with ``allow_preset_scale=True``. Images in a batch therefore end up with
+    similar shapes and ``mmdet.Pad`` adds far less padding. Every resize that
+    determines the final shape needs ``allow_preset_scale=True``; in the crop
+    branch of AutoAugment ``AugCrop(allow_preset_scale=True)`` also keeps the
+    aspect ratio of the image, otherwise the cropped shape is unrelated to
+    the bucket.
+
+    The epoch advances at the end of every pass, so different epochs get
+    different batches without ``DistSamplerSeedHook`` (non-distributed
+    training). ``set_epoch`` still overrides it.
+
+    Batches are formed in steps of ``num_replicas`` batches taken from the
+    same bucket, and every rank takes its own batch of each step, so the
+    sampler works for both distributed and non-distributed training.
+
+    If ``dataset_ratio`` is given, buckets are also split by the source
+    dataset ('COCO' / 'MUCO'), so every batch on every rank of a step comes
+    from the same dataset. Steps are drawn from each dataset with the given
+    ratio; a dataset is reshuffled and reused once its steps run out. Paired
+    with ``PETRHead3D(skip_empty_depth=True)`` this skips all depth work on
+    COCO-only steps.
+
+    Args:
+        dataset (Dataset): JointDataset or ConcatDataset of JointDataset.
+        samples_per_gpu (int): Batch size of each rank.
+        num_replicas (int): Number of processes. Default: 1.
+        rank (int): Rank of the current process. Default: 0.
+        seed (int): Random seed. Default: 0.
+        aspect_ratio_bins (list[float]): Boundaries of the w / h buckets.
+        img_scale (list[tuple]): ``[(long, short_min), (long, short_max)]``,
+            the scale range used by AugResize in 'range' mode.
+        dataset_ratio (dict, optional): Sampling ratio of each dataset,
+            e.g. ``dict(COCO=1, MUCO=1)``. Default: None, batches may mix
+            datasets.
+    """
+
+    def __init__(self,
+                 dataset,
+                 samples_per_gpu,
+                 num_replicas=1,
+                 rank=0,
+                 seed=0,
+                 aspect_ratio_bins=(0.6, 0.8, 1.0, 1.25, 1.6),
+                 img_scale=((1400, 400), (1400, 1400)),
+                 dataset_ratio=None):
+        self.dataset = dataset
+        self.samples_per_gpu = samples_per_gpu
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed if seed is not None else 0
+        self.epoch = 0
+        self.aspect_ratio_bins = list(aspect_ratio_bins)
+        self.long_edge = max(max(s) for s in img_scale)
+        self.short_edge_range = (min(min(s) for s in img_scale),
+                                 max(min(s) for s in img_scale))
+
+        data_infos = _get_data_infos(dataset)
+        assert len(data_infos) == len(dataset)
+        self.widths = np.array([info['img_width'] for info in data_infos],
+                               dtype=np.float32)
+        self.heights = np.array([info['img_height'] for info in data_infos],
+                                dtype=np.float32)
+        # 同一个batch共享scale, keep_ratio缩放后的尺寸只由宽高比决定
+        self.bucket_ids = np.digitize(self.widths / self.heights,
+                                      self.aspect_ratio_bins)
+        self.step_size = self.samples_per_gpu * self.num_replicas
+
+        self.dataset_ratio = dataset_ratio
+        if dataset_ratio is not None:
+            names = np.array(
+                [info['dataset'].upper() for info in data_infos])
+            self.dataset_names = sorted(
+                {k.upper() for k, v in dataset_ratio.items() if v > 0})
+            for name in self.dataset_names:
+                assert (names == name).any(), \
+                    f'no sample of {name} in the dataset'
+            self.dataset_ids = np.full(len(names), -1, dtype=np.int64)
+            for i, name in enumerate(self.dataset_names):
+                self.dataset_ids[names == name] = i
+            ratio = np.array([
+                {k.upper(): v for k, v in dataset_ratio.items()}[name]
+                for name in self.dataset_names], dtype=np.float64)
+            self.dataset_probs = ratio / ratio.sum()
+            # 不在dataset_ratio中的数据集不参与采样
+            valid = self.dataset_ids >= 0
+            self.bucket_ids = np.where(
+                valid,
+                self.dataset_ids * (len(self.aspect_ratio_bins) + 1) +
+                self.bucket_ids, -1)
+        self.num_steps = sum(
+            int(math.ceil(count / self.step_size))
+            for count in np.bincount(self.bucket_ids[self.bucket_ids >= 0])
+            if count > 0)
+
+    def _get_bucket_steps(self, rng, indices):
+        """将一个bucket中的索引切分为若干个step, 不足的部分循环补齐"""
+        indices = indices[rng.permutation(len(indices))]
+        num_steps = int(math.ceil(len(indices) / self.step_size))
+        total_size = num_steps * self.step_size
+        indices = np.resize(indices, total_size)
+        return list(indices.reshape(num_steps, self.step_size))
+
+    def _get_shuffled_steps(self, rng, bucket_ids):
+        steps = []
+        for bucket_id in bucket_ids:
+            indices = np.flatnonzero(self.bucket_ids == bucket_id)
+            steps.extend(self._get_bucket_steps(rng, indices))
+        return [steps[i] for i in rng.permutation(len(steps))]
+
+    def _get_steps(self, rng):
+        bucket_ids = np.unique(self.bucket_ids[self.bucket_ids >= 0])
+        if self.dataset_ratio is None:
+            return self._get_shuffled_steps(rng, bucket_ids)
+
+        num_bins = len(self.aspect_ratio_bins) + 1
+        dataset_bucket_ids = [
+            bucket_ids[bucket_ids // num_bins == i]
+            for i in range(len(self.dataset_names))]
+        dataset_steps = [[] for _ in self.dataset_names]
+        steps = []
+        for dataset_id in rng.choice(
+                len(self.dataset_names), self.num_steps,
+                p=self.dataset_probs):
+            if len(dataset_steps[dataset_id]) == 0:
+                dataset_steps[dataset_id] = self._get_shuffled_steps(
+                    rng, dataset_bucket_ids[dataset_id])
+            steps.append(dataset_steps[dataset_id].pop())
+        return steps
+
+    def __iter__(self):
+        # 所有rank使用相同的随机数, 保证step的划分与scale一致
+        rng = np.random.RandomState(self.seed + self.epoch)
+        for step in self._get_steps(rng):
+            short_edge = int(rng.randint(self.short_edge_range[0],
+                                         self.short_edge_range[1] + 1))
+            scale = (self.long_edge, short_edge)
+            batch = step[self.rank * self.samples_per_gpu:
+                         (self.rank + 1) * self.samples_per_gpu]
+            yield [(int(idx), scale) for idx in batch]
+        # 非分布式训练时没有DistSamplerSeedHook调用set_epoch
+        self.epoch += 1
+
+    def __len__(self):
+        return self.num_steps
+
+    @property
+    def sampler(self):
+        # DistSamplerSeedHook 通过 batch_sampler.sampler.set_epoch 设置epoch
+        return self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -0,0 +1,151 @@
+# neck特征缓存
+#   离线工具(tools/dataset_converters/build_feat_cache.py)用冻结的backbone+neck
+#   计算每张训练图像(固定尺度, 可选翻转)的多层特征, 以float16顺序写入若干个
+#   shard文件, 并生成记录偏移、shape与gt的index.pkl。
+#   训练时通过np.memmap按样本读取, 只训练head时不需要再运行backbone。
+import os
+import os.path as osp
+
+import mmcv
+import numpy as np
+
+FEAT_CACHE_INDEX = 'index.pkl'
+FEAT_CACHE_VERSION = 1
+FEAT_DTYPE = np.float16
+
+
+class FeatShardWriter:
+    """顺序写入多层特征。
+
+    Args:
+        out_dir (str): 输出目录。
+        shard_size (int): 每个shard文件的大致大小(MB)。Default: 4096.
+    """
+
+    def __init__(self, out_dir, shard_size=4096):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_size * 1024 * 1024
+        mmcv.mkdir_or_exist(out_dir)
+        # 之前的缓存在close之前不可读, 避免读到不完整的文件
+        if osp.exists(osp.join(out_dir, FEAT_CACHE_INDEX)):
+            os.remove(osp.join(out_dir, FEAT_CACHE_INDEX))
+        self.shards = []
+        self.total_bytes = 0
+        self._fp = None
+        self._offset = 0
+
+    def add(self, feats):
+        """写入一个样本的各层特征。
+
+        Args:
+            feats (Sequence[np.ndarray]): 每层的特征, shape为(C, H, W)。
+
+        Returns:
+            list: [shard_id, 字节偏移, 每层的shape], 由 FeatShardReader.get 读取。
+        """
+        feats = [np.ascontiguousarray(feat, dtype=FEAT_DTYPE) for feat in feats]
+        if self._fp is None or self._offset >= self.shard_bytes:
+            if self._fp is not None:
+                self._fp.close()
+            self.shards.append(f'shard_{len(self.shards):05d}.bin')
+            self._fp = open(osp.join(self.out_dir, self.shards[-1]), 'wb')
+            self._offset = 0
+        offset = self._offset
+        for feat in feats:
+            self._fp.write(feat.tobytes())
+            self._offset += feat.nbytes
+        self.total_bytes += self._offset - offset
+        return [len(self.shards) - 1, offset, [list(feat.shape) for feat in feats]]
+
+    def close(self, **meta):
+        """写入index, ``meta`` 中的内容(例如samples)一起保存"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        index = dict(
+            version=FEAT_CACHE_VERSION,
+            dtype=np.dtype(FEAT_DTYPE).name,
+            shards=self.shards,
+            **meta)
+        tmp_path = osp.join(self.out_dir, FEAT_CACHE_INDEX + '.tmp')
+        mmcv.dump(index, tmp_path, file_format='pkl')
+        os.replace(tmp_path, osp.join(self.out_dir, FEAT_CACHE_INDEX))
+
+
+class FeatShardReader:
+    """读取neck特征缓存。
+
+    index.pkl格式:
+        {
+            'version': 1,
+            'dtype': 'float16',
+            'shards': ['shard_00000.bin', ...],
+            'views': ['orig', 'flip'],
+            'samples': [{'views': [{'feat': [shard_id, offset, shapes],
+                                    'img_meta': dict, 'gt_bboxes': ndarray,
+                                    ..., 'dataset': 'MUCO'}, ...]}, ...],
+            'config': str, 'checkpoint': str, ...
+        }
+
+    memmap在每个进程中懒加载, 因此可以安全地传递给dataloader的worker。
+
+    Args:
+        cache_root (str): build_feat_cache.py 的输出目录。
+    """
+
+    def __init__(self, cache_root):
+        self.cache_root = cache_root
+        self.index = mmcv.load(osp.join(cache_root, FEAT_CACHE_INDEX))
+        assert self.index.get('version') == FEAT_CACHE_VERSION, \
+            f"unsupported feat cache version: {self.index.get('version')}"
+        self.dtype = np.dtype(self.index['dtype'])
+        self.shards = self.index['shards']
+        self.samples = self.index['samples']
+        self._maps = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _get_map(self, shard_id):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._maps = dict()
+            self._pid = pid
+        data = self._maps.get(shard_id)
+        if data is None:
+            data = np.memmap(
+                osp.join(self.cache_root, self.shards[shard_id]),
+                dtype=self.dtype,
+                mode='r')
+            self._maps[shard_id] = data
+        return data
+
+    def get(self, item):
+        """读取一个样本的各层特征。
+
+        Args:
+            item (list): FeatShardWriter.add 的返回值。
+
+        Returns:
+            list[np.ndarray]: 每层的特征, 为memmap的只读视图。
+        """
+        shard_id, offset, shapes = item
+        data = self._get_map(shard_id)
+        start = offset // self.dtype.itemsize
+        feats = []
+        for shape in shapes:
+            size = int(np.prod(shape))
+            feats.append(data[start:start + size].reshape(shape))
+            start += size
+        return feats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        state['_pid'] = None
+        return state
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(cache_root={self.cache_root}, '
+                f'num_samples={len(self)}, num_shards={len(self.shards)})')
@@ -0,0 +1,137 @@
+# 预缩放图像缓存
+#   离线工具(tools/dataset_converters/build_img_cache.py)将图像缩放到最大训练尺度后,
+#   顺序写入若干个大的shard文件, 并生成记录字节偏移的index.json。
+#   训练时每张图像只需要一次pread, 避免在网络文件系统上频繁打开大量小文件。
+import copy
+import os
+import os.path as osp
+
+import mmcv
+
+CACHE_INDEX = 'index.json'
+CACHE_VERSION = 1
+
+
+def rescale_ann_info(ann_info, scale_w, scale_h):
+    """按照缓存图像的缩放比例修改SMAP格式的注释。
+
+    bodys中的[x, y]与相机内参[fx, fy, cx, cy]同时缩放, 因此
+    depth target (Z / img_scale / fx) 与 evaluate 中的反投影结果保持不变。
+    3D坐标[X, Y, Z]与深度Z不受影响。
+
+    Args:
+        ann_info (dict): data_infos中的一项。
+        scale_w (float): 宽度方向的缩放比例。
+        scale_h (float): 高度方向的缩放比例。
+    Returns:
+        dict: 缩放之后的注释(深拷贝, 不修改原始注释)。
+    """
+    ann_info = copy.deepcopy(ann_info)
+    if scale_w == 1. and scale_h == 1.:
+        return ann_info
+    ann_info['img_width'] = int(round(ann_info['img_width'] * scale_w))
+    ann_info['img_height'] = int(round(ann_info['img_height'] * scale_h))
+    for body in ann_info['bodys']:
+        for kpt in body:
+            # [x, y, Z, v, X, Y, Z, fx, fy, cx, cy]
+            kpt[0] *= scale_w
+            kpt[1] *= scale_h
+            kpt[7] *= scale_w
+            kpt[8] *= scale_h
+            kpt[9] *= scale_w
+            kpt[10] *= scale_h
+    for bbox in ann_info['bboxs']:
+        # [x, y, w, h]
+        bbox[0] *= scale_w
+        bbox[1] *= scale_h
+        bbox[2] *= scale_w
+        bbox[3] *= scale_h
+    if 'areas' in ann_info:
+        ann_info['areas'] = [
+            area * scale_w * scale_h for area in ann_info['areas']]
+    return ann_info
+
+
+class ImgShardReader:
+    """读取预缩放的图像缓存。
+
+    index.json格式:
+        {
+            'version': 1,
+            'max_scale': [long_edge, short_edge],
+            'shards': ['shard_00000.bin', ...],
+            'images': {img_paths: [shard_id, offset, length, scale_w, scale_h]}
+        }
+
+    文件描述符在每个进程中懒加载, 因此可以安全地传递给dataloader的worker。
+
+    Args:
+        cache_root (str): build_img_cache.py 的输出目录。
+    """
+
+    def __init__(self, cache_root):
+        self.cache_root = cache_root
+        index = mmcv.load(osp.join(cache_root, CACHE_INDEX))
+        assert index.get('version') == CACHE_VERSION, \
+            f"unsupported img cache version: {index.get('version')}"
+        self.max_scale = index['max_scale']
+        self.shards = index['shards']
+        self.images = index['images']
+        self._fds = None
+        self._pid = None
+
+    def __contains__(self, img_path):
+        return img_path in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def get_scale(self, img_path):
+        """返回(scale_w, scale_h)"""
+        item = self.images[img_path]
+        return item[3], item[4]
+
+    def _get_fd(self, shard_id):
+        pid = os.getpid()
+        if self._pid != pid:
+            # fork之后不能复用父进程的文件描述符偏移之外的状态, 重新打开
+            self._fds = dict()
+            self._pid = pid
+        fd = self._fds.get(shard_id)
+        if fd is None:
+            fd = os.open(osp.join(self.cache_root, self.shards[shard_id]),
+                         os.O_RDONLY)
+            self._fds[shard_id] = fd
+        return fd
+
+    def get(self, img_path):
+        """读取编码后的图像字节"""
+        shard_id, offset, length = self.images[img_path][:3]
+        fd = self._get_fd(shard_id)
+        img_bytes = os.pread(fd, length, offset)
+        assert len(img_bytes) == length, \
+            f"truncated read of {img_path} from {self.shards[shard_id]}"
+        return img_bytes
+
+    def close(self):
+        if self._fds is not None and self._pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+        self._fds = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fds'] = None
+        state['_pid'] = None
+        return state
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(cache_root={self.cache_root}, '
+                f'num_images={len(self)}, num_shards={len(self.shards)})')
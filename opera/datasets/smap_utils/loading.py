@@ -44,7 +44,12 @@ class LoadImgFromFile:
         else:
             raise ValueError("img_prefix 不能为空。")
         
-        img_bytes = self.file_client.get(filepath)
+        img_cache = results.get('img_cache', None)
+        if img_cache is not None:
+            # 预缩放的图像缓存, 一次pread读取
+            img_bytes = img_cache.get(results['ann_info']['img_paths'])
+        else:
+            img_bytes = self.file_client.get(filepath)
         img = mmcv.imfrombytes(
             img_bytes, flag=self.color_type, channel_order=self.channel_order)
         
@@ -0,0 +1,192 @@
+# 3D姿态结果文件
+#   JointDataset.evaluate 原先将 3d_pairs 以缩进的json保存, 测试集完整结果有几百MB,
+#   写入与解析都很慢。这里按列保存为若干个原始数组文件:
+#       <path>/index.json       版本、列的dtype与shape、每张图像的偏移与路径
+#       <path>/<column>.bin     所有人依次拼接, 例如 pred_3d.bin: [num_people, 15, 4]
+#   写入时逐张图像追加, 读取时通过np.memmap按图像随机访问。
+#   流式评测(JointDataset.get_evaluator(result_path=...))时在推理过程中写入,
+#   分布式测试时每个rank写入 <path>/rank_<rank>/, 读取时合并。
+import glob
+import json
+import os
+import os.path as osp
+from collections import OrderedDict
+
+import mmcv
+import numpy as np
+
+RESULT_INDEX = 'index.json'
+RESULT_VERSION = 1
+# 列名 -> 每个人的shape
+RESULT_COLUMNS = OrderedDict(
+    pred_2d=(15, 4), pred_3d=(15, 4), root_d=(), gt_2d=(16, 4), gt_3d=(16, 7))
+# float16时只压缩预测值, gt保持float32
+HALF_COLUMNS = ('pred_2d', 'pred_3d')
+
+
+class Pose3DResultWriter:
+    """逐张图像写入3D姿态结果。
+
+    Args:
+        path (str): 输出目录。
+        float16 (bool): 预测值(pred_2d, pred_3d)是否保存为float16, 坐标最大
+            约为2048像素与1000cm时的误差分别在1像素与0.5cm左右。Default: False.
+        model_pattern (str): 写入index的模型名称, 与legacy json一致。
+    """
+
+    def __init__(self, path, float16=False, model_pattern='JointDataset'):
+        self.path = path
+        self.model_pattern = model_pattern
+        self.dtypes = OrderedDict(
+            (name, 'float16' if float16 and name in HALF_COLUMNS else
+             'float32') for name in RESULT_COLUMNS)
+        mmcv.mkdir_or_exist(path)
+        # 之前的结果在close之前不可读, 避免读到不完整的文件
+        if osp.exists(osp.join(path, RESULT_INDEX)):
+            os.remove(osp.join(path, RESULT_INDEX))
+        self._fps = OrderedDict(
+            (name, open(osp.join(path, f'{name}.bin'), 'wb'))
+            for name in RESULT_COLUMNS)
+        self.offsets = [0]
+        self.image_paths = []
+
+    def add(self, pair):
+        """写入一张图像的结果, pair 与 3d_pairs 中的一项格式相同, 值为
+        JointDataset._match_single 输出的numpy数组, dtype相同时不再拷贝"""
+        num_people = len(pair['root_d'])
+        for name, shape in RESULT_COLUMNS.items():
+            array = pair[name].astype(self.dtypes[name], copy=False)
+            array = array.reshape((num_people, ) + shape)
+            np.ascontiguousarray(array).tofile(self._fps[name])
+        self.offsets.append(self.offsets[-1] + num_people)
+        self.image_paths.append(pair['image_path'])
+
+    def close(self):
+        if self._fps is None:
+            return
+        for fp in self._fps.values():
+            fp.close()
+        self._fps = None
+        index = dict(
+            version=RESULT_VERSION,
+            model_pattern=self.model_pattern,
+            columns=OrderedDict(
+                (name, dict(dtype=self.dtypes[name], shape=list(shape)))
+                for name, shape in RESULT_COLUMNS.items()),
+            offsets=self.offsets,
+            image_paths=self.image_paths)
+        tmp_path = osp.join(self.path, RESULT_INDEX + '.tmp')
+        mmcv.dump(index, tmp_path, file_format='json')
+        os.replace(tmp_path, osp.join(self.path, RESULT_INDEX))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Pose3DResultReader:
+    """按图像随机访问3D姿态结果。
+
+    ``reader[i]`` 返回与 3d_pairs 中的一项相同的字典, 值为numpy数组。
+    分布式流式评测时每个rank写入 ``path/rank_{rank}``, 这里按rank的顺序
+    合并, 图像的顺序与数据集不同。
+
+    Args:
+        path (str): Pose3DResultWriter 的输出目录。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = None
+        if not osp.exists(osp.join(path, RESULT_INDEX)):
+            part_dirs = glob.glob(osp.join(path, 'rank_*'))
+            if part_dirs:
+                self._init_parts(part_dirs)
+                return
+        index = mmcv.load(osp.join(path, RESULT_INDEX))
+        assert index.get('version') == RESULT_VERSION, \
+            f"unsupported result version: {index.get('version')}"
+        self.model_pattern = index['model_pattern']
+        self.offsets = np.asarray(index['offsets'], dtype=np.int64)
+        self.image_paths = index['image_paths']
+        self.columns = OrderedDict()
+        self.num_people = num_people = int(self.offsets[-1])
+        for name, col in index['columns'].items():
+            shape = (num_people, ) + tuple(col['shape'])
+            if num_people == 0:
+                self.columns[name] = np.zeros(shape, dtype=col['dtype'])
+            else:
+                self.columns[name] = np.memmap(
+                    osp.join(path, f'{name}.bin'),
+                    dtype=col['dtype'],
+                    mode='r',
+                    shape=shape)
+
+    def _init_parts(self, part_dirs):
+        part_dirs = sorted(
+            part_dirs, key=lambda d: int(osp.basename(d).split('_')[-1]))
+        self.parts = [Pose3DResultReader(d) for d in part_dirs]
+        self.model_pattern = self.parts[0].model_pattern
+        self.image_paths = [
+            p for part in self.parts for p in part.image_paths
+        ]
+        # 每个part第一张图像的索引
+        self.part_starts = np.cumsum([0] + [len(p) for p in self.parts])
+        self.num_people = sum(p.num_people for p in self.parts)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'index {idx} out of range')
+        if self.parts is not None:
+            part = int(np.searchsorted(self.part_starts, idx, 'right')) - 1
+            return self.parts[part][idx - self.part_starts[part]]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        pair = dict(
+            (name, np.asarray(col[start:end], dtype=np.float64))
+            for name, col in self.columns.items())
+        pair['image_path'] = self.image_paths[idx]
+        return pair
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_legacy_json(self, out_file, indent=4):
+        """转换为原先 JointDataset.evaluate 输出的 output.json"""
+        output = dict()
+        output['model_pattern'] = self.model_pattern
+        output['3d_pairs'] = []
+        for pair in self:
+            output['3d_pairs'].append(
+                dict(
+                    pred_2d=pair['pred_2d'].tolist(),
+                    pred_3d=pair['pred_3d'].tolist(),
+                    root_d=pair['root_d'].tolist(),
+                    image_path=pair['image_path'],
+                    gt_3d=pair['gt_3d'].tolist(),
+                    gt_2d=pair['gt_2d'].tolist()))
+        with open(out_file, 'w') as fp:
+            json.dump(output, fp, indent=indent)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(path={self.path}, '
+                f'num_images={len(self)}, num_people={self.num_people})')
+
+
+def load_pose3d_pairs(path):
+    """读取3D姿态结果, 兼容legacy output.json 与 Pose3DResultWriter 的输出目录。
+
+    Returns:
+        Sequence[dict]: 3d_pairs
+    """
+    if osp.isdir(path):
+        return Pose3DResultReader(path)
+    with open(path, 'r') as f:
+        return json.load(f)['3d_pairs']
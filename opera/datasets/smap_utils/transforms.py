@@ -270,9 +270,20 @@ class AugResize(MMDetResize):
     def __init__(self, 
                     *args,
                     keypoint_clip_border=True,
+                    allow_preset_scale=False,
                     **kwargs):
         super(AugResize, self).__init__(*args, **kwargs)
         self.keypoint_clip_border = keypoint_clip_border
+        # 使用BucketBatchSampler预先采样的尺度, 同一个batch的图像尺寸接近
+        self.allow_preset_scale = allow_preset_scale
+
+    def _random_scale(self, results):
+        if self.allow_preset_scale and \
+                results.get('preset_scale', None) is not None:
+            results['scale'] = tuple(results['preset_scale'])
+            results['scale_idx'] = None
+            return
+        super(AugResize, self)._random_scale(results)
     
     def _resize_img(self, results):
         """Resize img
@@ -377,7 +388,8 @@ class AugResize(MMDetResize):
 
     def __repr__(self):
         repr_str = super(AugResize, self).__repr__()[:-1] + ', '
-        repr_str += f'keypoint_clip_border={self.keypoint_clip_border})'
+        repr_str += f'keypoint_clip_border={self.keypoint_clip_border}, '
+        repr_str += f'allow_preset_scale={self.allow_preset_scale})'
         return repr_str
 
 
@@ -386,23 +398,113 @@ class AugCrop(MMDetRandomCrop):
     """随机裁剪 img, bbox, keypoints
     存在的问题：
         如果keypoints被裁剪，而COCO数据集的areas未做对应处理
+    Args:
+        allow_preset_scale (bool): 存在BucketBatchSampler预先采样的尺度时,
+            裁剪区域保持输入图像的宽高比, 之后的AugResize得到与分桶一致的
+            尺寸。否则裁剪后的宽高比与原图无关, 无法按宽高比分桶。
+            Default: False.
     """
     def __init__(self, 
                     *args,
                     kpt_clip_border=True,
+                    max_trials=10,
+                    allow_preset_scale=False,
                     **kwargs):
         super(AugCrop, self).__init__(*args, **kwargs)
         self.kpt_clip_border = kpt_clip_border
+        self.max_trials = max_trials
+        self.allow_preset_scale = allow_preset_scale
+
+    @staticmethod
+    def _keep_ratio_crop_size(img_shape, crop_size):
+        """以crop_size的高度为准, 调整宽度使裁剪区域与图像的宽高比相同"""
+        img_h, img_w = img_shape[:2]
+        crop_h = min(crop_size[0], img_h)
+        crop_w = int(round(crop_h * img_w / img_h))
+        if crop_w > img_w:
+            crop_w = img_w
+            crop_h = min(int(round(crop_w * img_h / img_w)), img_h)
+        return max(crop_h, 1), max(crop_w, 2)
+
+    @staticmethod
+    def _crop_bboxes(bboxes, offset_w, offset_h, img_shape):
+        """平移bbox并限制在裁剪后的图像内, 返回(bboxes, 不退化的mask)"""
+        bbox_offset = np.array([offset_w, offset_h, offset_w, offset_h],
+                                dtype=np.float32)
+        bboxes = bboxes - bbox_offset  # 注意这里是减去偏移。
+        # 判断是否超出范围, 这里要确保bbox中的数据满足[x1, y1, x2, y2]
+        bboxes[:, 0::2] = np.clip(bboxes[:, 0::2], 0, img_shape[1])
+        bboxes[:, 1::2] = np.clip(bboxes[:, 1::2], 0, img_shape[0])
+        valid_inds = (bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])
+        return bboxes, valid_inds
+
+    @staticmethod
+    def _crop_keypoints(keypoints, vis_flag, offset_w, offset_h):
+        """平移keypoints [N, J, 11], 不可见与越界(<0)的关键点置零"""
+        kpt_offset = np.array([offset_w, offset_h], dtype=np.float32)
+        keypoints = keypoints.copy()
+        for i in range(len(keypoints)):
+            keypoints[i][:, :2] = \
+                keypoints[i][:, :2] - kpt_offset  # x, y - oofset_x, offset_y
+                
+            kpt_vis_flag = vis_flag[i] > 0
+            for j in range(15):
+                if not kpt_vis_flag[i]:
+                    keypoints[i][j] = np.asarray([0.0 for _ in range(11)])
+            # 越界处理
+            valid_inds = (keypoints[i][:, 0] >= 0.0) & \
+                (keypoints[i][:, 1] >= 0.0)
+            assert valid_inds.shape == kpt_vis_flag.shape, \
+                f"valid_ids.shape:{valid_inds.shape}, kpt_vis_flag.shape:{kpt_vis_flag.shape}"
+            keypoints[i][~ valid_inds] = np.asarray([0.0 for _ in range(11)], dtype=np.float32)
+            # TODO 这里没有进一步处理 gt_vis_flag，最后重新生成
+        return keypoints
+
+    def _crop_has_valid_gt(self, results, offset_w, offset_h, crop_size):
+        """在裁剪图像之前预测裁剪后是否还有有效的人。
+
+        直接调用_crop_data使用的_crop_bboxes与_crop_keypoints, 判断条件为
+        AugPostProcess删除人的规则: bbox不退化且至少一个关键点vis>0。
+        没有模拟AugPostProcess中把关键点坐标clip到图像内的操作,
+        它只修改坐标, 不影响vis。
+        """
+        img_h, img_w = results['img'].shape[:2]
+        # 与_crop_data中切片后的图像尺寸相同
+        img_shape = (min(crop_size[0], img_h - offset_h),
+                     min(crop_size[1], img_w - offset_w))
+        _, valid_inds = self._crop_bboxes(results['gt_bboxes'], offset_w,
+                                          offset_h, img_shape)
+        if not valid_inds.any():
+            return False
+        keypoints = self._crop_keypoints(results['gt_keypoints'][valid_inds],
+                                         results['gt_vis_flag'][valid_inds],
+                                         offset_w, offset_h)
+        return bool((keypoints[..., 3] > 0).any())
+
+    def _sample_offset(self, results, crop_size):
+        """采样裁剪位置, 在裁剪图像之前先用几何信息检查是否为空,
+        为空时重新采样, 避免整条pipeline在JointDataset中重试。
+        """
+        img_shape = results['img'].shape
+        margin_h = max(img_shape[0] - crop_size[0], 0)
+        margin_w = max(img_shape[1] - crop_size[1], 0)
+        for _ in range(self.max_trials):
+            offset_h = np.random.randint(0, margin_h + 1)
+            offset_w = np.random.randint(0, margin_w + 1)
+            if self._crop_has_valid_gt(results, offset_w, offset_h, crop_size):
+                break
+        return offset_h, offset_w
         
     def _crop_data(self, results, crop_size, allow_negative_crop):
+        if self.allow_preset_scale and \
+                results.get('preset_scale', None) is not None:
+            crop_size = self._keep_ratio_crop_size(results['img'].shape,
+                                                   crop_size)
         assert crop_size[0] > 0 and crop_size[1] > 1 , \
             "crop size 不符合范围"
+        offset_h, offset_w = self._sample_offset(results, crop_size)
         for key in results.get('img_fields', ['img']):
             img = results[key]
-            margin_h = max(img.shape[0] - crop_size[0], 0)
-            margin_w = max(img.shape[1] - crop_size[1], 0)
-            offset_h = np.random.randint(0, margin_h + 1)
-            offset_w = np.random.randint(0, margin_w + 1)
             crop_y1, crop_y2 = offset_h, offset_h + crop_size[0]
             crop_x1, crop_x2 = offset_w, offset_w + crop_size[1]
             
@@ -414,15 +516,9 @@ class AugCrop(MMDetRandomCrop):
 
         # crop bboxes accordingly and clip to the image boundary
         for key in results.get('bbox_fields', ['gt_bboxes']):
-            bboxes = results[key].copy()  # [num_persons, 4]
-            bbox_offset = np.array([offset_w, offset_h, offset_w, offset_h],
-                                    dtype=np.float32)
-            bboxes = bboxes - bbox_offset  # 注意这里是减去偏移。
-            # 判断是否超出范围, 这里要确保bbox中的数据满足[x1, y1, x2, y2]
-            bboxes[:, 0::2] = np.clip(bboxes[:, 0::2], 0, img_shape[1])
-            bboxes[:, 1::2] = np.clip(bboxes[:, 1::2], 0, img_shape[0])
-
-            valid_inds = (bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])
+            # [num_persons, 4]
+            bboxes, valid_inds = self._crop_bboxes(results[key], offset_w,
+                                                   offset_h, img_shape)
             if (not valid_inds.any() and not allow_negative_crop):
                 print(f"{results['img_prefix']} 裁剪后不包含有效的bbox")
                 return None
@@ -443,24 +539,9 @@ class AugCrop(MMDetRandomCrop):
                 "bbox长度与vis flag长度不一致"
                 
             for key in results.get('keypoint_fields', ['gt_keypoints']):
-                kpt_offset = np.array([offset_w, offset_h], dtype=np.float32)
-                keypoints = results[key].copy()
-                vis_flag = results["gt_vis_flag"].copy()
-                for i in range(len(keypoints)):
-                    keypoints[i][:, :2] = \
-                        keypoints[i][:, :2] - kpt_offset  # x, y - oofset_x, offset_y
-                        
-                    kpt_vis_flag = vis_flag[i] > 0
-                    for j in range(15):
-                        if not kpt_vis_flag[i]:
-                            keypoints[i][j] = np.asarray([0.0 for _ in range(11)])
-                    # 越界处理
-                    valid_inds = (keypoints[i][:, 0] >= 0.0) & \
-                        (keypoints[i][:, 1] >= 0.0)
-                    assert valid_inds.shape == kpt_vis_flag.shape, \
-                        f"valid_ids.shape:{valid_inds.shape}, kpt_vis_flag.shape:{kpt_vis_flag.shape}"
-                    keypoints[i][~ valid_inds] = np.asarray([0.0 for _ in range(11)], dtype=np.float32)
-                    # TODO 这里没有进一步处理 gt_vis_flag，最后重新生成
+                keypoints = self._crop_keypoints(results[key],
+                                                 results["gt_vis_flag"],
+                                                 offset_w, offset_h)
                 assert keypoints.shape[-1] == 11 and keypoints.shape[-2] == 15, \
                     f"error in process keypoints, keypoints.shape: {keypoints.shape}"
                 results[key] = keypoints
@@ -472,7 +553,9 @@ class AugCrop(MMDetRandomCrop):
                 
     def __repr__(self):
         repr_str = super(AugCrop, self).__repr__()[:-1] + ', '
-        repr_str += f'kpt_clip_border={self.kpt_clip_border})'
+        repr_str += f'kpt_clip_border={self.kpt_clip_border}, '
+        repr_str += f'max_trials={self.max_trials}, '
+        repr_str += f'allow_preset_scale={self.allow_preset_scale})'
         return repr_str
 
 
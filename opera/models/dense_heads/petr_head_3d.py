@@ -2,6 +2,7 @@
 import copy
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from mmcv.cnn import (Linear, bias_init_with_prob, constant_init, normal_init,
@@ -12,7 +13,8 @@ from mmdet.models.utils.transformer import inverse_sigmoid
 from mmdet.models.dense_heads import AnchorFreeHead
 
 from opera.core.bbox import build_assigner, build_sampler
-from opera.core.keypoint import gaussian_radius, draw_umich_gaussian
+from opera.core.keypoint import gaussian_radius, draw_umich_gaussians
+from opera.core.runner import profile_stage
 from opera.models.utils import build_positional_encoding, build_transformer
 from ..builder import HEADS, build_loss
 
@@ -48,6 +50,21 @@ class PETRHead3D(AnchorFreeHead):
             the outputs of encoder.
         with_kpt_refine (bool): Whether to refine the reference points
             in the decoder. Defaults to True.
+        skip_empty_depth (bool): Whether to skip the depth target and loss
+            computation (including the cross-rank normalizer) for batches
+            without 3D supervision, i.e. COCO-only batches. The decision is
+            all-reduced, so depth is only skipped when no rank has 3D
+            supervision in its batch, which costs one small collective and
+            host sync per iteration. Pair it with `BucketBatchSampler` with
+            `dataset_ratio` so whole steps are COCO-only. Defaults to False.
+        debug (bool): Whether to validate the targets during training
+            (finite depth targets, positive areas, keypoints inside the
+            heatmap). Every check forces a device-to-host synchronization,
+            so it is off by default. Defaults to False.
+        fused_loss (bool): Whether to compute the losses of all decoder
+            layers with one set of batched ops (`loss_all_layers`) instead
+            of mapping `loss_single` over the layers. The loss keys are the
+            same. Defaults to False.
         train_cfg (obj:`mmcv.ConfigDict`|dict): Training config of
             transformer head.
         test_cfg (obj:`mmcv.ConfigDict`|dict): Testing config of
@@ -81,6 +98,9 @@ class PETRHead3D(AnchorFreeHead):
                     as_two_stage=True,
                     with_kpt_refine=True,
                     with_depth_refine=True,
+                    skip_empty_depth=False,
+                    debug=False,
+                    fused_loss=False,
                     train_cfg=dict(
                         assigner=dict(
                             type='PoseHungarianAssigner3D',
@@ -125,6 +145,9 @@ class PETRHead3D(AnchorFreeHead):
         self.as_two_stage = as_two_stage  # True
         self.with_kpt_refine = with_kpt_refine  # True
         self.with_depth_refine = with_depth_refine  
+        self.skip_empty_depth = skip_empty_depth
+        self.debug = debug
+        self.fused_loss = fused_loss
         self.num_keypoints = num_keypoints  # 15
         if self.as_two_stage:
             transformer['as_two_stage'] = self.as_two_stage  
@@ -390,13 +413,15 @@ class PETRHead3D(AnchorFreeHead):
         area_targets, kpt_preds, kpt_targets, kpt_weights, \
             depth_preds, depth_targets, depth_weights = refine_targets  # 打包的数据
         
-        pos_inds = kpt_weights.sum(-1) > 0
-        if pos_inds.sum() == 0:
+        # 正样本的个数决定了refine的shape, 这里只同步一次
+        pos_inds = (kpt_weights.sum(-1) > 0).nonzero().squeeze(1)
+        num_pos = pos_inds.numel()
+        if num_pos == 0:
             pos_kpt_preds = torch.zeros_like(kpt_preds[:1])
             pos_img_inds = kpt_preds.new_zeros([1], dtype=torch.int64)
         else:
             pos_kpt_preds = kpt_preds[pos_inds]
-            pos_img_inds = (pos_inds.nonzero() / self.num_query).squeeze(1).to(
+            pos_img_inds = (pos_inds / self.num_query).to(
                 torch.int64)  # (100)
 
         hs, init_reference, inter_references = self.transformer.forward_refine(
@@ -440,41 +465,43 @@ class PETRHead3D(AnchorFreeHead):
         factors = torch.cat(factors, 0)
         factors = factors[pos_inds][:, :2].repeat(1, kpt_preds.shape[-1] // 2)
 
-        num_valid_kpt = torch.clamp(
-            reduce_mean(kpt_weights.sum()), min=1).item()
-        num_total_pos = kpt_weights.new_tensor([outputs_kpts.size(1)])
-        num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1).item()
+        # normalizer保持为tensor, 避免.item()同步
+        num_valid_kpt = torch.clamp(reduce_mean(kpt_weights.sum()), min=1)
+        num_total_pos = kpt_weights.new_tensor(outputs_kpts.size(1))
+        num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1)
         pos_kpt_weights = kpt_weights[pos_inds]
         pos_kpt_targets = kpt_targets[pos_inds]
         pos_kpt_targets_scaled = pos_kpt_targets * factors
         pos_areas = area_targets[pos_inds]
         pos_valid = kpt_weights[pos_inds, 0::2]
-        for i, kpt_refine_preds in enumerate(outputs_kpts):
-            if pos_inds.sum() == 0:
-                loss_kpt = loss_oks = kpt_refine_preds.sum() * 0
+        if self.debug and num_pos > 0:
+            assert (pos_areas > 0).all(), f'pos_areas: {pos_areas}'
+        with profile_stage('loss_refine'):
+            for i, kpt_refine_preds in enumerate(outputs_kpts):
+                if num_pos == 0:
+                    loss_kpt = loss_oks = kpt_refine_preds.sum() * 0
+                    losses[f'd{i}.loss_kpt_refine'] = loss_kpt
+                    losses[f'd{i}.loss_oks_refine'] = loss_oks
+                    continue
+                # kpt L1 Loss
+                pos_refine_preds = kpt_refine_preds.reshape(
+                    kpt_refine_preds.size(0), -1)  # [num_gts, 30]
+                loss_kpt = self.loss_kpt_refine(
+                    pos_refine_preds,
+                    pos_kpt_targets,
+                    pos_kpt_weights,
+                    avg_factor=num_valid_kpt)
                 losses[f'd{i}.loss_kpt_refine'] = loss_kpt
+                # kpt oks loss
+                pos_refine_preds_scaled = pos_refine_preds * factors
+                loss_oks = self.loss_oks_refine(
+                    pos_refine_preds_scaled,
+                    pos_kpt_targets_scaled,
+                    pos_valid,
+                    pos_areas,
+                    avg_factor=num_total_pos)
                 losses[f'd{i}.loss_oks_refine'] = loss_oks
-                continue
-            # kpt L1 Loss
-            pos_refine_preds = kpt_refine_preds.reshape(
-                kpt_refine_preds.size(0), -1)  # [num_gts, 30]
-            loss_kpt = self.loss_kpt_refine(
-                pos_refine_preds,
-                pos_kpt_targets,
-                pos_kpt_weights,
-                avg_factor=num_valid_kpt)
-            losses[f'd{i}.loss_kpt_refine'] = loss_kpt
-            # kpt oks loss
-            pos_refine_preds_scaled = pos_refine_preds * factors
-            assert (pos_areas > 0).all()
-            loss_oks = self.loss_oks_refine(
-                pos_refine_preds_scaled,
-                pos_kpt_targets_scaled,
-                pos_valid,
-                pos_areas,
-                avg_factor=num_total_pos)
-            losses[f'd{i}.loss_oks_refine'] = loss_oks
-            
+
         return losses
 
     # over-write because img_metas are needed as inputs for bbox_head.
@@ -530,6 +557,18 @@ class PETRHead3D(AnchorFreeHead):
                                         losses, img_metas)
         return losses
 
+    @staticmethod
+    def _any_rank_has_depth(dataset, device):
+        """batch中是否有3D监督, 分布式训练时所有rank取或, 保证各rank执行
+        相同的collective(depth分支中的reduce_mean)"""
+        with_depth = any(d == 'MUCO' for d in dataset)
+        if dist.is_available() and dist.is_initialized() and \
+                dist.get_world_size() > 1:
+            flag = torch.tensor([float(with_depth)], device=device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            with_depth = bool(flag.item())
+        return with_depth
+
     @force_fp32(apply_to=('all_cls_scores', 'all_kpt_preds'))
     def loss(self,
                 all_cls_scores,
@@ -598,14 +637,28 @@ class PETRHead3D(AnchorFreeHead):
         all_gt_areas_list = [gt_areas_list for _ in range(num_dec_layers)]
         dataset_list = [dataset for _ in range(num_dec_layers)]
         img_metas_list = [img_metas for _ in range(num_dec_layers)]
+        # COCO-only的batch没有3D监督, 跳过depth相关的计算
+        with_depth = not self.skip_empty_depth or \
+            self._any_rank_has_depth(dataset, all_cls_scores.device)
+        with_depth_list = [with_depth for _ in range(num_dec_layers)]
+        # gt只补齐一次, 所有decoder层与encoder的proposal共用
+        packed_gts = self._pack_gts(gt_keypoints_list, gt_areas_list)
         # 修改输入，修改返回值
+        if self.fused_loss:
+            loss_outputs = self.loss_all_layers(
+                all_cls_scores, all_kpt_preds, all_depths_preds,
+                gt_labels_list, gt_keypoints_list, gt_areas_list, dataset,
+                img_metas, with_depth, packed_gts)
+        else:
+            loss_outputs = multi_apply(
+                self.loss_single, all_cls_scores, all_kpt_preds, all_depths_preds,
+                all_gt_labels_list, all_gt_keypoints_list,
+                all_gt_areas_list, dataset_list, img_metas_list,
+                with_depth_list, packed_gts=packed_gts)  # 计算decoder输出产生的loss
         losses_cls, losses_kpt, losses_oks, losses_depth, area_targets_list, \
         kpt_preds_list, depth_preds_list, \
         kpt_weights_list, depth_weights_list, \
-        kpt_targets_list,  depth_targets_list = multi_apply(
-                self.loss_single, all_cls_scores, all_kpt_preds, all_depths_preds,
-                all_gt_labels_list, all_gt_keypoints_list,
-                all_gt_areas_list, dataset_list, img_metas_list)  # 计算decoder输出产生的loss
+        kpt_targets_list,  depth_targets_list = loss_outputs
 
         loss_dict = dict()
         # loss of proposal generated from encode feature map.
@@ -614,10 +667,12 @@ class PETRHead3D(AnchorFreeHead):
                 torch.zeros_like(gt_labels_list[i])
                 for i in range(len(img_metas))
             ]
-            enc_losses_cls, enc_losses_kpt, enc_losses_depth = \
-                self.loss_single_rpn(
-                    enc_cls_scores, enc_kpt_preds, enc_depth_preds, binary_labels_list,
-                    gt_keypoints_list, gt_areas_list, dataset, img_metas)
+            with profile_stage('loss_rpn'):  # 包括encoder proposal的assigner
+                enc_losses_cls, enc_losses_kpt, enc_losses_depth = \
+                    self.loss_single_rpn(
+                        enc_cls_scores, enc_kpt_preds, enc_depth_preds, binary_labels_list,
+                        gt_keypoints_list, gt_areas_list, dataset, img_metas,
+                        with_depth, packed_gts)
             
             loss_dict['enc_loss_cls'] = enc_losses_cls
             loss_dict['enc_loss_kpt'] = enc_losses_kpt
@@ -641,8 +696,9 @@ class PETRHead3D(AnchorFreeHead):
 
         # losses of heatmap generated from P3 feature map
         hm_pred, hm_mask = enc_hm_proto
-        loss_hm = self.loss_heatmap(hm_pred, hm_mask, gt_keypoints_list,
-                                    gt_labels_list, gt_bboxes_list)
+        with profile_stage('loss_hm'):
+            loss_hm = self.loss_heatmap(hm_pred, hm_mask, gt_keypoints_list,
+                                        gt_labels_list, gt_bboxes_list)
         loss_dict['loss_hm'] = loss_hm
 
         return loss_dict, (area_targets_list[-1],
@@ -665,29 +721,22 @@ class PETRHead3D(AnchorFreeHead):
             gt_keypoint = torch.cat((gt_keypoint_depth[..., :2], gt_keypoint_depth[..., 3].unsqueeze(-1)), -1)  # [x, y, vis]
             gt_keypoint = gt_keypoint.reshape(gt_keypoint.shape[0], -1, 3).clone()
             gt_keypoint[..., :2] /= 8
-            # if gt_keypoint[..., 0].max() > w or gt_keypoint[..., 1].max() > h:
-            #     import pdb;pdb.set_trace() 
             # FIXME 为什么会有 keypoint 越界
             # 由于数据处理有错误，导致有keypoints不在图片范围内
             # gt_keypoint[..., 0] = torch.clip(gt_keypoint[..., 0], 0, w - 1)
             # gt_keypoint[..., 1] = torch.clip(gt_keypoint[..., 1], 0, h - 1)
-            assert gt_keypoint[..., 0].max() <= w  # new coordinate system
-            assert gt_keypoint[..., 1].max() <= h  # new coordinate system
-            gt_bbox /= 8
+            if self.debug:
+                assert gt_keypoint[..., 0].max() <= w  # new coordinate system
+                assert gt_keypoint[..., 1].max() <= h  # new coordinate system
+            gt_bbox = gt_bbox / 8
             gt_w = gt_bbox[:, 2] - gt_bbox[:, 0]
             gt_h = gt_bbox[:, 3] - gt_bbox[:, 1]
-            for j in range(gt_label.size(0)):
-                # get heatmap radius
-                kp_radius = torch.clamp(
-                    torch.floor(
-                        gaussian_radius((gt_h[j], gt_w[j]), min_overlap=0.9)),
-                    min=0, max=3)
-                for k in range(self.num_keypoints):
-                    if gt_keypoint[j, k, 2] > 0:
-                        gt_kp = gt_keypoint[j, k, :2]
-                        gt_kp_int = torch.floor(gt_kp)
-                        draw_umich_gaussian(hm_target[i, k], gt_kp_int,
-                                            kp_radius)
+            # get heatmap radius, 所有实例一起绘制, 避免逐个关键点同步到host
+            kp_radius = torch.clamp(
+                torch.floor(gaussian_radius((gt_h, gt_w), min_overlap=0.9)),
+                min=0, max=3)
+            draw_umich_gaussians(hm_target[i], torch.floor(gt_keypoint[..., :2]),
+                                 kp_radius, gt_keypoint[..., 2] > 0)
         # compute heatmap loss
         hm_pred = torch.clamp(
             hm_pred.sigmoid_(), min=1e-4, max=1 - 1e-4)  # refer to CenterNet
@@ -702,7 +751,9 @@ class PETRHead3D(AnchorFreeHead):
                     gt_keypoints_list,
                     gt_areas_list,
                     dataset_list,
-                    img_metas):
+                    img_metas,
+                    with_depth=True,
+                    packed_gts=None):
         """Loss function for outputs from a single decoder layer of a single
         feature level.
 
@@ -713,6 +764,7 @@ class PETRHead3D(AnchorFreeHead):
                 for all images, with normalized coordinate (x_{i}, y_{i})
                 shape [bs, num_query, K*2].
             depth_preds: reference point depth and other keypoints releative depth
+            with_depth (bool): Whether the batch has 3D supervision.
             gt_labels_list (list[Tensor]): Ground truth class indices for each
                 image with shape (num_gts, ).
             gt_keypoints_list (list[Tensor]): Ground truth keypoints for each
@@ -720,6 +772,7 @@ class PETRHead3D(AnchorFreeHead):
             gt_areas_list (list[Tensor]): Ground truth mask areas for each
                 image with shape (num_gts, ).
             img_metas (list[dict]): List of image meta information.
+            packed_gts (tuple[Tensor], optional): Outputs of `_pack_gts`.
 
         Returns:
             dict[str, Tensor]: A dictionary of loss components for outputs from
@@ -730,20 +783,14 @@ class PETRHead3D(AnchorFreeHead):
         kpt_preds_list = [kpt_preds[i] for i in range(num_imgs)]
         depth_preds_list = [depth_preds[i] for i in range(num_imgs)]
 
-        cls_reg_depth_targets = self.get_targets(cls_scores_list, kpt_preds_list, depth_preds_list,
-                gt_labels_list, gt_keypoints_list, gt_areas_list, dataset_list, img_metas)
-        
-        (labels_list, label_weights_list, kpt_targets_list, kpt_weights_list, depth_targets_list, 
-            depth_weights_list, area_targets_list, num_total_pos, num_total_neg) = cls_reg_depth_targets
+        with profile_stage('targets'):  # 包括assigner
+            cls_reg_depth_targets = self.get_targets(cls_scores_list, kpt_preds_list, depth_preds_list,
+                    gt_labels_list, gt_keypoints_list, gt_areas_list, dataset_list, img_metas,
+                    packed_gts)
         
-        # 将所有batch拼接在一起
-        labels = torch.cat(labels_list, 0)  # [bs * 300, ]
-        label_weights = torch.cat(label_weights_list, 0)  # [bs * 300, ]
-        kpt_targets = torch.cat(kpt_targets_list, 0)  # [bs * 300, 30]
-        kpt_weights = torch.cat(kpt_weights_list, 0)  # [bs * 300, 30]
-        depth_targets = torch.cat(depth_targets_list, 0)  # [bs * 300, 16]
-        depth_weights = torch.cat(depth_weights_list, 0)  # [bs * 300, 16]
-        area_targets = torch.cat(area_targets_list, 0)  # [bs * 300, ]
+        # 所有batch的target, [bs * 300, ...]
+        (labels, label_weights, kpt_targets, kpt_weights, depth_targets, 
+            depth_weights, area_targets, num_total_pos, num_total_neg) = cls_reg_depth_targets
 
         # classification loss
         cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
@@ -751,17 +798,19 @@ class PETRHead3D(AnchorFreeHead):
         cls_avg_factor = num_total_pos * 1.0 + \
             num_total_neg * self.bg_cls_weight
         if self.sync_cls_avg_factor:
-            cls_avg_factor = reduce_mean(
-                cls_scores.new_tensor([cls_avg_factor]))
-        cls_avg_factor = max(cls_avg_factor, 1)
+            cls_avg_factor = torch.clamp(
+                reduce_mean(cls_scores.new_tensor([cls_avg_factor])), min=1)
+        else:
+            cls_avg_factor = max(cls_avg_factor, 1)
 
-        loss_cls = self.loss_cls(
-            cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
+        with profile_stage('loss_cls'):
+            loss_cls = self.loss_cls(
+                cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
 
         # Compute the average number of gt keypoints accross all gpus, for
         # normalization purposes
-        num_total_pos = loss_cls.new_tensor([num_total_pos])
-        num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1).item()
+        num_total_pos = loss_cls.new_tensor(num_total_pos)
+        num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1)
 
         # construct factors used for rescale keypoints
         factors = []
@@ -774,14 +823,15 @@ class PETRHead3D(AnchorFreeHead):
 
         # keypoint regression loss
         kpt_preds = kpt_preds.reshape(-1, kpt_preds.shape[-1])  # [bs * 300, 30]
-        num_valid_kpt = torch.clamp(
-            reduce_mean(kpt_weights.sum()), min=1).item()
+        num_valid_kpt = torch.clamp(reduce_mean(kpt_weights.sum()), min=1)
         # assert num_valid_kpt == (kpt_targets>0).sum().item()
-        loss_kpt = self.loss_kpt(
-            kpt_preds, kpt_targets, kpt_weights, avg_factor=num_valid_kpt)
+        with profile_stage('loss_kpt'):
+            loss_kpt = self.loss_kpt(
+                kpt_preds, kpt_targets, kpt_weights, avg_factor=num_valid_kpt)
         
         # keypoint oks loss
-        pos_inds = kpt_weights.sum(-1) > 0
+        # 只对正样本的索引同步一次, 之后的gather不再同步
+        pos_inds = (kpt_weights.sum(-1) > 0).nonzero().squeeze(1)
         factors = factors[pos_inds][:, :2].repeat(1, kpt_preds.shape[-1] // 2)
         pos_kpt_preds = kpt_preds[pos_inds] * factors
         pos_kpt_targets = kpt_targets[pos_inds] * factors
@@ -790,20 +840,26 @@ class PETRHead3D(AnchorFreeHead):
         if len(pos_areas) == 0:
             loss_oks = pos_kpt_preds.sum() * 0
         else:
-            # if not (pos_areas > 0).all():
-            #     import pdb;pdb.set_trace()
-            assert (pos_areas > 0).all(), f"pos_areas: {pos_areas}"
-            loss_oks = self.loss_oks(
-                pos_kpt_preds,
-                pos_kpt_targets,
-                pos_valid,
-                pos_areas,
-                avg_factor=num_total_pos)
+            if self.debug:
+                assert (pos_areas > 0).all(), f'pos_areas: {pos_areas}'
+            with profile_stage('loss_oks'):
+                loss_oks = self.loss_oks(
+                    pos_kpt_preds,
+                    pos_kpt_targets,
+                    pos_valid,
+                    pos_areas,
+                    avg_factor=num_total_pos)
         # depth L1 Loss 
         # 使用depth_weights和dataset在signle_target去控制是否计算深度loss, 故这里不在判断数据集类型
         depth_preds = depth_preds.reshape(-1, depth_preds.shape[-1])  # [bs * 300, 1 + 15]
-        num_valid_depth = torch.clamp(
-            reduce_mean(depth_weights.sum()), min=1).item()
+        if not with_depth:
+            # depth_weights全为0, 梯度与原来一致
+            loss_depth = depth_preds.sum() * 0
+            return loss_cls, loss_kpt, loss_oks, loss_depth, area_targets,\
+                kpt_preds, depth_preds, \
+                kpt_weights, depth_weights, \
+                kpt_targets, depth_targets
+        num_valid_depth = torch.clamp(reduce_mean(depth_weights.sum()), min=1)
         # 处理关键点的相对深度 至 绝对深度
         # 为什么不支持 [..., 1:] += [..., 0],已解决，由于shape对不上 [..., 1:] += [..., 0].unsqueeze(-1)
         # refer_center_depth = depth_preds[..., 0]  # [bs * 300, ]
@@ -813,14 +869,182 @@ class PETRHead3D(AnchorFreeHead):
         # kpt_depth_preds = torch.cat((refer_center_depth.unsqueeze(-1), kpt_real_depth_tmp), -1)
         depth_preds_tmp = depth_preds.clone()  # 保证传回的depth_preds依旧是绝对 + 相对
         depth_preds_tmp[..., 1:] = depth_preds_tmp[..., 0].unsqueeze(-1) + depth_preds_tmp[..., 1:]
-        loss_depth = self.loss_depth(
-            depth_preds_tmp, depth_targets, depth_weights, avg_factor=num_valid_depth)
+        with profile_stage('loss_depth'):
+            loss_depth = self.loss_depth(
+                depth_preds_tmp, depth_targets, depth_weights, avg_factor=num_valid_depth)
         
         return loss_cls, loss_kpt, loss_oks, loss_depth, area_targets,\
             kpt_preds, depth_preds, \
             kpt_weights, depth_weights, \
             kpt_targets, depth_targets
 
+    def loss_all_layers(self,
+                        all_cls_scores,
+                        all_kpt_preds,
+                        all_depth_preds,
+                        gt_labels_list,
+                        gt_keypoints_list,
+                        gt_areas_list,
+                        dataset_list,
+                        img_metas,
+                        with_depth=True,
+                        packed_gts=None):
+        """Fused version of mapping `loss_single` over all decoder layers.
+
+        The targets are still assigned layer by layer, but the predictions
+        and targets of all layers are stacked to [num_dec, bs * num_query,
+        ...] and every loss term is computed once for all layers with
+        ``reduction_override='none'``, then normalized by the per-layer
+        avg_factor. The normalizers of all layers are synchronized across
+        ranks with a single all_reduce.
+
+        Args:
+            all_cls_scores (Tensor): [num_dec, bs, num_query,
+                cls_out_channels].
+            all_kpt_preds (Tensor): [num_dec, bs, num_query, K*2].
+            all_depth_preds (Tensor): [num_dec, bs, num_query, 1 + K].
+            Others are the same as `loss_single`.
+
+        Returns:
+            tuple[list]: The same outputs as
+                ``multi_apply(self.loss_single, ...)``.
+        """
+        num_layers, num_imgs, num_query = all_kpt_preds.shape[:3]
+        targets = []
+        for cls_scores, kpt_preds, depth_preds in zip(
+                all_cls_scores, all_kpt_preds, all_depth_preds):
+            with profile_stage('targets'):  # 包括assigner
+                targets.append(self.get_targets(
+                    [cls_scores[i] for i in range(num_imgs)],
+                    [kpt_preds[i] for i in range(num_imgs)],
+                    [depth_preds[i] for i in range(num_imgs)],
+                    gt_labels_list, gt_keypoints_list, gt_areas_list,
+                    dataset_list, img_metas, packed_gts))
+        # [num_dec, bs * num_query, ...]
+        (labels, label_weights, kpt_targets, kpt_weights, depth_targets,
+            depth_weights, area_targets) = [
+                torch.stack(t) for t in list(zip(*targets))[:7]]
+        num_total_pos, num_total_neg = list(zip(*targets))[7:]
+        kpt_preds = all_kpt_preds.reshape(num_layers, num_imgs * num_query, -1)
+        depth_preds = all_depth_preds.reshape(
+            num_layers, num_imgs * num_query, -1)
+
+        # 所有层的normalizer一起同步, [4, num_dec]
+        cls_avg_factor = [
+            pos * 1.0 + neg * self.bg_cls_weight
+            for pos, neg in zip(num_total_pos, num_total_neg)
+        ]
+        normalizers = torch.cat([
+            kpt_preds.new_tensor([cls_avg_factor, num_total_pos]),
+            kpt_weights.sum((1, 2))[None],
+            depth_weights.sum((1, 2))[None]
+        ])
+        synced = torch.clamp(reduce_mean(normalizers), min=1)
+        cls_avg_factor = synced[0] if self.sync_cls_avg_factor else \
+            torch.clamp(normalizers[0], min=1)
+        num_total_pos, num_valid_kpt, num_valid_depth = synced[1:]
+        # 与 weight_reduce_loss 中 avg_factor 的处理一致
+        eps = torch.finfo(torch.float32).eps
+
+        def _reduce(loss, avg_factor):
+            return loss.reshape(num_layers, -1).sum(1) / (avg_factor + eps)
+
+        # classification loss
+        with profile_stage('loss_cls'):
+            loss_cls = self.loss_cls(
+                all_cls_scores.reshape(-1, self.cls_out_channels),
+                labels.reshape(-1),
+                label_weights.reshape(-1),
+                reduction_override='none')
+            losses_cls = _reduce(loss_cls, cls_avg_factor)
+
+        # keypoint regression loss
+        with profile_stage('loss_kpt'):
+            loss_kpt = self.loss_kpt(
+                kpt_preds, kpt_targets, kpt_weights,
+                reduction_override='none')
+            losses_kpt = _reduce(loss_kpt, num_valid_kpt)
+
+        # keypoint oks loss, 所有层的正样本拼接在一起计算
+        factors = torch.cat([
+            kpt_preds.new_tensor(img_meta['img_shape'][1::-1]).repeat(
+                num_query, kpt_preds.shape[-1] // 2) for img_meta in img_metas
+        ])  # [bs * num_query, K*2]
+        pos_layer_inds, pos_inds = (kpt_weights.sum(-1) > 0).nonzero(
+            as_tuple=True)
+        losses_oks = kpt_preds.new_zeros(num_layers)
+        if len(pos_inds) > 0:
+            pos_factors = factors[pos_inds]
+            pos_areas = area_targets[pos_layer_inds, pos_inds]
+            if self.debug:
+                assert (pos_areas > 0).all(), f'pos_areas: {pos_areas}'
+            with profile_stage('loss_oks'):
+                loss_oks = self.loss_oks(
+                    kpt_preds[pos_layer_inds, pos_inds] * pos_factors,
+                    kpt_targets[pos_layer_inds, pos_inds] * pos_factors,
+                    kpt_weights[pos_layer_inds, pos_inds, 0::2],
+                    pos_areas,
+                    reduction_override='none')
+                losses_oks = losses_oks.index_add(0, pos_layer_inds,
+                                                  loss_oks)
+        losses_oks = losses_oks / (num_total_pos + eps)
+
+        # depth L1 Loss
+        if with_depth:
+            # 将相对深度转为绝对深度
+            depth_preds_abs = torch.cat(
+                (depth_preds[..., :1],
+                 depth_preds[..., :1] + depth_preds[..., 1:]), -1)
+            with profile_stage('loss_depth'):
+                loss_depth = self.loss_depth(
+                    depth_preds_abs, depth_targets, depth_weights,
+                    reduction_override='none')
+                losses_depth = _reduce(loss_depth, num_valid_depth)
+        else:
+            losses_depth = depth_preds.reshape(num_layers, -1).sum(1) * 0
+
+        return (list(losses_cls), list(losses_kpt), list(losses_oks),
+                list(losses_depth), list(area_targets), list(kpt_preds),
+                list(depth_preds), list(kpt_weights), list(depth_weights),
+                list(kpt_targets), list(depth_targets))
+
+    def _pack_gts(self, gt_keypoints_list, gt_areas_list):
+        """Pack the ground truths of a batch into padded tensors.
+
+        It only needs to be done once per iteration, the packed tensors are
+        shared by all decoder layers and the encoder proposals.
+
+        Args:
+            gt_keypoints_list (list[Tensor]): Ground truth keypoints for each
+                image with shape (num_gts, K, 11) come from SMAP format.
+            gt_areas_list (list[Tensor]): Ground truth mask areas for each
+                image with shape (num_gts, ).
+
+        Returns:
+            tuple[Tensor]: a tuple containing the following tensors.
+
+                - gt_keypoints (Tensor): [bs, max_gt, K, 11].
+                - gt_areas (Tensor): [bs, max_gt].
+                - gt_valid (Tensor): Whether the gt is not padded,
+                    [bs, max_gt].
+        """
+        num_imgs = len(gt_keypoints_list)
+        num_gts = [gt_keypoints.size(0) for gt_keypoints in gt_keypoints_list]
+        # 至少补齐到1, 没有gt的batch也可以直接gather
+        max_gt = max(num_gts + [1])
+        # SMAP格式为 [num_gts, 15, 11]
+        gt_keypoints = gt_keypoints_list[0].new_zeros(
+            (num_imgs, max_gt, self.num_keypoints, 11))
+        gt_areas = gt_areas_list[0].new_zeros((num_imgs, max_gt))
+        for i, (gt_keypoint, gt_area) in enumerate(
+                zip(gt_keypoints_list, gt_areas_list)):
+            if num_gts[i] > 0:
+                gt_keypoints[i, :num_gts[i]] = gt_keypoint
+                gt_areas[i, :num_gts[i]] = gt_area
+        gt_valid = torch.arange(max_gt, device=gt_areas.device)[None] < \
+            gt_areas.new_tensor(num_gts, dtype=torch.long)[:, None]
+        return gt_keypoints, gt_areas, gt_valid
+
     def get_targets(self,
                     cls_scores_list,
                     kpt_preds_list,
@@ -829,10 +1053,14 @@ class PETRHead3D(AnchorFreeHead):
                     gt_keypoints_list,
                     gt_areas_list,
                     dataset_list,
-                    img_metas):
+                    img_metas,
+                    packed_gts=None):
         """Compute regression and classification targets for a batch image.
 
         Outputs from a single decoder layer of a single feature level are used.
+        The assignment is done image by image (Hungarian matching on CPU), then
+        all the targets of the batch are gathered from the padded ground
+        truths at once.
 
         Args:
             cls_scores_list (list[Tensor]): Box score logits from a single
@@ -841,175 +1069,128 @@ class PETRHead3D(AnchorFreeHead):
             kpt_preds_list (list[Tensor]): Sigmoid outputs from a single
                 decoder layer for each image, with normalized coordinate
                 (x_{i}, y_{i}) and shape [num_query, K*2]. len=batch_size
-            depth_preds_list:
+            depth_preds_list (list[Tensor]): Reference point absolute depth
+                and keypoints relative depth for each image with shape
+                [num_query, 1 + K]. len=batch_size
             gt_labels_list (list[Tensor]): Ground truth class indices for each
                 image with shape (num_gts, ).
             gt_keypoints_list (list[Tensor]): Ground truth keypoints for each
-                image with shape (num_gts, K*3).
+                image with shape (num_gts, K, 11).
             gt_areas_list (list[Tensor]): Ground truth mask areas for each
                 image with shape (num_gts, ).
+            dataset_list (list[str]): 'COCO' or 'MUCO' for each image.
             img_metas (list[dict]): List of image meta information.
+            packed_gts (tuple[Tensor], optional): Outputs of `_pack_gts`,
+                packed here if not given. Default: None.
 
         Returns:
-            tuple: a tuple containing the following targets.
-                length = batch_size
-                - labels_list (list[Tensor]): Labels for all images.  # [300, ]
-                - label_weights_list (list[Tensor]): Label weights for all
-                    images.  # [300, ]
-                - kpt_targets_list (list[Tensor]): Keypoint targets for all
-                    images.  # [300, 15*2 + 1 + 15]
-                - kpt_weights_list (list[Tensor]): Keypoint weights for all
-                    images.  # [300, 15*2 + 1 + 15]
-                - area_targets_list (list[Tensor]): area targets for all
-                    images.  # [300. ]
+            tuple: a tuple containing the following targets of all images,
+                the first dimension is bs * num_query.
+
+                - labels (Tensor): Labels.  # [bs * 300, ]
+                - label_weights (Tensor): Label weights.  # [bs * 300, ]
+                - kpt_targets (Tensor): Keypoint targets.  # [bs * 300, 15*2]
+                - kpt_weights (Tensor): Keypoint weights.  # [bs * 300, 15*2]
+                - depth_targets (Tensor): Depth targets.  # [bs * 300, 1 + 15]
+                - depth_weights (Tensor): Depth weights.  # [bs * 300, 1 + 15]
+                - area_targets (Tensor): Area targets.  # [bs * 300, ]
                 - num_total_pos (int): Number of positive samples in all
-                    images.  # eg: [279, 296], num = 2 
+                    images.
                 - num_total_neg (int): Number of negative samples in all
-                    images.  # eg: [0, ..., 299], num = 298
+                    images.
         """
-        # len(labels_list) == batch_size
-        (labels_list, label_weights_list, kpt_targets_list, kpt_weights_list, depth_targets_list, 
-            depth_weights_list, area_targets_list, pos_inds_list, neg_inds_list) = multi_apply(
-                self._get_target_single, cls_scores_list, kpt_preds_list, depth_preds_list,
-                gt_labels_list, gt_keypoints_list, gt_areas_list, dataset_list, img_metas)
-        num_total_pos = sum((inds.numel() for inds in pos_inds_list))  # pos 个数
-        num_total_neg = sum((inds.numel() for inds in neg_inds_list))  # neg 个数
-        return (labels_list, label_weights_list, kpt_targets_list,
-                kpt_weights_list, depth_targets_list, depth_weights_list, 
-                area_targets_list, num_total_pos, num_total_neg)
-
-    def _get_target_single(self,
-                            cls_score,
-                            kpt_pred,
-                            depth_pred,
-                            gt_labels,
-                            gt_keypoints,
-                            gt_areas,
-                            dataset,
-                            img_meta):
-        """Compute regression and classification targets for one image.
-
-        Outputs from a single decoder layer of a single feature level are used.
-
-        Args:
-            cls_score (Tensor): Box score logits from a single decoder layer
-                for one image. Shape [num_query, cls_out_channels].
-                [300, 1]
-            kpt_pred (Tensor): Sigmoid outputs from a single decoder layer
-                for one image, with normalized coordinate (x_{i}, y_{i}) and
-                shape [num_query, K*2].
-                [300, 30]
-            depth_preds: 
-                [300, 16]
-            gt_labels (Tensor): Ground truth class indices for one image
-                with shape (num_gts, ).
-                [num_gts, ]
-            gt_keypoints (Tensor): Ground truth keypoints for one image with
-                shape (num_gts, K*3) in [p^{1}_x, p^{1}_y, p^{1}_v, ..., \
-                    p^{K}_x, p^{K}_y, p^{K}_v] format.
-                [num_gts, 15, 11]
-            gt_areas (Tensor): Ground truth mask areas for one image
-                with shape (num_gts, ).
-                [num_gts, ]
-            img_meta (dict): Meta information for one image.
-        Returns:
-            tuple[Tensor]: a tuple containing the following for one image.
-
-                - labels (Tensor): Labels of each image.
-                - label_weights (Tensor): Label weights of each image.
-                - kpt_targets (Tensor): Keypoint targets of each image.
-                - kpt_weights (Tensor): Keypoint weights of each image.
-                - depth_targets (Tensor): Depth targets of each image.
-                - depth_weights (Tensor): Depth weights of each image.
-                - area_targets (Tensor): Area targets of each image.
-                - pos_inds (Tensor): Sampled positive indices for each image.
-                - neg_inds (Tensor): Sampled negative indices for each image.
-        """
-        num_querys = kpt_pred.size(0)
-        # # 将ground truth 转为 float32
-        # gt_keypoints = gt_keypoints.to(torch.float32)
-        # gt_areas = gt_areas.to(torch.float32)
-        # assigner and sampler
-        assign_result = self.assigner.assign(cls_score, kpt_pred, depth_pred, 
-                            gt_labels, gt_keypoints, gt_areas, dataset, img_meta)
-        sampling_result = self.sampler.sample(assign_result, kpt_pred,
-                                        gt_keypoints)
-        pos_inds = sampling_result.pos_inds  # query中选中的index eg: [279, 296]
-        neg_inds = sampling_result.neg_inds  # query中未选中的index eg: [0, ..., 299]
+        num_imgs = len(cls_scores_list)
+        num_query = kpt_preds_list[0].size(0)
+        if packed_gts is None:
+            packed_gts = self._pack_gts(gt_keypoints_list, gt_areas_list)
+        gt_keypoints, gt_areas, gt_valid = packed_gts
+        gt_labels = gt_keypoints.new_full(gt_valid.shape, self.num_classes,
+                                          dtype=torch.long)
+        for i, gt_label in enumerate(gt_labels_list):
+            gt_labels[i, :gt_label.size(0)] = gt_label
+        for dataset in dataset_list:
+            if dataset not in ('COCO', 'MUCO'):
+                raise NotImplementedError('未知的dataset in get_targets.')
+
+        # assigner, sampler为PseudoSampler, 直接使用assign结果
+        # gt_inds: 0为负样本, 正数为gt的索引 + 1
+        with profile_stage('assigner'):  # Hungarian matching on CPU
+            assigned_gt_inds = torch.stack([
+                self.assigner.assign(*args).gt_inds for args in zip(
+                    cls_scores_list, kpt_preds_list, depth_preds_list,
+                    gt_labels_list, gt_keypoints_list, gt_areas_list,
+                    dataset_list, img_metas)
+            ])  # [bs, 300]
+        # Hungarian matching的正样本个数为 min(num_gts, num_query), 不需要同步
+        num_total_pos = sum(
+            min(gt_label.size(0), num_query) for gt_label in gt_labels_list)
+        num_total_neg = num_imgs * num_query - num_total_pos
+
+        img_inds = torch.arange(num_imgs, device=gt_valid.device)[:, None]
+        pos_gt_inds = (assigned_gt_inds - 1).clamp(min=0)
+        pos_mask = (assigned_gt_inds > 0) & gt_valid[img_inds, pos_gt_inds]
+        pos_gt_kpts = gt_keypoints[img_inds, pos_gt_inds]  # [bs, 300, 15, 11]
 
         # label targets
-        labels = gt_labels.new_full((num_querys, ),
-                                    self.num_classes,
-                                    dtype=torch.long)  # [300, ] value= 1 = self.num_classes
-        labels[pos_inds] = gt_labels[sampling_result.pos_assigned_gt_inds].long()
-        # sampling_result.pos_assigned_gt_inds: gt 中对应的索引，eg [1, 0]
-        # sampling_result.pos_assigned_gt_inds = assign_result.gt_inds[pos_inds] - 1
-        label_weights = gt_labels.new_ones(num_querys)  # [300, ]， 这里是全1
-
-        img_h, img_w, _ = img_meta['img_shape']
-        # keypoint targets
-        kpt_targets = torch.zeros_like(kpt_pred)  # [300, 15*2]
-        kpt_weights = torch.zeros_like(kpt_pred)  # [300, 15*2]
-        pos_gt_kpts = gt_keypoints[sampling_result.pos_assigned_gt_inds]  # [num_gts, 15, 11]
-        try:
-            valid_idx = pos_gt_kpts[..., 3] > 0  # vis, [num_gts, 15]
-        except:
-            print("error")
-            import pdb;pdb.set_trace()
-        pos_kpt_weights = kpt_weights[pos_inds].reshape(
-            pos_gt_kpts.shape[0], kpt_weights.shape[-1] // 2, 2)  # [num_gts, 15, 2]
-        pos_kpt_weights[valid_idx] = 1.0
-        kpt_weights[pos_inds] = pos_kpt_weights.reshape(
-            pos_kpt_weights.shape[0], kpt_pred.shape[-1])  # [300, 30]
-
-        factor = kpt_pred.new_tensor([img_w, img_h]).unsqueeze(0)  # [1, 2]
-        pos_gt_kpts_normalized = pos_gt_kpts[..., :2]  # [num_gts, 15, 2]
-        pos_gt_kpts_normalized[..., 0] = pos_gt_kpts_normalized[..., 0] / \
-            factor[:, 0:1]  # [num_gts, 15, 2]
-        pos_gt_kpts_normalized[..., 1] = pos_gt_kpts_normalized[..., 1] / \
-            factor[:, 1:2]  # [num_gts, 15, 2]
-        kpt_targets[pos_inds] = pos_gt_kpts_normalized.reshape(
-            pos_gt_kpts.shape[0], kpt_pred.shape[-1])  # [num_gts, 2]
-
-        # depth target
-        if dataset == "COCO":
-            depth_targets = torch.zeros_like(depth_pred)
-            depth_weights = torch.zeros_like(depth_pred)
-        elif dataset == "MUCO":
-            depth_targets = torch.zeros_like(depth_pred)  # [300, 1 + 15]
-            depth_weights = torch.zeros_like(depth_pred)  # [300, 1 + 15]
-            gt_keypoints_tmp = gt_keypoints[sampling_result.pos_assigned_gt_inds]
-            pos_gt_kpts = gt_keypoints_tmp  # [num_gts, 15, 11]
-            valid_idx = pos_gt_kpts[:, :, 3] > 0  # vis, [num_gts, 15]
-            # depth_weights[pos_inds][..., 0] = 1.0  # reference point 的 weight 直接设为1
-            # depth_weights[pos_inds][..., 1:] = valid_idx.int()  # 形状要对应上
-            # TODO 为什么无法赋值
-            num_gts = gt_keypoints.shape[0]
-            refer_point_weights = torch.ones((num_gts, 1)).cuda()  # [num_gts, 1]
-            depth_weights[pos_inds] = torch.cat((refer_point_weights, valid_idx.int()), -1)  # [num_gts, 1 + 15]
-            # 这里直接对gt_targets进行变换，之后计算loss时就不用再针对进行变换, 但是需要考虑preds中绝对深度与相对深度
-            kpt_gt_depth = torch.zeros((num_gts, 15), dtype=torch.float32).cuda()
-            # FIXME 这里的图片宽度应该是变换后的图片深度还是变换前的图片深度, 进一步考虑
-            img_scale = img_meta['scale_factor'][0]
-            # kpt_gt_depth[valid_idx] = gt_keypoints_tmp[valid_idx][..., 6] * img_w / \
-            #     gt_keypoints_tmp[valid_idx][..., 7]  # [num_gts, 15]
-            kpt_gt_depth[valid_idx] = gt_keypoints_tmp[valid_idx][..., 6] / img_scale / \
-                gt_keypoints_tmp[valid_idx][..., 7]  # [num_gts, 15]
-            kpt_center_depth = torch.sum(kpt_gt_depth, -1) / torch.sum(valid_idx.int(), -1)  # [num_gts, ]
-            depth_targets[pos_inds] = torch.cat((kpt_center_depth.unsqueeze(-1), kpt_gt_depth), -1)
-            if torch.isnan(depth_targets).int().sum():
-                import pdb;pdb.set_trace()
-        else:
-            raise  NotImplementedError("未知的dataset in _get_target_single.")
+        labels = gt_labels[img_inds, pos_gt_inds].masked_fill(
+            ~pos_mask, self.num_classes)
+        label_weights = gt_labels.new_ones(num_imgs * num_query)
 
-        # area target
-        area_targets = kpt_pred.new_zeros(
-            kpt_pred.shape[0])  # get areas for calculating oks
-        pos_gt_areas = gt_areas[sampling_result.pos_assigned_gt_inds]
-        area_targets[pos_inds] = pos_gt_areas
-
-        return (labels, label_weights, kpt_targets, kpt_weights, depth_targets, depth_weights,
-            area_targets, pos_inds, neg_inds)
+        # keypoint targets
+        kpt_pred = kpt_preds_list[0]
+        valid_idx = pos_gt_kpts[..., 3] > 0  # vis, [bs, 300, 15]
+        kpt_weights = (valid_idx & pos_mask[..., None]).to(kpt_pred.dtype)
+        kpt_weights = kpt_weights[..., None].expand(
+            -1, -1, -1, 2).reshape(num_imgs * num_query, -1)  # [bs * 300, 30]
+        factor = kpt_pred.new_tensor([
+            [img_meta['img_shape'][1], img_meta['img_shape'][0]]
+            for img_meta in img_metas
+        ])[:, None, None]  # [bs, 1, 1, 2]
+        pos_gt_kpts_normalized = pos_gt_kpts[..., :2] / factor
+        kpt_targets = torch.where(
+            pos_mask[..., None, None], pos_gt_kpts_normalized,
+            pos_gt_kpts_normalized.new_zeros(())).reshape(
+                num_imgs * num_query, -1).to(kpt_pred.dtype)  # [bs * 300, 30]
+
+        # depth target, 只有MUCO有深度监督
+        depth_pred = depth_preds_list[0]
+        depth_mask = pos_mask & pos_mask.new_tensor(
+            [dataset == 'MUCO' for dataset in dataset_list])[:, None]
+        # FIXME 这里的图片宽度应该是变换后的图片深度还是变换前的图片深度, 进一步考虑
+        img_scale = gt_keypoints.new_tensor(
+            [img_meta['scale_factor'][0] for img_meta in img_metas])
+        kpt_gt_depth = torch.where(
+            valid_idx,
+            pos_gt_kpts[..., 6] / img_scale[:, None, None] /
+            pos_gt_kpts[..., 7], pos_gt_kpts.new_zeros(()))  # [bs, 300, 15]
+        kpt_center_depth = torch.sum(kpt_gt_depth, -1) / torch.sum(
+            valid_idx.int(), -1)  # [bs, 300]
+        depth_targets = torch.cat(
+            (kpt_center_depth[..., None], kpt_gt_depth), -1)
+        # reference point 的 weight 直接设为1
+        depth_weights = torch.cat(
+            (torch.ones_like(kpt_gt_depth[..., :1]), valid_idx.float()), -1)
+        depth_targets = torch.where(
+            depth_mask[..., None], depth_targets,
+            depth_targets.new_zeros(())).reshape(
+                num_imgs * num_query, -1).to(depth_pred.dtype)
+        depth_weights = torch.where(
+            depth_mask[..., None], depth_weights,
+            depth_weights.new_zeros(())).reshape(
+                num_imgs * num_query, -1).to(depth_pred.dtype)
+        if self.debug:
+            assert not torch.isnan(depth_targets).any(), \
+                'nan in depth targets of ' \
+                f'{[img_meta.get("filename") for img_meta in img_metas]}'
+
+        # area target, get areas for calculating oks
+        area_targets = torch.where(
+            pos_mask, gt_areas[img_inds, pos_gt_inds],
+            gt_areas.new_zeros(())).reshape(-1).to(kpt_pred.dtype)
+
+        return (labels.reshape(-1), label_weights, kpt_targets, kpt_weights,
+                depth_targets, depth_weights, area_targets, num_total_pos,
+                num_total_neg)
 
     def loss_single_rpn(self,
                         cls_scores,
@@ -1019,7 +1200,9 @@ class PETRHead3D(AnchorFreeHead):
                         gt_keypoints_list,
                         gt_areas_list,
                         dataset,
-                        img_metas):
+                        img_metas,
+                        with_depth=True,
+                        packed_gts=None):
         """Loss function for outputs from a single decoder layer of a single
         feature level.
 
@@ -1029,6 +1212,7 @@ class PETRHead3D(AnchorFreeHead):
             kpt_preds (Tensor): Sigmoid outputs from a single decoder layer
                 for all images, with normalized coordinate (x_{i}, y_{i}) and
                 shape [bs, num_query, K*2].
+            with_depth (bool): Whether the batch has 3D supervision.
             gt_labels_list (list[Tensor]): Ground truth class indices for each
                 image with shape (num_gts, ).
             gt_keypoints_list (list[Tensor]): Ground truth keypoints for each
@@ -1037,6 +1221,7 @@ class PETRHead3D(AnchorFreeHead):
             gt_areas_list (list[Tensor]): Ground truth mask areas for each
                 image with shape (num_gts, ).
             img_metas (list[dict]): List of image meta information.
+            packed_gts (tuple[Tensor], optional): Outputs of `_pack_gts`.
 
         Returns:
             dict[str, Tensor]: A dictionary of loss components for outputs from
@@ -1047,15 +1232,10 @@ class PETRHead3D(AnchorFreeHead):
         kpt_preds_list = [kpt_preds[i] for i in range(num_imgs)]
         depth_preds_list = [depth_preds[i] for i in range(num_imgs)]
         cls_reg_depth_targets = self.get_targets(cls_scores_list, kpt_preds_list, depth_preds_list,
-                gt_labels_list, gt_keypoints_list, gt_areas_list, dataset, img_metas)
-        (labels_list, label_weights_list, kpt_targets_list, kpt_weights_list, depth_targets_list,
-            depth_weights_list, area_targets_list, num_total_pos, num_total_neg) = cls_reg_depth_targets
-        labels = torch.cat(labels_list, 0)
-        label_weights = torch.cat(label_weights_list, 0)
-        kpt_targets = torch.cat(kpt_targets_list, 0)
-        kpt_weights = torch.cat(kpt_weights_list, 0)
-        depth_targets = torch.cat(depth_targets_list)
-        depth_weights = torch.cat(depth_weights_list)
+                gt_labels_list, gt_keypoints_list, gt_areas_list, dataset, img_metas,
+                packed_gts)
+        (labels, label_weights, kpt_targets, kpt_weights, depth_targets,
+            depth_weights, area_targets, num_total_pos, num_total_neg) = cls_reg_depth_targets
 
         # classification loss
         cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
@@ -1063,11 +1243,11 @@ class PETRHead3D(AnchorFreeHead):
         cls_avg_factor = num_total_pos * 1.0 + \
             num_total_neg * self.bg_cls_weight
         if self.sync_cls_avg_factor:
-            cls_avg_factor = reduce_mean(
-                cls_scores.new_tensor([cls_avg_factor]))
-        cls_avg_factor = max(cls_avg_factor, 1)
+            cls_avg_factor = torch.clamp(
+                reduce_mean(cls_scores.new_tensor([cls_avg_factor])), min=1)
+        else:
+            cls_avg_factor = max(cls_avg_factor, 1)
 
-        cls_avg_factor = max(cls_avg_factor, 1)
         loss_cls = self.loss_cls(
             cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
 
@@ -1078,19 +1258,19 @@ class PETRHead3D(AnchorFreeHead):
 
         # keypoint regression loss
         kpt_preds = kpt_preds.reshape(-1, kpt_preds.shape[-1])
-        num_valid_kpt = torch.clamp(
-            reduce_mean(kpt_weights.sum()), min=1).item()
+        num_valid_kpt = torch.clamp(reduce_mean(kpt_weights.sum()), min=1)
         # assert num_valid_kpt == (kpt_targets>0).sum().item()
         loss_kpt = self.loss_kpt_rpn(
             kpt_preds, kpt_targets, kpt_weights, avg_factor=num_valid_kpt)
 
         # keypoint Depth L1 loss
         depth_preds = depth_preds.reshape(-1, depth_preds.shape[-1])
+        if not with_depth:
+            return loss_cls, loss_kpt, depth_preds.sum() * 0
         assert depth_preds.shape[-1] == 16, f"shape 与设想不一致"
         # 将相对深度转为绝对深度
         depth_preds[..., 1:] = depth_preds[..., 1:] + depth_preds[..., 0].unsqueeze(-1)
-        num_valid_depth = torch.clamp(
-            reduce_mean(depth_weights.sum()), min=1).item()
+        num_valid_depth = torch.clamp(reduce_mean(depth_weights.sum()), min=1)
         loss_depth = self.loss_depth_rpn(
             depth_preds, depth_targets, depth_weights, avg_factor=num_valid_depth)
         return loss_cls, loss_kpt, loss_depth
@@ -1269,5 +1449,6 @@ class PETRHead3D(AnchorFreeHead):
         """
         # forward of this head requires img_metas
         outs = self.forward(feats, img_metas)
-        results_list = self.get_bboxes(*outs, img_metas, rescale=rescale)
+        with profile_stage('post_process'):  # 包括joint decoder
+            results_list = self.get_bboxes(*outs, img_metas, rescale=rescale)
         return results_list
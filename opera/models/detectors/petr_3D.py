@@ -3,7 +3,6 @@ import mmcv
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-import warnings
 from matplotlib.collections import PatchCollection
 from matplotlib.patches import Polygon, Circle
 from mmdet.core.visualization import color_val_matplotlib
@@ -11,7 +10,10 @@ from mmdet.core import bbox_mapping_back, multiclass_nms
 from mmdet.models.detectors.single_stage import SingleStageDetector
 from mmdet.models.detectors.detr import DETR
 
-from opera.core.keypoint import bbox_kpt2result_3d, kpt_mapping_back
+from opera.core.keypoint import (bbox_kpt2result_3d, bbox_kpt2result_3d_compact,
+                                 compact_result2arrays, is_compact_result,
+                                 kpt_mapping_back)
+from opera.core.runner import profile_stage
 from ..builder import DETECTORS
 
 
@@ -20,8 +22,31 @@ class PETR3D(DETR):
     """Implementation of `End-to-End Multi-Person Pose Estimation with
     Transformers`"""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, freeze_feat=False, **kwargs):
+        """
+        Args:
+            freeze_feat (bool): 冻结backbone与neck(不计算梯度, 保持eval模式),
+                使用FeatCacheDataset的缓存特征只训练head时需要设置。
+                Default: False.
+        """
         super(DETR, self).__init__(*args, **kwargs)
+        self.freeze_feat = freeze_feat
+        if freeze_feat:
+            for module in self._feat_modules():
+                module.eval()
+                for param in module.parameters():
+                    param.requires_grad = False
+
+    def _feat_modules(self):
+        return [self.backbone, self.neck] if self.with_neck \
+            else [self.backbone]
+
+    def train(self, mode=True):
+        super(PETR3D, self).train(mode)
+        if self.freeze_feat:
+            for module in self._feat_modules():
+                module.eval()
+        return self
 
     def forward_train(self,
                         img,
@@ -34,8 +59,10 @@ class PETR3D(DETR):
                         gt_bboxes_ignore=None):
         """
         Args:
-            img (Tensor): Input images of shape (N, C, H, W).
-                Typically these should be mean centered and std scaled.
+            img (Tensor | list[list[Tensor]]): Input images of shape
+                (N, C, H, W). Typically these should be mean centered and
+                std scaled. Or the cached neck features of each image from
+                :class:`FeatCacheDataset`.
             img_metas (list[dict]): A List of image info dict where each dict
                 has: 'img_shape', 'scale_factor', 'flip', and may also contain
                 'filename', 'ori_shape', 'pad_shape', and 'img_norm_cfg'.
@@ -54,20 +81,78 @@ class PETR3D(DETR):
         Returns:
             dict[str, Tensor]: A dictionary of loss components.
         """
-        super(SingleStageDetector, self).forward_train(img, img_metas)  # BaseDetector.forward_train()
-        x = self.extract_feat(img)  # x: [bs, 256, H / 8 ..., W / 8 ...], len(x) = 4
-        losses = self.bbox_head.forward_train(x, img_metas, dataset, gt_bboxes,
-                gt_labels, gt_keypoints, gt_areas, gt_bboxes_ignore)
+        cached_feats = isinstance(img, (list, tuple))
+        if not cached_feats:
+            super(SingleStageDetector, self).forward_train(img, img_metas)  # BaseDetector.forward_train()
+        with profile_stage('forward'):
+            if cached_feats:
+                # FeatCacheDataset: img为每张图像neck输出的各层特征
+                x = self._stack_cached_feats(img, img_metas)
+            else:
+                x = self.extract_feat(img)  # x: [bs, 256, H / 8 ..., W / 8 ...], len(x) = 4
+            losses = self.bbox_head.forward_train(x, img_metas, dataset,
+                gt_bboxes, gt_labels, gt_keypoints, gt_areas, gt_bboxes_ignore)
+        # 记录batch中padding像素的比例, 不参与loss计算
+        losses['pad_ratio'] = x[0].new_tensor(self._get_pad_ratio(img_metas))
         return losses
 
+    def _stack_cached_feats(self, feats, img_metas):
+        """将每张图像的各层特征补零后拼成batch。
+
+        这是对图像补零后再提取特征的近似: 只有各层的stride整除图像补零的
+        宽高时, 补零区域的特征才与原图特征对齐; 即使对齐, 边界附近的卷积
+        感受野会看到补零的图像, 而缓存的特征是单独提取的, 数值上也不完全相同。
+
+        Args:
+            feats (list[list[Tensor]]): 每张图像各层的特征, shape为(C, H, W),
+                缓存中为float16。
+            img_metas (list[dict]): 需要包含 'pad_shape', 这里设置
+                'batch_input_shape'。
+
+        Returns:
+            tuple[Tensor]: 每层的特征, shape为(N, C, H, W)。
+        """
+        batch_input_shape = tuple(
+            max(img_meta['pad_shape'][i] for img_meta in img_metas)
+            for i in range(2))
+        for img_meta in img_metas:
+            img_meta['batch_input_shape'] = batch_input_shape
+        dtype = next(self.bbox_head.parameters()).dtype
+        mlvl_feats = []
+        for level_feats in zip(*feats):
+            height = max(feat.size(1) for feat in level_feats)
+            width = max(feat.size(2) for feat in level_feats)
+            x = level_feats[0].new_zeros(
+                (len(level_feats), level_feats[0].size(0), height, width),
+                dtype=dtype)
+            for i, feat in enumerate(level_feats):
+                x[i, :, :feat.size(1), :feat.size(2)] = feat
+            mlvl_feats.append(x)
+        return tuple(mlvl_feats)
+
+    def extract_feat(self, img):
+        """Directly extract features from the backbone+neck."""
+        with profile_stage('backbone'):
+            x = self.backbone(img)
+        if self.with_neck:
+            with profile_stage('neck'):  # ChannelMapper
+                x = self.neck(x)
+        return x
+
+    @staticmethod
+    def _get_pad_ratio(img_metas):
+        batch_h, batch_w = img_metas[0]['batch_input_shape']
+        valid_pixels = sum(
+            img_meta['img_shape'][0] * img_meta['img_shape'][1]
+            for img_meta in img_metas)
+        return 1. - valid_pixels / (len(img_metas) * batch_h * batch_w)
+
     def forward_dummy(self, img):
         """Used for computing network flops.
 
-        See `mmdetection/tools/analysis_tools/get_flops.py`.
+        See `tools/analysis_tools/get_flops_3d.py`, which also counts the
+        attention modules. mmcv's `get_model_complexity_info` does not.
         """
-        warnings.warn('Warning! MultiheadAttention in DETR does not '
-                        'support flops computation! Do not use the '
-                        'results in your papers!')
 
         batch_size, _, height, width = img.shape
         dummy_img_metas = [
@@ -95,6 +180,10 @@ class PETR3D(DETR):
             list[list[np.ndarray]]: BBox and keypoint results of each image
                 and classes. The outer list corresponds to each image.
                 The inner list corresponds to each class.
+                If ``test_cfg.compact_result`` is set, e.g.
+                ``dict(score_thr=0.05, min_k=20, float16=True)``, each image
+                gets a single structured array instead, see
+                :func:`bbox_kpt2result_3d_compact`.
         """
         batch_size = len(img_metas)
         assert batch_size == 1, 'Currently only batch_size 1 for inference ' \
@@ -104,6 +193,17 @@ class PETR3D(DETR):
         results_list = self.bbox_head.simple_test(
             feat, img_metas, rescale=rescale)  # petr_head.simple_test_bboxes
 
+        compact_cfg = (self.test_cfg or {}).get('compact_result', None)
+        if compact_cfg is not None:
+            # 按分数过滤后保存为一个结构化数组, 减少结果的内存与IO
+            return [
+                bbox_kpt2result_3d_compact(det_bboxes, det_labels, det_kpts,
+                                           det_depths, scale_factor,
+                                           **compact_cfg)
+                for det_bboxes, det_labels, det_kpts, det_depths, scale_factor
+                in results_list
+            ]
+
         bbox_kpt_results = [
             bbox_kpt2result_3d(det_bboxes, det_labels, det_kpts, det_depths, scale_factor,
                             self.bbox_head.num_classes)
@@ -225,8 +325,14 @@ class PETR3D(DETR):
         """
         img = mmcv.imread(img)
         img = img.copy()
-        if isinstance(result, tuple):
-            bbox_result, keypoint_result = result  # [100, 5], [100, 17, 3]
+        if is_compact_result(result):
+            bboxes, labels, kpts = compact_result2arrays(result)[:3]
+            bbox_result = [bboxes[labels == i] for i in range(len(self.CLASSES))]
+            keypoint_result = [kpts[labels == i] for i in range(len(self.CLASSES))]
+            segm_result = None
+        elif isinstance(result, tuple):
+            # 3D结果为(bbox, kpt, depth, scale_factor)
+            bbox_result, keypoint_result = result[:2]  # [100, 5], [100, 17, 3]
             segm_result = None
         else:
             bbox_result, segm_result, keypoint_result = result, None, None
@@ -354,6 +460,13 @@ class PETR3D(DETR):
                             (169, 209, 142), (255, 255, 0), (0, 176, 240),
                             (252, 176, 243), (0, 176, 240), (252, 176, 243),
                             (0, 176, 240), (252, 176, 243)]
+        elif num_keypoint == 15:
+            # MuCo/MuPoTS关键点顺序, 见JointDataset
+            colors_hp = [(236, 6, 124), (236, 6, 124), (236, 6, 124),
+                            (169, 209, 142), (169, 209, 142), (169, 209, 142),
+                            (0, 176, 240), (0, 176, 240), (0, 176, 240),
+                            (255, 255, 0), (255, 255, 0), (255, 255, 0),
+                            (252, 176, 243), (252, 176, 243), (252, 176, 243)]
         else:
             raise ValueError(f'unsupported keypoint amount {num_keypoint}')
         colors_hp = [color[::-1] for color in colors_hp]
@@ -401,6 +514,15 @@ class PETR3D(DETR):
                     (169, 209, 142), (255, 255, 0), (255, 255, 0), (255, 102, 0),
                     (0, 176, 240), (252, 176, 243), (0, 176, 240), (0, 176, 240),
                     (252, 176, 243), (252, 176, 243)]
+        elif num_keypoint == 15:
+            edges = [[0, 1], [0, 2], [0, 9], [9, 10], [10, 11], [0, 3], [3, 4],
+                     [4, 5], [2, 12], [12, 13], [13, 14], [2, 6], [6, 7],
+                     [7, 8]]
+            ec = [(236, 6, 124), (236, 6, 124), (255, 255, 0), (255, 255, 0),
+                    (255, 255, 0), (169, 209, 142), (169, 209, 142),
+                    (169, 209, 142), (252, 176, 243), (252, 176, 243),
+                    (252, 176, 243), (0, 176, 240), (0, 176, 240),
+                    (0, 176, 240)]
         else:
             raise ValueError(f'unsupported keypoint amount {num_keypoint}')
         ec = [color[::-1] for color in ec]
@@ -37,10 +37,8 @@ def center_focal_loss(pred, gt, mask=None):
     pos_loss = pos_loss.sum()
     neg_loss = neg_loss.sum()
 
-    if num_pos == 0:
-        loss = loss - neg_loss
-    else:
-        loss = loss - (pos_loss + neg_loss) / num_pos
+    # num_pos为0时pos_loss也为0, 等价于 loss - neg_loss, 且不需要同步到host
+    loss = loss - (pos_loss + neg_loss) / num_pos.clamp(min=1)
     return loss
 
 
@@ -412,7 +412,7 @@ class MultiScaleDeformablePoseAttention(BaseModule):
             raise ValueError(
                 f'Last dim of reference_points must be'
                 f' 2K, but get {reference_points.shape[-1]} instead.')
-        if torch.cuda.is_available():
+        if torch.cuda.is_available() and value.is_cuda:
             output = MultiScaleDeformableAttnFunction.apply(  # [1, 300, 256]
                 value, spatial_shapes, level_start_index, sampling_locations,
                 attention_weights, self.im2col_step)
@@ -1,9 +1,11 @@
 # Copyright (c) Hikvision Research Institute. All rights reserved.
 import math
 import warnings
+from types import MethodType
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint as cp
 from torch.nn.init import normal_
 from mmcv.cnn import constant_init, xavier_init
 from mmcv.cnn.bricks.transformer import (BaseTransformerLayer,
@@ -15,10 +17,40 @@ from mmcv.runner.base_module import BaseModule
 from mmdet.models.utils.transformer import (DeformableDetrTransformer,
                                             Transformer, inverse_sigmoid)
 
+from opera.core.runner import profile_stage
 from .builder import (TRANSFORMER, ATTENTION, TRANSFORMER_LAYER_SEQUENCE,
                         build_transformer_layer_sequence)
 
 
+def _checkpoint_forward(self, *args, **kwargs):
+    """以activation checkpoint的方式调用层的forward。
+
+    reentrant的checkpoint只追踪按位置传入的tensor, 因此将所有tensor参数
+    (包括关键字参数)按位置传入, 其余参数通过闭包传入。没有需要梯度的输入时
+    (例如测试阶段)直接调用forward。
+    """
+    forward = type(self).forward
+    values = list(args) + list(kwargs.values())
+    tensor_inds = [
+        i for i, value in enumerate(values) if isinstance(value, torch.Tensor)
+    ]
+    tensors = [values[i] for i in tensor_inds]
+    if not (torch.is_grad_enabled() and
+            any(tensor.requires_grad for tensor in tensors)):
+        return forward(self, *args, **kwargs)
+    num_args = len(args)
+    names = list(kwargs)
+
+    def _inner_forward(*tensors):
+        inputs = list(values)
+        for i, tensor in zip(tensor_inds, tensors):
+            inputs[i] = tensor
+        return forward(self, *inputs[:num_args],
+                       **dict(zip(names, inputs[num_args:])))
+
+    return cp.checkpoint(_inner_forward, *tensors)
+
+
 @ATTENTION.register_module()
 class MultiScaleDeformablePoseAttention3D(BaseModule):
     """An attention module used in PETR. `End-to-End Multi-Person
@@ -185,7 +217,7 @@ class MultiScaleDeformablePoseAttention3D(BaseModule):
             raise ValueError(
                 f'Last dim of reference_points must be'
                 f' 2K, but get {reference_points.shape[-1]} instead.')
-        if torch.cuda.is_available():
+        if torch.cuda.is_available() and value.is_cuda:
             output = MultiScaleDeformableAttnFunction.apply(  # [1, 300, 256]
                 value, spatial_shapes, level_start_index, sampling_locations,
                 attention_weights, self.im2col_step)
@@ -311,8 +343,16 @@ class PETRTransformer3D(Transformer):
             Default: 4.
         two_stage_num_proposals (int): Number of proposals when set
             `as_two_stage` as True. Default: 300.
+        with_cp (bool | Sequence[str]): 对哪些层序列的每一层使用activation
+            checkpoint, 可选 'encoder', 'hm_encoder', 'decoder',
+            'refine_decoder', True 表示全部。反向传播时重新计算层内的中间结果,
+            以计算量换显存。只替换层实例的forward, 不改变state_dict。
+            Default: False.
     """
 
+    CP_LAYER_SEQUENCES = ('encoder', 'hm_encoder', 'decoder',
+                          'refine_decoder')
+
     def __init__(self,
                 hm_encoder=dict(
                     type='DetrTransformerEncoder',
@@ -351,6 +391,7 @@ class PETRTransformer3D(Transformer):
                 num_feature_levels=4,
                 two_stage_num_proposals=300,
                 num_keypoints=15,
+                with_cp=False,
                 **kwargs):
         super(PETRTransformer3D, self).__init__(**kwargs)
         self.as_two_stage = as_two_stage
@@ -361,6 +402,24 @@ class PETRTransformer3D(Transformer):
         self.init_layers()
         self.hm_encoder = build_transformer_layer_sequence(hm_encoder)
         self.refine_decoder = build_transformer_layer_sequence(refine_decoder)
+        self.with_cp = with_cp
+        self.init_checkpoint()
+
+    def init_checkpoint(self):
+        """为with_cp中的层序列开启activation checkpoint"""
+        if self.with_cp is True:
+            names = self.CP_LAYER_SEQUENCES
+        elif not self.with_cp:
+            names = ()
+        else:
+            names = [self.with_cp] if isinstance(self.with_cp, str) else \
+                list(self.with_cp)
+        for name in names:
+            assert name in self.CP_LAYER_SEQUENCES, \
+                f'with_cp does not support {name}'
+            for layer in getattr(self, name).layers:
+                # 绑定到实例上, deepcopy时会随实例一起复制
+                layer.forward = MethodType(_checkpoint_forward, layer)
 
     def init_layers(self):
         """Initialize layers of the DeformableDetrTransformer."""
@@ -610,17 +669,18 @@ class PETRTransformer3D(Transformer):
         lvl_pos_embed_flatten = lvl_pos_embed_flatten.permute(
             1, 0, 2)  # (sun(h*w), bs, embed_dims)
         # 调用 ./mmdet/models/utils/transformer.py TransformerLayerSequence.fprwaed()
-        memory = self.encoder(  # the refined multi-scale visual feature memory F, [sum(h*w), bs, 256]
-            query=feat_flatten,
-            key=None,
-            value=None,
-            query_pos=lvl_pos_embed_flatten,
-            query_key_padding_mask=mask_flatten,
-            spatial_shapes=spatial_shapes,
-            reference_points=reference_points,
-            level_start_index=level_start_index,
-            valid_ratios=valid_ratios,
-            **kwargs)
+        with profile_stage('encoder'):
+            memory = self.encoder(  # the refined multi-scale visual feature memory F, [sum(h*w), bs, 256]
+                query=feat_flatten,
+                key=None,
+                value=None,
+                query_pos=lvl_pos_embed_flatten,
+                query_key_padding_mask=mask_flatten,
+                spatial_shapes=spatial_shapes,
+                reference_points=reference_points,
+                level_start_index=level_start_index,
+                valid_ratios=valid_ratios,
+                **kwargs)
 
         memory = memory.permute(1, 0, 2)  # [bs, sum(h*w), 256]
         bs, _, c = memory.shape
@@ -635,17 +695,18 @@ class PETRTransformer3D(Transformer):
             hm_reference_points = reference_points[
                 :, level_start_index[0]:level_start_index[1], [0], :]  # [bs, h1 * w1, level_0, 2]
             hm_memory = hm_memory.permute(1, 0, 2) # [h1 * w1, bs, 256]
-            hm_memory = self.hm_encoder(  # [h1 * w1, bs, 256]
-                query=hm_memory,
-                key=None,
-                value=None,
-                query_pose=hm_pos_embed,
-                query_key_padding_mask=hm_mask,
-                spatial_shapes=spatial_shapes[[0]],
-                reference_points=hm_reference_points,
-                level_start_index=level_start_index[0],
-                valid_ratios=valid_ratios[:, [0], :],
-                **kwargs)
+            with profile_stage('hm_encoder'):
+                hm_memory = self.hm_encoder(  # [h1 * w1, bs, 256]
+                    query=hm_memory,
+                    key=None,
+                    value=None,
+                    query_pose=hm_pos_embed,
+                    query_key_padding_mask=hm_mask,
+                    spatial_shapes=spatial_shapes[[0]],
+                    reference_points=hm_reference_points,
+                    level_start_index=level_start_index[0],
+                    valid_ratios=valid_ratios[:, [0], :],
+                    **kwargs)
             hm_memory = hm_memory.permute(1, 0, 2).reshape(bs,  # [bs, h1, w1, 256]
                 spatial_shapes[0, 0], spatial_shapes[0, 1], -1)
             hm_proto = (hm_memory, mlvl_masks[0])  # tuple
@@ -706,20 +767,21 @@ class PETRTransformer3D(Transformer):
         query = query.permute(1, 0, 2)  # [300, bs, 256]
         memory = memory.permute(1, 0, 2)  # [sum(h*w), bs, 256]
         query_pos = query_pos.permute(1, 0, 2)  # [300, bs, 256]
-        inter_states, inter_references, inter_depths = self.decoder(  # [num_dec, 300, bs, 256], [num_dec, bs, 300, 30]
-            query=query,
-            key=None,
-            value=memory,
-            query_pos=query_pos,
-            key_padding_mask=mask_flatten,
-            reference_points=reference_points,
-            kpts_depth=kpts_depth,
-            spatial_shapes=spatial_shapes,
-            level_start_index=level_start_index,
-            valid_ratios=valid_ratios,
-            kpt_branches=kpt_branches, 
-            depth_branches=depth_branches,
-            **kwargs)
+        with profile_stage('decoder'):  # pose decoder
+            inter_states, inter_references, inter_depths = self.decoder(  # [num_dec, 300, bs, 256], [num_dec, bs, 300, 30]
+                query=query,
+                key=None,
+                value=memory,
+                query_pos=query_pos,
+                key_padding_mask=mask_flatten,
+                reference_points=reference_points,
+                kpts_depth=kpts_depth,
+                spatial_shapes=spatial_shapes,
+                level_start_index=level_start_index,
+                valid_ratios=valid_ratios,
+                kpt_branches=kpt_branches,
+                depth_branches=depth_branches,
+                **kwargs)
 
         if self.as_two_stage:
             return inter_states, inter_references, inter_depths, \
@@ -781,18 +843,19 @@ class PETRTransformer3D(Transformer):
         pos_memory = memory[:, img_inds, :]  # [sum(h*w), num_gts, 256]
         mask_flatten = mask_flatten[img_inds, :]  # [num_gts, sum(h*w)]
         valid_ratios = valid_ratios[img_inds, ...]  # [num_gts, 4, 2]
-        inter_states, inter_references = self.refine_decoder(  # joint decoder
-            query=query,
-            key=None,
-            value=pos_memory,
-            query_pos=query_pos,
-            key_padding_mask=mask_flatten,
-            reference_points=reference_points,
-            spatial_shapes=spatial_shapes,
-            level_start_index=level_start_index,
-            valid_ratios=valid_ratios,
-            reg_branches=kpt_branches,
-            **kwargs)
+        with profile_stage('joint_decoder'):
+            inter_states, inter_references = self.refine_decoder(  # joint decoder
+                query=query,
+                key=None,
+                value=pos_memory,
+                query_pos=query_pos,
+                key_padding_mask=mask_flatten,
+                reference_points=reference_points,
+                spatial_shapes=spatial_shapes,
+                level_start_index=level_start_index,
+                valid_ratios=valid_ratios,
+                reg_branches=kpt_branches,
+                **kwargs)
         # [num_decoder, num_query, num_gts, embed_dim]
         # inter_states: [num_dec, 15, num_gts, 256], inter_references: [num_dec, num_gts, 15, 2]
         init_reference_out = reference_points
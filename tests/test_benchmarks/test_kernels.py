@@ -0,0 +1,431 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 非网络部分热点函数的CPU微基准 (pytest-benchmark), 用于发现性能回归
+#   pytest tests/test_benchmarks --benchmark-only
+#   pytest tests/test_benchmarks --benchmark-only -k assigner
+#   KERNEL_BENCH_SAVE=1 pytest tests/test_benchmarks --benchmark-only
+# 每个case按参数组合 (num_gt, num_query, 图像尺寸等) 展开。baseline文件
+# (默认 work_dirs/kernel_bench/baseline.json, 环境变量 KERNEL_BENCH_BASELINE
+# 修改路径) 存在时, 中位数比baseline慢超过 REGRESSION_TOLERANCE 的case失败。
+# KERNEL_BENCH_SAVE=1 时把本次的中位数写入baseline, 不做比较。
+# 耗时与机器和线程数相关, baseline需要在同一台机器上生成, 计时时使用单线程。
+# 普通的单元测试可以用 --benchmark-skip 跳过这些case。
+import json
+import os
+import os.path as osp
+import platform
+import warnings
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('pytest_benchmark')
+
+from opera.core.bbox import build_assigner  # noqa: E402
+from opera.core.bbox.match_costs import build_match_cost  # noqa: E402
+from opera.core.evaluation import evaluate_mupots  # noqa: E402
+from opera.core.keypoint import (draw_umich_gaussian,  # noqa: E402
+                                 draw_umich_gaussians, gaussian_radius)
+from opera.datasets import JointDataset  # noqa: E402
+from opera.datasets.smap_utils.transforms import (  # noqa: E402
+    AugRandomFlip, AugRandomRotate, AugResize)
+from opera.models.losses import OKSLoss, center_focal_loss  # noqa: E402
+from opera.models.losses.oks_loss import oks_overlaps  # noqa: E402
+
+# 中位数允许变慢的比例, 超过时case失败
+REGRESSION_TOLERANCE = 0.15
+BASELINE_FILE = os.environ.get('KERNEL_BENCH_BASELINE',
+                               'work_dirs/kernel_bench/baseline.json')
+SAVE_BASELINE = os.environ.get('KERNEL_BENCH_SAVE', '0') == '1'
+NUM_KPTS = 15
+# 与 configs/petr/petr_r50_16x2_100e_3d.py 的 train_cfg 一致
+ASSIGNER_CFG = dict(
+    type='opera.PoseHungarianAssigner3D',
+    cls_cost=dict(type='mmdet.FocalLossCost', weight=2.0),
+    kpt_cost=dict(type='opera.KptL1Cost', weight=70.0),
+    oks_cost=dict(type='opera.OksCost', num_keypoints=15, weight=7.0),
+    depth_cost=dict(
+        type='opera.DepthL1Cost', kpt_depth_weight=1, refer_depth_weight=1))
+
+pytestmark = pytest.mark.benchmark(
+    group='kernels', disable_gc=True, warmup=True, warmup_iterations=3)
+
+
+def _environment():
+    return dict(
+        host=platform.node(),
+        torch_version=torch.__version__,
+        num_threads=torch.get_num_threads())
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    """{case: 中位数(秒)}, 模块结束时按需写回baseline文件"""
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    saved = dict(env=_environment(), results=dict())
+    if osp.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            saved = json.load(f)
+    current = dict()
+    yield saved, current
+    if SAVE_BASELINE and current:
+        saved['env'] = _environment()
+        saved['results'].update(current)
+        os.makedirs(osp.dirname(osp.abspath(BASELINE_FILE)), exist_ok=True)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(saved, f, indent=2)
+    torch.set_num_threads(num_threads)
+
+
+@pytest.fixture
+def kernel_benchmark(benchmark, baseline, request):
+    """计时 ``fn``, 中位数比baseline慢超过REGRESSION_TOLERANCE时失败"""
+    saved, current = baseline
+
+    def run(fn, grad=False):
+        with torch.enable_grad() if grad else torch.no_grad():
+            benchmark(fn)
+        if benchmark.stats is None:
+            # --benchmark-disable 时只调用一次, 没有统计
+            return
+        case = request.node.name
+        median = benchmark.stats.stats.median
+        current[case] = median
+        base = saved['results'].get(case)
+        if SAVE_BASELINE or base is None:
+            return
+        env = _environment()
+        if any(saved['env'].get(k) != v for k, v in env.items()):
+            warnings.warn(f'{case}: the baseline was recorded with '
+                          f'{saved["env"]}, not {env}, skip the comparison')
+            return
+        ratio = median / base - 1
+        assert ratio <= REGRESSION_TOLERANCE, \
+            f'{case}: median {median * 1e3:.3f} ms is {ratio:.1%} slower ' \
+            f'than the baseline {base * 1e3:.3f} ms'
+
+    return run
+
+
+# ----------------------------------------------------------------------------
+# 合成数据, 范围与MuCo训练时的gt接近, 所有关键点可见
+# ----------------------------------------------------------------------------
+
+
+def random_bodys(num_gt, img_h, img_w, rng):
+    """gt关键点 [num_gt, 15, 11]: [x, y, Z, v, X, Y, Z, fx, fy, cx, cy]"""
+    bodys = np.zeros((num_gt, NUM_KPTS, 11), dtype=np.float32)
+    bodys[..., 0] = rng.uniform(0, img_w - 1, (num_gt, NUM_KPTS))
+    bodys[..., 1] = rng.uniform(0, img_h - 1, (num_gt, NUM_KPTS))
+    depth = rng.uniform(200, 800, (num_gt, NUM_KPTS))
+    bodys[..., 2] = depth
+    bodys[..., 3] = 1
+    bodys[..., 4:6] = rng.uniform(-100, 100, (num_gt, NUM_KPTS, 2))
+    bodys[..., 6] = depth
+    bodys[..., 7:9] = 1500.
+    bodys[..., 9] = img_w / 2
+    bodys[..., 10] = img_h / 2
+    return bodys
+
+
+def bodys2bboxes(bodys):
+    """关键点的外接框 [num_gt, 4], (x1, y1, x2, y2)"""
+    x1y1 = bodys[..., :2].min(1)
+    x2y2 = bodys[..., :2].max(1) + 1
+    return np.concatenate([x1y1, x2y2], axis=1)
+
+
+def smap_results(num_gt, img_h, img_w, rng):
+    """SMAP数据增强的输入"""
+    bodys = random_bodys(num_gt, img_h, img_w, rng)
+    bboxes = bodys2bboxes(bodys)
+    img = rng.integers(0, 256, (img_h, img_w, 3), dtype=np.uint8)
+    return dict(
+        img=img,
+        img_shape=img.shape,
+        ori_shape=img.shape,
+        img_fields=['img'],
+        bbox_fields=['gt_bboxes'],
+        keypoint_fields=['gt_keypoints'],
+        gt_bboxes=bboxes,
+        gt_labels=np.zeros(num_gt, dtype=np.int64),
+        gt_keypoints=bodys,
+        gt_vis_flag=bodys[..., 3].copy(),
+        gt_areas=(bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1]),
+        dataset='MUCO')
+
+
+# ----------------------------------------------------------------------------
+# match costs 与 assigner
+# ----------------------------------------------------------------------------
+
+
+def _cost_inputs(num_gt, num_query, img_h=800, img_w=1333, seed=0):
+    rng = np.random.default_rng(seed)
+    bodys = torch.from_numpy(random_bodys(num_gt, img_h, img_w, rng))
+    torch.manual_seed(seed)
+    kpt_pred = torch.rand(num_query, NUM_KPTS, 2)
+    factor = bodys.new_tensor([img_w, img_h])
+    return bodys, kpt_pred, factor
+
+
+@pytest.mark.parametrize('num_query', [100, 300])
+@pytest.mark.parametrize('num_gt', [1, 10, 30])
+def test_kpt_l1_cost(kernel_benchmark, num_gt, num_query):
+    bodys, kpt_pred, factor = _cost_inputs(num_gt, num_query)
+    cost = build_match_cost(dict(type='KptL1Cost', weight=70.0))
+    gt_kpts = bodys[..., :2] / factor
+    valid = bodys[..., 3]
+    kernel_benchmark(lambda: cost(kpt_pred, gt_kpts, valid))
+
+
+@pytest.mark.parametrize('num_query', [100, 300])
+@pytest.mark.parametrize('num_gt', [1, 10, 30])
+def test_oks_cost(kernel_benchmark, num_gt, num_query):
+    bodys, kpt_pred, factor = _cost_inputs(num_gt, num_query)
+    cost = build_match_cost(
+        dict(type='OksCost', num_keypoints=NUM_KPTS, weight=7.0))
+    bboxes = bodys2bboxes(bodys.numpy())
+    areas = torch.from_numpy(
+        (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1]))
+    kpt_pred = kpt_pred * factor
+    kernel_benchmark(
+        lambda: cost(kpt_pred, bodys[..., :2], bodys[..., 3], areas))
+
+
+@pytest.mark.parametrize('num_query', [100, 300])
+@pytest.mark.parametrize('num_gt', [1, 10, 30])
+def test_depth_l1_cost(kernel_benchmark, num_gt, num_query):
+    bodys, _, _ = _cost_inputs(num_gt, num_query)
+    cost = build_match_cost(dict(type='DepthL1Cost'))
+    refer_depth = torch.rand(num_query, 1)
+    kpt_depth = refer_depth + torch.randn(num_query, NUM_KPTS) * 0.01
+    scale = np.ones(4, dtype=np.float32)
+    kernel_benchmark(lambda: cost(refer_depth, kpt_depth, bodys[..., -5:],
+                                  bodys[..., 3], scale))
+
+
+@pytest.mark.parametrize('dataset', ['MUCO', 'COCO'])
+@pytest.mark.parametrize('num_query', [100, 300])
+@pytest.mark.parametrize('num_gt', [1, 10, 30])
+def test_hungarian_assigner_3d(kernel_benchmark, num_gt, num_query, dataset):
+    img_h, img_w = 800, 1333
+    bodys, kpt_pred, _ = _cost_inputs(num_gt, num_query, img_h, img_w)
+    assigner = build_assigner(ASSIGNER_CFG)
+    bboxes = bodys2bboxes(bodys.numpy())
+    areas = torch.from_numpy(
+        (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1]))
+    cls_pred = torch.randn(num_query, 1)
+    depth_pred = torch.rand(num_query, NUM_KPTS + 1)
+    gt_labels = torch.zeros(num_gt, dtype=torch.long)
+    img_meta = dict(
+        img_shape=(img_h, img_w, 3), scale_factor=np.ones(4, np.float32))
+    kpt_pred = kpt_pred.reshape(num_query, -1)
+    kernel_benchmark(lambda: assigner.assign(
+        cls_pred, kpt_pred, depth_pred, gt_labels, bodys, areas, dataset,
+        img_meta))
+
+
+# ----------------------------------------------------------------------------
+# losses 与 heatmap target
+# ----------------------------------------------------------------------------
+
+
+def _oks_inputs(num_pos, seed=0):
+    rng = np.random.default_rng(seed)
+    bodys = torch.from_numpy(random_bodys(num_pos, 800, 1333, rng))
+    kpt_gts = bodys[..., :2].reshape(num_pos, -1)
+    torch.manual_seed(seed)
+    kpt_preds = kpt_gts + torch.randn_like(kpt_gts) * 10
+    bboxes = bodys2bboxes(bodys.numpy())
+    areas = torch.from_numpy(
+        (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1]))
+    return kpt_preds, kpt_gts, bodys[..., 3], areas
+
+
+@pytest.mark.parametrize('num_pos', [10, 100, 1000])
+def test_oks_overlaps(kernel_benchmark, num_pos):
+    kpt_preds, kpt_gts, valids, areas = _oks_inputs(num_pos)
+    sigmas = OKSLoss(num_keypoints=NUM_KPTS).sigmas
+    kernel_benchmark(
+        lambda: oks_overlaps(kpt_preds, kpt_gts, valids, areas, sigmas))
+
+
+@pytest.mark.parametrize('num_pos', [10, 100, 1000])
+def test_oks_loss_fwd_bwd(kernel_benchmark, num_pos):
+    kpt_preds, kpt_gts, valids, areas = _oks_inputs(num_pos)
+    kpt_preds.requires_grad_(True)
+    loss_oks = OKSLoss(num_keypoints=NUM_KPTS, loss_weight=2.0)
+
+    def run():
+        loss_oks(kpt_preds, kpt_gts, valids, areas,
+                 avg_factor=num_pos).backward()
+        kpt_preds.grad = None
+
+    kernel_benchmark(run, grad=True)
+
+
+def _heatmap_inputs(num_gt, img_size, stride=8, seed=0):
+    """编码器heatmap分支的输入, heatmap尺寸为图像的 1/stride"""
+    img_h, img_w = img_size
+    h, w = img_h // stride, img_w // stride
+    rng = np.random.default_rng(seed)
+    bodys = torch.from_numpy(random_bodys(num_gt, h, w, rng))
+    bboxes = torch.from_numpy(bodys2bboxes(bodys.numpy()))
+    radius = torch.clamp(
+        torch.floor(
+            gaussian_radius((bboxes[:, 3] - bboxes[:, 1],
+                             bboxes[:, 2] - bboxes[:, 0]),
+                            min_overlap=0.9)),
+        min=0,
+        max=3)
+    return bodys, radius, h, w
+
+
+@pytest.mark.parametrize('img_size', [(512, 832), (800, 1333)])
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_draw_umich_gaussian(kernel_benchmark, num_gt, img_size):
+    """逐个关键点绘制, PETR 2D的heatmap target"""
+    bodys, radius, h, w = _heatmap_inputs(num_gt, img_size)
+    centers = torch.floor(bodys[..., :2])
+
+    def run():
+        heatmap = torch.zeros(NUM_KPTS, h, w)
+        for j in range(num_gt):
+            for k in range(NUM_KPTS):
+                draw_umich_gaussian(heatmap[k], centers[j, k], radius[j])
+        return heatmap
+
+    kernel_benchmark(run)
+
+
+@pytest.mark.parametrize('img_size', [(512, 832), (800, 1333)])
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_draw_umich_gaussians(kernel_benchmark, num_gt, img_size):
+    """批量绘制, PETRHead3D.loss_heatmap"""
+    bodys, radius, h, w = _heatmap_inputs(num_gt, img_size)
+    centers = torch.floor(bodys[..., :2])
+    valid = bodys[..., 3] > 0
+
+    def run():
+        heatmap = torch.zeros(NUM_KPTS, h, w)
+        return draw_umich_gaussians(heatmap, centers, radius, valid)
+
+    kernel_benchmark(run)
+
+
+@pytest.mark.parametrize('img_size', [(512, 832), (800, 1333)])
+def test_center_focal_loss_fwd_bwd(kernel_benchmark, img_size, batch_size=2):
+    bodys, radius, h, w = _heatmap_inputs(10, img_size)
+    target = torch.zeros(batch_size, NUM_KPTS, h, w)
+    for i in range(batch_size):
+        draw_umich_gaussians(target[i], torch.floor(bodys[..., :2]), radius,
+                             bodys[..., 3] > 0)
+    torch.manual_seed(0)
+    logits = torch.randn(batch_size, NUM_KPTS, h, w, requires_grad=True)
+    mask = torch.ones(batch_size, 1, h, w)
+
+    def run():
+        pred = torch.clamp(logits.sigmoid(), min=1e-4, max=1 - 1e-4)
+        center_focal_loss(pred, target, mask=mask).backward()
+        logits.grad = None
+
+    kernel_benchmark(run, grad=True)
+
+
+# ----------------------------------------------------------------------------
+# SMAP数据增强
+# ----------------------------------------------------------------------------
+
+SMAP_SIZES = [(512, 832), (1080, 1920)]
+
+
+@pytest.mark.parametrize('img_size', SMAP_SIZES)
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_smap_random_flip(kernel_benchmark, num_gt, img_size):
+    results = smap_results(num_gt, *img_size, np.random.default_rng(0))
+    flip = AugRandomFlip(flip_ratio=1.0)
+    # 各个变换都生成新的数组, 浅拷贝即可保证每次调用的输入相同
+    kernel_benchmark(lambda: flip(dict(results)))
+
+
+@pytest.mark.parametrize('img_size', SMAP_SIZES)
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_smap_random_rotate(kernel_benchmark, num_gt, img_size):
+    results = smap_results(num_gt, *img_size, np.random.default_rng(0))
+    rotate = AugRandomRotate(max_rotate_degree=30, rotate_prob=1.0)
+    kernel_benchmark(lambda: rotate(dict(results)))
+
+
+@pytest.mark.parametrize('img_size', SMAP_SIZES)
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_smap_resize(kernel_benchmark, num_gt, img_size):
+    results = smap_results(num_gt, *img_size, np.random.default_rng(0))
+    resize = AugResize(img_scale=(1333, 800), keep_ratio=True)
+    kernel_benchmark(lambda: resize(dict(results)))
+
+
+# ----------------------------------------------------------------------------
+# 评测
+# ----------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('num_pred', [100, 300])
+@pytest.mark.parametrize('num_gt', [5, 30])
+def test_calc_iou_matrix(kernel_benchmark, num_gt, num_pred):
+    rng = np.random.default_rng(0)
+    gt_bboxes = bodys2bboxes(random_bodys(num_gt, 1080, 1920, rng))
+    pred_bboxes = bodys2bboxes(random_bodys(num_pred, 1080, 1920, rng))
+    kernel_benchmark(
+        lambda: JointDataset._calc_iou_matrix(gt_bboxes, pred_bboxes))
+
+
+def _match_inputs(num_gt, seed=0, num_pred=100, img_h=1080, img_w=1920):
+    """一张图片的标注与 (bboxs, kpts, depths, scale_factor) 形式的预测"""
+    rng = np.random.default_rng(seed)
+    bodys = random_bodys(num_gt, img_h, img_w, rng)
+    bboxes = bodys2bboxes(bodys)
+    anno = dict(
+        img_paths='MultiPersonTestSet/TS1/img_000000.jpg',
+        img_width=img_w,
+        img_height=img_h,
+        bodys=bodys,
+        # 标注中的bbox为 [x, y, w, h]
+        bboxs=np.concatenate([bboxes[:, :2], bboxes[:, 2:] - bboxes[:, :2]],
+                             axis=1))
+    pred_bodys = random_bodys(num_pred, img_h, img_w, rng)
+    pred_bboxes = np.concatenate([
+        bodys2bboxes(pred_bodys),
+        np.sort(rng.uniform(0, 1, (num_pred, 1)), axis=0)[::-1]
+    ], axis=1)
+    result = ([pred_bboxes], [pred_bodys[..., :2]],
+              [rng.uniform(0, 1, (num_pred, NUM_KPTS + 1))],
+              [np.ones(4, dtype=np.float32)])
+    return anno, result
+
+
+@pytest.mark.parametrize('num_gt', [1, 5, 30])
+def test_match_single(kernel_benchmark, num_gt):
+    """JointDataset.evaluate 中每张图片的匹配与2D/3D坐标处理"""
+    anno, result = _match_inputs(num_gt)
+    # 只用到不依赖标注文件的helper
+    dataset = JointDataset.__new__(JointDataset)
+    kernel_benchmark(lambda: dataset._match_single(anno, result))
+
+
+@pytest.mark.parametrize('num_images', [100, 1000])
+def test_evaluate_mupots(kernel_benchmark, num_images, num_gt=3):
+    rng = np.random.default_rng(0)
+    pairs = []
+    for i in range(num_images):
+        gt = rng.uniform(-100, 100, (num_gt, 16, 11))
+        gt[..., 3] = 1
+        pairs.append(
+            dict(
+                image_path=f'MultiPersonTestSet/TS{i % 20 + 1}/'
+                f'img_{i:06d}.jpg',
+                pred_3d=rng.uniform(-100, 100, (num_gt, NUM_KPTS, 4)),
+                gt_3d=gt[..., 4:],
+                gt_2d=gt[..., :4]))
+    kernel_benchmark(lambda: evaluate_mupots(pairs).summary())
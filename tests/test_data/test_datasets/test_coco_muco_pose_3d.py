@@ -0,0 +1,120 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import numpy as np
+import pytest
+import torch
+
+from opera.core.keypoint import bbox_kpt2result_3d_compact
+from opera.datasets.coco_muco_pose_3d import JointDataset
+
+
+def _fake_anno(num_gts):
+    bodys, bboxs = [], []
+    for i in range(num_gts):
+        body = np.zeros((15, 11))
+        body[:, 0] = 100 + 200 * i + np.arange(15)
+        body[:, 1] = 200 + np.arange(15)
+        body[:, 3] = 1
+        body[:, 4:7] = 1000.
+        body[:, 7:9] = 1500.
+        body[:, 9:11] = (1024, 1024)
+        bodys.append(body)
+        bboxs.append([100 + 200 * i, 200, 100, 300])
+    return dict(
+        bodys=bodys,
+        bboxs=bboxs,
+        img_paths='TS1/img_000000.jpg',
+        img_width=2048,
+        img_height=2048)
+
+
+def _fake_preds(num_preds):
+    bboxes = np.zeros((num_preds, 5), np.float32)
+    for i in range(num_preds):
+        bboxes[i] = [100 + 200 * i, 200, 200 + 200 * i, 500, 0.9 - 0.1 * i]
+    kpts = np.random.rand(num_preds, 15, 2).astype(np.float32) * 500
+    depths = np.random.rand(num_preds, 16).astype(np.float32)
+    return bboxes, kpts, depths
+
+
+@pytest.mark.parametrize('float16', [True, False])
+def test_match_single_fewer_preds_than_gts(float16):
+    dataset = JointDataset.__new__(JointDataset)
+    num_gts, num_preds = 3, 1
+    bboxes, kpts, depths = _fake_preds(num_preds)
+    kwargs = dict() if float16 else dict(float16=False)
+    result = bbox_kpt2result_3d_compact(
+        torch.from_numpy(bboxes),
+        torch.zeros(num_preds, dtype=torch.long),
+        torch.from_numpy(kpts),
+        torch.from_numpy(depths),
+        np.ones(4, np.float32),
+        score_thr=0.5,
+        min_k=1,
+        **kwargs)
+    assert len(result) == num_preds
+
+    pair = dataset._match_single(_fake_anno(num_gts), result)
+    pred_2d = np.array(pair['pred_2d'])
+    assert pred_2d.shape == (num_gts, 15, 4)
+    assert np.array(pair['gt_2d']).shape == (num_gts, 16, 4)
+    # 唯一的预测与第一个gt匹配, 其余gt对应补齐的全零预测
+    np.testing.assert_allclose(pred_2d[0, :, :2], kpts[0], rtol=1e-3)
+    assert (pred_2d[1:, :, 3] == 0).all()
+
+
+def test_pred_indexs_by_scores_ignores_padding():
+    dataset = JointDataset.__new__(JointDataset)
+    gt_bboxs = np.array([[0, 0, 10, 10], [20, 20, 30, 30]], np.float64)
+    # 第二行为补齐的全零预测, 不满足x1 < x2
+    pred_bboxs = np.array([[20, 20, 30, 30, 0.9], [0, 0, 0, 0, 0]],
+                          np.float16)
+    pred_indexs = dataset._get_pred_indexs_by_scores(gt_bboxs, pred_bboxs, 1)
+    assert list(pred_indexs) == [1, 0]
+
+
+class _FakeContainer:
+
+    def __init__(self, data):
+        self._data = data
+
+
+def _retry_dataset(retry_max_workers=4):
+    """每个样本第一次增强返回None, 第二次成功"""
+    dataset = JointDataset.__new__(JointDataset)
+    dataset.test_mode = False
+    dataset.retry_max_workers = retry_max_workers
+    dataset.retry_counts = torch.zeros(
+        (retry_max_workers + 1, 2), dtype=torch.int64).share_memory_()
+    dataset._retry_row = None
+    calls = dict()
+
+    def prepare_train_img(idx, preset_scale=None):
+        calls[idx] = calls.get(idx, 0) + 1
+        if calls[idx] == 1:
+            return None
+        return dict(gt_bboxes=_FakeContainer(torch.ones(1, 4)), idx=idx)
+
+    dataset.prepare_train_img = prepare_train_img
+    dataset._rand_another = lambda idx: idx
+    return dataset
+
+
+@pytest.mark.parametrize('num_workers', [0, 3])
+def test_retry_counts_per_worker(num_workers):
+    num_samples = 24
+    dataset = _retry_dataset()
+    loader = torch.utils.data.DataLoader(
+        list(range(num_samples)),
+        batch_size=4,
+        num_workers=num_workers,
+        # 在worker中取样, 重试计数由worker累加
+        collate_fn=lambda idxs: [dataset[i]['idx'] for i in idxs])
+    seen = [idx for batch in loader for idx in batch]
+    assert sorted(seen) == list(range(num_samples))
+    assert dataset.get_retry_counts() == (num_samples, num_samples)
+    # worker只写自己的一行, 主进程的第0行没有被写入
+    if num_workers > 0:
+        assert dataset.retry_counts[0].sum() == 0
+        assert (dataset.retry_counts[1:num_workers + 1, 0] > 0).all()
+    dataset.reset_retry_counts()
+    assert dataset.get_retry_counts() == (0, 0)
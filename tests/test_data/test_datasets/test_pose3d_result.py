@@ -0,0 +1,54 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import os.path as osp
+import tempfile
+
+import numpy as np
+
+from opera.datasets.smap_utils.pose3d_result import (Pose3DResultReader,
+                                                     Pose3DResultWriter)
+
+
+def _fake_pair(num_people, image_path):
+    return dict(
+        pred_2d=np.random.rand(num_people, 15, 4),
+        pred_3d=np.random.rand(num_people, 15, 4),
+        root_d=np.random.rand(num_people),
+        gt_2d=np.random.rand(num_people, 16, 4),
+        gt_3d=np.random.rand(num_people, 16, 7),
+        image_path=image_path)
+
+
+def test_pose3d_result_roundtrip():
+    pairs = [_fake_pair(n, f'TS1/img_{i:06d}.jpg') for i, n in enumerate(
+        (2, 0, 3))]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = osp.join(tmpdir, 'output.pose3d')
+        with Pose3DResultWriter(path) as writer:
+            for pair in pairs:
+                writer.add(pair)
+        reader = Pose3DResultReader(path)
+        assert len(reader) == len(pairs)
+        assert reader.num_people == 5
+        for pair, loaded in zip(pairs, reader):
+            assert loaded['image_path'] == pair['image_path']
+            for name in ('pred_2d', 'pred_3d', 'root_d', 'gt_2d', 'gt_3d'):
+                np.testing.assert_allclose(
+                    loaded[name], pair[name], rtol=1e-6)
+
+
+def test_pose3d_result_rank_parts():
+    pairs = [_fake_pair(1, f'TS1/img_{i:06d}.jpg') for i in range(5)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = osp.join(tmpdir, 'output.pose3d')
+        # 分布式流式评测时rank r处理第 r, r + world_size, ... 张图像
+        for rank in range(2):
+            with Pose3DResultWriter(osp.join(path, f'rank_{rank}')) as writer:
+                for pair in pairs[rank::2]:
+                    writer.add(pair)
+        reader = Pose3DResultReader(path)
+        assert len(reader) == len(pairs)
+        assert reader.num_people == len(pairs)
+        assert sorted(p['image_path'] for p in reader) == \
+            [p['image_path'] for p in pairs]
+        np.testing.assert_allclose(reader[-1]['pred_3d'],
+                                   pairs[3]['pred_3d'], rtol=1e-6)
@@ -0,0 +1,45 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import numpy as np
+
+from opera.datasets.smap_utils.transforms import AugCrop
+
+
+def _fake_results(rng, num_persons=4, img_shape=(300, 400)):
+    img_h, img_w = img_shape
+    keypoints = np.zeros((num_persons, 15, 11), np.float32)
+    keypoints[..., 0] = rng.uniform(0, img_w, (num_persons, 15))
+    keypoints[..., 1] = rng.uniform(0, img_h, (num_persons, 15))
+    keypoints[..., 3] = rng.rand(num_persons, 15) > 0.3
+    x1y1 = keypoints[..., :2].min(1)
+    x2y2 = keypoints[..., :2].max(1)
+    bboxes = np.concatenate([x1y1, x2y2], axis=1).astype(np.float32)
+    return dict(
+        img=np.zeros((img_h, img_w, 3), np.uint8),
+        img_prefix='',
+        gt_bboxes=bboxes,
+        gt_keypoints=keypoints,
+        gt_vis_flag=keypoints[..., 3].copy(),
+        gt_labels=np.zeros(num_persons, np.int64),
+        gt_areas=np.ones(num_persons, np.float32))
+
+
+def test_crop_has_valid_gt_matches_crop_data():
+    rng = np.random.RandomState(0)
+    transform = AugCrop.__new__(AugCrop)
+    transform.allow_preset_scale = False
+    crop_size = (160, 320)
+    num_valid = 0
+    for _ in range(200):
+        results = _fake_results(rng, num_persons=rng.randint(1, 5))
+        offset_h = rng.randint(0, 300 - 100)
+        offset_w = rng.randint(0, 400 - 100)
+        expected = transform._crop_has_valid_gt(results, offset_w, offset_h,
+                                                crop_size)
+        transform._sample_offset = lambda *args: (offset_h, offset_w)
+        cropped = transform._crop_data(results, crop_size, False)
+        # AugPostProcess删除vis全为零的人, 之后没有gt时JointDataset重试
+        actual = cropped is not None and \
+            bool((cropped['gt_keypoints'][..., 3] > 0).any())
+        assert expected == actual
+        num_valid += actual
+    assert 0 < num_valid < 200
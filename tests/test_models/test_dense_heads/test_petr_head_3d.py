@@ -0,0 +1,109 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+import os.path as osp
+import warnings
+from collections import Counter
+
+import numpy as np
+import pytest
+import torch
+from mmcv import Config
+
+import opera
+from opera.models import build_model
+
+CONFIG = osp.join(
+    osp.dirname(__file__), '../../../configs/petr/petr_r50_16x2_100e_3d.py')
+# 每个iteration中opera代码(不含CPU上的Hungarian匹配)的同步次数上限。
+# 目前剩下的同步: 正样本的nonzero(decoder各层合并一次, encoder proposal一次,
+# refine一次)与OKSLoss中有效关键点的检查, 其余为余量。loss中新增的
+# .item()、按层的nonzero等会超出。
+SYNC_BUDGET = 10
+# Hungarian匹配在CPU上进行, 同步次数与gt个数有关, 不计入
+EXCLUDED_SITES = ('assigners', 'match_costs')
+
+
+def _fake_inputs(num_imgs=2, num_gts=2, img_size=(320, 320), device='cuda'):
+    img_h, img_w = img_size
+    rng = np.random.RandomState(0)
+    img_metas, gt_bboxes, gt_labels, gt_keypoints, gt_areas = \
+        [], [], [], [], []
+    for _ in range(num_imgs):
+        img_metas.append(
+            dict(
+                img_shape=(img_h, img_w, 3),
+                ori_shape=(img_h, img_w, 3),
+                pad_shape=(img_h, img_w, 3),
+                scale_factor=np.ones(4, dtype=np.float32),
+                flip=False))
+        kpts = np.zeros((num_gts, 15, 11), dtype=np.float32)
+        kpts[..., 0] = rng.uniform(40, img_w - 40, (num_gts, 15))
+        kpts[..., 1] = rng.uniform(40, img_h - 40, (num_gts, 15))
+        kpts[..., 3] = 1
+        kpts[..., 6] = rng.uniform(300, 500, (num_gts, 15))
+        kpts[..., 7:9] = 1500.
+        kpts[..., 9] = img_w / 2
+        kpts[..., 10] = img_h / 2
+        kpts[..., 2] = kpts[..., 6]
+        bboxes = np.concatenate(
+            [kpts[..., :2].min(1), kpts[..., :2].max(1)], -1)
+        gt_keypoints.append(torch.from_numpy(kpts).to(device))
+        gt_bboxes.append(torch.from_numpy(bboxes).to(device))
+        gt_labels.append(torch.zeros(num_gts, dtype=torch.long, device=device))
+        gt_areas.append(
+            torch.from_numpy((bboxes[:, 2] - bboxes[:, 0]) *
+                             (bboxes[:, 3] - bboxes[:, 1])).to(device))
+    return dict(
+        img=torch.randn(num_imgs, 3, img_h, img_w, device=device),
+        img_metas=img_metas,
+        dataset=['MUCO'] * num_imgs,
+        gt_bboxes=gt_bboxes,
+        gt_labels=gt_labels,
+        gt_keypoints=gt_keypoints,
+        gt_areas=gt_areas)
+
+
+def _train_iter(model, inputs):
+    losses = model(return_loss=True, **inputs)
+    loss = sum(v for k, v in losses.items() if 'loss' in k)
+    loss.backward()
+
+
+def _count_syncs(fn):
+    """用sync debug mode按调用位置统计fn中的同步次数"""
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            fn()
+        finally:
+            torch.cuda.set_sync_debug_mode('default')
+    return Counter(f'{record.filename}:{record.lineno}' for record in records
+                   if 'synchroniz' in str(record.message))
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='requires CUDA support')
+def test_petr_head_3d_host_sync_budget():
+    cfg = Config.fromfile(CONFIG)
+    cfg.model.backbone.init_cfg = None
+    model = build_model(cfg.model).cuda()
+    model.train()
+    inputs = _fake_inputs()
+
+    # 第一个iteration包括cudnn的选择等初始化
+    _train_iter(model, inputs)
+    model.zero_grad()
+    torch.cuda.synchronize()
+
+    call_sites = _count_syncs(lambda: _train_iter(model, inputs))
+    opera_root = osp.dirname(opera.__file__) + osp.sep
+    opera_sites = Counter({
+        site: count
+        for site, count in call_sites.items()
+        if site.startswith(opera_root) and not any(
+            name in site for name in EXCLUDED_SITES)
+    })
+    num_syncs = sum(opera_sites.values())
+    assert num_syncs <= SYNC_BUDGET, \
+        f'{num_syncs} host syncs per iteration exceed the budget ' \
+        f'{SYNC_BUDGET}: {opera_sites.most_common()}'
@@ -0,0 +1,312 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# PETR3D推理的基准测试, 不包括数据加载与评测
+#   python tools/analysis_tools/benchmark_3d.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py --checkpoint xxx.pth \
+#       --shapes 800x1333 512x832 --batch-sizes 1 2 --out bench.json
+#   CPU: --device cpu --num-threads 16
+# --source dataset 时使用测试集的前几张图片 (经过测试pipeline), 此时输入
+# 尺寸由pipeline决定, --shapes 不起作用。
+# batch size > 1 时get_bboxes中每张图片的joint decoder都使用第一张图片的
+# memory (见 PETRHead3D._get_bboxes_single), 计算量相同, 只用于计时。
+# RSS峰值是整个进程的峰值, 因此默认每个 (shape, batch size) 在新的子进程
+# 中运行, peak_rss_mb 只包含该设置 (包括模型构建与warmup)。ru_maxrss在exec
+# 之后仍保留父进程的峰值, 所以优先读取/proc/self/status中的VmHWM。
+# --in-process 时所有设置在同一进程中运行, peak_rss_mb 为到目前为止的峰值。
+import argparse
+import copy
+import json
+import os.path as osp
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from mmcv import Config, DictAction
+from mmcv.cnn import fuse_conv_bn
+from mmcv.parallel import collate, scatter
+from mmcv.runner import load_checkpoint, wrap_fp16_model
+from mmcv.utils import get_git_hash
+from mmdet.utils import get_device, replace_cfg_vals, update_data_root
+
+from opera.core.runner import StageProfiler
+from opera.datasets import build_dataset, replace_ImageToTensor
+from opera.models import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark PETR3D inference')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument(
+        '--checkpoint', help='checkpoint file, random weights if not given')
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default=None,
+        help='defaults to cuda if available')
+    parser.add_argument(
+        '--num-threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument(
+        '--source',
+        choices=['synthetic', 'dataset'],
+        default='synthetic',
+        help='random images or the first images of data.test')
+    parser.add_argument(
+        '--shapes',
+        nargs='+',
+        default=['800x1333'],
+        help='input shapes HxW of synthetic images')
+    parser.add_argument(
+        '--batch-sizes', type=int, nargs='+', default=[1], help='batch sizes')
+    parser.add_argument(
+        '--warmup', type=int, default=5, help='iterations not timed')
+    parser.add_argument(
+        '--iters', type=int, default=50, help='iterations to be timed')
+    parser.add_argument(
+        '--profile-iters',
+        type=int,
+        default=20,
+        help='iterations of the per-stage breakdown, which runs separately '
+        'since it synchronizes at every stage. 0 to disable')
+    parser.add_argument(
+        '--fuse-conv-bn',
+        action='store_true',
+        help='whether to fuse conv and bn')
+    parser.add_argument('--out', help='output json file')
+    parser.add_argument(
+        '--in-process',
+        action='store_true',
+        help='run all settings in this process instead of one subprocess '
+        'per setting, peak_rss_mb then accumulates across settings')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def build_benchmark_model(cfg, args, device):
+    cfg.model.pretrained = None
+    if cfg.model.get('backbone', {}).get('init_cfg') is not None:
+        cfg.model.backbone.init_cfg = None
+    cfg.model.train_cfg = None
+    model = build_model(cfg.model, test_cfg=cfg.get('test_cfg'))
+    if cfg.get('fp16', None) is not None:
+        wrap_fp16_model(model)
+    if args.checkpoint is not None:
+        load_checkpoint(model, args.checkpoint, map_location='cpu')
+    else:
+        model.init_weights()
+    if args.fuse_conv_bn:
+        model = fuse_conv_bn(model)
+    return model.to(device).eval()
+
+
+def synthetic_batches(shape, batch_size, device):
+    """随机图片与对应的img_metas, 图片没有padding"""
+    h, w = shape
+    img = torch.randn(batch_size, 3, h, w, device=device)
+    img_metas = [
+        dict(
+            img_shape=(h, w, 3),
+            ori_shape=(h, w, 3),
+            pad_shape=(h, w, 3),
+            batch_input_shape=(h, w),
+            scale_factor=np.ones(4, dtype=np.float32),
+            flip=False,
+            flip_direction=None) for _ in range(batch_size)
+    ]
+    while True:
+        yield img, img_metas
+
+
+def dataset_batches(cfg, batch_size, device, num_images=16):
+    """测试集前 ``num_images`` 张图片经过pipeline后缓存, 循环组成batch"""
+    if batch_size > 1:
+        cfg.data.test.pipeline = replace_ImageToTensor(cfg.data.test.pipeline)
+    cfg.data.test.test_mode = True
+    dataset = build_dataset(cfg.data.test)
+    samples = [dataset[i] for i in range(min(num_images, len(dataset)))]
+    batches = []
+    for i in range(0, len(samples), batch_size):
+        chunk = samples[i:i + batch_size]
+        if len(chunk) < batch_size:
+            break
+        data = collate(chunk, samples_per_gpu=batch_size)
+        data = scatter(data, [-1 if device == 'cpu' else 0])[0]
+        # 只测试原图, 不使用TTA
+        batches.append((data['img'][0], data['img_metas'][0]))
+    assert batches, f'not enough images for batch size {batch_size}'
+    while True:
+        yield from batches
+
+
+def inference(model, img, img_metas):
+    feat = model.extract_feat(img)
+    return model.bbox_head.simple_test(feat, img_metas, rescale=True)
+
+
+def synchronize(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def peak_rss_mb():
+    """当前进程的RSS峰值, VmHWM在exec时重置, ru_maxrss会继承父进程的峰值"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss在Linux上的单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(model, batches, device, warmup, iters, profile_iters):
+    with torch.no_grad():
+        for _ in range(warmup):
+            inference(model, *next(batches))
+        synchronize(device)
+        if device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+
+        latencies = []
+        num_images = 0
+        for _ in range(iters):
+            img, img_metas = next(batches)
+            start = time.perf_counter()
+            inference(model, img, img_metas)
+            synchronize(device)
+            latencies.append((time.perf_counter() - start) * 1000)
+            num_images += len(img_metas)
+
+        stages = {}
+        if profile_iters > 0:
+            profiler = StageProfiler(window=profile_iters)
+            with profiler:
+                for _ in range(profile_iters):
+                    img, img_metas = next(batches)
+                    start = time.perf_counter()
+                    inference(model, img, img_metas)
+                    synchronize(device)
+                    profiler.add('total', (time.perf_counter() - start) * 1000)
+                    profiler.step()
+            stages = profiler.summary()
+
+    latencies = np.array(latencies)
+    result = dict(
+        fps=num_images / (latencies.sum() / 1000),
+        latency_ms=dict(
+            mean=float(latencies.mean()),
+            p50=float(np.percentile(latencies, 50)),
+            p90=float(np.percentile(latencies, 90)),
+            p99=float(np.percentile(latencies, 99))),
+        stages_ms={
+            name: dict(p50=stats['p50'], p90=stats['p90'], mean=stats['mean'])
+            for name, stats in stages.items()
+        },
+        peak_rss_mb=peak_rss_mb())
+    if device == 'cuda':
+        result['peak_cuda_memory_mb'] = \
+            torch.cuda.max_memory_allocated() / 1024**2
+    return result
+
+
+def run_in_subprocesses(args, settings):
+    """每个设置在新的子进程中运行, 子进程的结果写入临时json后合并"""
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (shape, batch_size) in enumerate(settings):
+            out = osp.join(tmp_dir, f'{i}.json')
+            # argparse中后出现的参数覆盖前面的参数
+            cmd = [sys.executable, __file__] + sys.argv[1:] + [
+                '--batch-sizes',
+                str(batch_size), '--out', out, '--in-process'
+            ]
+            if shape is not None:
+                cmd += ['--shapes', 'x'.join(str(x) for x in shape)]
+            subprocess.run(cmd, check=True)
+            with open(out) as f:
+                child = json.load(f)
+            records.extend(child['results'])
+    return records, child['device'], child['num_threads']
+
+
+def run_settings(cfg, args, settings, device):
+    model = build_benchmark_model(cfg, args, device)
+    records = []
+    for shape, batch_size in settings:
+        if args.source == 'synthetic':
+            batches = synthetic_batches(shape, batch_size, device)
+        else:
+            batches = dataset_batches(copy.deepcopy(cfg), batch_size, device)
+        result = benchmark(model, batches, device, args.warmup, args.iters,
+                           args.profile_iters)
+        record = dict(
+            shape=list(shape) if shape is not None else 'dataset',
+            batch_size=batch_size,
+            **result)
+        records.append(record)
+        latency = result['latency_ms']
+        print(f'shape={record["shape"]} batch_size={batch_size}: '
+              f'{result["fps"]:.2f} img/s, latency p50 '
+              f'{latency["p50"]:.1f} / p90 {latency["p90"]:.1f} / p99 '
+              f'{latency["p99"]:.1f} ms, peak RSS '
+              f'{result["peak_rss_mb"]:.0f} MB')
+        for name, stats in result['stages_ms'].items():
+            print(f'    {name:<16}p50 {stats["p50"]:>9.2f} ms'
+                  f'    mean {stats["mean"]:>9.2f} ms')
+    return records
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg = replace_cfg_vals(cfg)
+    update_data_root(cfg)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    if cfg.get('cudnn_benchmark', False):
+        torch.backends.cudnn.benchmark = True
+    device = args.device or get_device()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    shapes = [tuple(int(x) for x in s.split('x')) for s in args.shapes] \
+        if args.source == 'synthetic' else [None]
+    settings = [(shape, batch_size) for shape in shapes
+                for batch_size in args.batch_sizes]
+
+    if args.in_process:
+        records = run_settings(cfg, args, settings, device)
+        num_threads = torch.get_num_threads()
+    else:
+        records, device, num_threads = run_in_subprocesses(args, settings)
+
+    output = dict(
+        config=args.config,
+        checkpoint=args.checkpoint,
+        git_hash=get_git_hash(),
+        device=device,
+        num_threads=num_threads,
+        torch_version=torch.__version__,
+        host=platform.node(),
+        warmup=args.warmup,
+        iters=args.iters,
+        results=records)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'results saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 比较不同 with_cp 设置下训练一个iteration的峰值显存与耗时
+#   python tools/analysis_tools/benchmark_with_cp.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py \
+#       --settings none encoder decoder encoder,hm_encoder,decoder all
+#   CPU: --device cpu --samples-per-gpu 1
+# 同时统计forward中autograd保存的张量大小 (不含参数, 按storage去重),
+# 这部分正是with_cp减少的显存, CPU上没有峰值显存时以它为准。
+import argparse
+import copy
+import time
+
+import torch
+from mmcv import Config, DictAction
+from mmcv.parallel import MMDataParallel, scatter
+from mmcv.runner import build_optimizer
+from mmdet.utils import get_device, replace_cfg_vals, update_data_root
+
+from opera.datasets import build_dataloader, build_dataset
+from opera.models import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark activation checkpointing of PETRTransformer3D')
+    parser.add_argument('config', help='train config file path')
+    parser.add_argument(
+        '--settings',
+        nargs='+',
+        default=['none', 'encoder', 'decoder', 'all'],
+        help='with_cp settings to compare, "none", "all" or comma separated '
+        'layer sequences, e.g. encoder,hm_encoder')
+    parser.add_argument(
+        '--samples-per-gpu',
+        type=int,
+        default=None,
+        help='batch size, defaults to data.samples_per_gpu of the config')
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default=None,
+        help='defaults to cuda if available')
+    parser.add_argument(
+        '--warmup', type=int, default=3, help='iterations not timed')
+    parser.add_argument(
+        '--iters', type=int, default=10, help='iterations to be timed')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def parse_setting(setting):
+    if setting == 'none':
+        return False
+    if setting == 'all':
+        return True
+    return tuple(setting.split(','))
+
+
+def synchronize(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+class SavedTensorCounter:
+    """统计autograd为backward保存的张量字节数, 参数与共享storage只计一次"""
+
+    def __init__(self, model):
+        self.param_storages = {
+            self._storage(p).data_ptr()
+            for p in model.parameters()
+        }
+        self.storages = dict()
+
+    @staticmethod
+    def _storage(tensor):
+        if hasattr(tensor, 'untyped_storage'):
+            return tensor.untyped_storage()
+        return tensor.storage()
+
+    def pack(self, tensor):
+        storage = self._storage(tensor)
+        if storage.data_ptr() not in self.param_storages:
+            self.storages[(tensor.device, storage.data_ptr())] = \
+                storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self.storages.clear()
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(
+            self.pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+    @property
+    def megabytes(self):
+        return sum(self.storages.values()) / 1024**2
+
+
+def benchmark(cfg, with_cp, data_batch, device, warmup, iters):
+    """返回 (平均每个iteration的秒数, forward保存的张量MB, 峰值显存MB),
+    CPU上峰值显存为None"""
+    cfg = copy.deepcopy(cfg)
+    cfg.model.bbox_head.transformer.with_cp = with_cp
+    model = build_model(
+        cfg.model,
+        train_cfg=cfg.get('train_cfg'),
+        test_cfg=cfg.get('test_cfg'))
+    model.init_weights()
+    if device == 'cuda':
+        model = MMDataParallel(model.cuda(), device_ids=[0])
+    else:
+        # CPU上不使用DataParallel, 直接把DataContainer展开
+        data_batch = scatter(data_batch, [-1])[0]
+    model.train()
+    optimizer = build_optimizer(model, cfg.optimizer)
+    counter = SavedTensorCounter(model)
+
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    elapsed = 0.
+    for i in range(warmup + iters):
+        synchronize(device)
+        start = time.perf_counter()
+        # backward中重新计算时保存的张量是临时的, 不计入
+        with counter:
+            outputs = model.train_step(data_batch, optimizer)
+        optimizer.zero_grad()
+        outputs['loss'].backward()
+        optimizer.step()
+        synchronize(device)
+        if i >= warmup:
+            elapsed += time.perf_counter() - start
+    saved_memory = counter.megabytes
+    peak_memory = None
+    if device == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated() / 1024**2
+    del model, optimizer, outputs
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+    return elapsed / max(iters, 1), saved_memory, peak_memory
+
+
+def format_mb(value):
+    return '-' if value is None else f'{value:.0f}'
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg = replace_cfg_vals(cfg)
+    update_data_root(cfg)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    if cfg.get('cudnn_benchmark', False):
+        torch.backends.cudnn.benchmark = True
+    device = args.device or get_device()
+
+    samples_per_gpu = args.samples_per_gpu or cfg.data.samples_per_gpu
+    dataset = build_dataset(cfg.data.train)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu,
+        cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+    # 所有设置使用同一个batch, 结果只反映模型本身
+    data_batch = next(iter(data_loader))
+
+    print(f'device: {device}, batch size: {samples_per_gpu}, '
+          f'warmup: {args.warmup}, iters: {args.iters}')
+    results = []
+    for setting in args.settings:
+        step_time, saved_memory, peak_memory = benchmark(
+            cfg, parse_setting(setting), data_batch, device, args.warmup,
+            args.iters)
+        results.append((setting, step_time, saved_memory, peak_memory))
+        print(f'with_cp={setting}: {step_time * 1000:.1f} ms/iter, '
+              f'saved tensors {saved_memory:.0f} MB, '
+              f'peak memory {format_mb(peak_memory)} MB')
+
+    print(f'\n{"with_cp":<40}{"ms/iter":>10}{"saved MB":>10}'
+          f'{"peak MB":>10}')
+    for setting, step_time, saved_memory, peak_memory in results:
+        print(f'{setting:<40}{step_time * 1000:>10.1f}{saved_memory:>10.0f}'
+              f'{format_mb(peak_memory):>10}')
+
+
+if __name__ == '__main__':
+    main()
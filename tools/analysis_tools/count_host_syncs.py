@@ -0,0 +1,146 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# 统计训练时每个iteration的device-to-host同步次数
+#   python tools/analysis_tools/count_host_syncs.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py --iters 5
+# 同时使用两种方式统计:
+#   1. torch.profiler 中的 cudaStreamSynchronize / cudaDeviceSynchronize /
+#      cudaMemcpy(DtoH) 等CUDA runtime调用, 以及会同步的aten算子
+#   2. torch.cuda.set_sync_debug_mode('warn'), 按python调用位置汇总
+import argparse
+import warnings
+from collections import Counter
+
+import torch
+from mmcv import Config, DictAction
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import build_optimizer
+from mmdet.utils import replace_cfg_vals, update_data_root
+
+from opera.datasets import build_dataloader, build_dataset
+from opera.models import build_model
+
+SYNC_RUNTIME_CALLS = ('cudaStreamSynchronize', 'cudaDeviceSynchronize',
+                      'cudaEventSynchronize', 'cudaMemcpy')
+# 结果的shape或值需要回到host的算子
+SYNC_ATEN_OPS = ('aten::_local_scalar_dense', 'aten::nonzero',
+                 'aten::masked_select', 'aten::unique', 'aten::_unique2')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Count host syncs per training iteration')
+    parser.add_argument('config', help='train config file path')
+    parser.add_argument(
+        '--samples-per-gpu',
+        type=int,
+        default=None,
+        help='batch size, defaults to data.samples_per_gpu of the config')
+    parser.add_argument(
+        '--warmup', type=int, default=2, help='iterations not counted')
+    parser.add_argument(
+        '--iters', type=int, default=3, help='iterations to be counted')
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='enable the target checks of the head (bbox_head.debug=True)')
+    parser.add_argument(
+        '--topk', type=int, default=20, help='number of call sites to show')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def train_iter(model, optimizer, data_batch):
+    outputs = model.train_step(data_batch, optimizer)
+    optimizer.zero_grad()
+    outputs['loss'].backward()
+    optimizer.step()
+
+
+def count_profiler_events(model, optimizer, data_batch, iters):
+    """返回每个iteration中各类同步事件的平均次数"""
+    with torch.profiler.profile(activities=[
+            torch.profiler.ProfilerActivity.CPU,
+            torch.profiler.ProfilerActivity.CUDA
+    ]) as prof:
+        for _ in range(iters):
+            train_iter(model, optimizer, data_batch)
+        torch.cuda.synchronize()
+    counts = Counter()
+    for event in prof.key_averages():
+        if event.key.startswith(SYNC_RUNTIME_CALLS) or \
+                event.key in SYNC_ATEN_OPS:
+            counts[event.key] += event.count
+    return {key: count / iters for key, count in counts.items()}
+
+
+def count_sync_warnings(model, optimizer, data_batch, iters):
+    """按调用位置返回每个iteration的同步次数"""
+    call_sites = Counter()
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            for _ in range(iters):
+                train_iter(model, optimizer, data_batch)
+        finally:
+            torch.cuda.set_sync_debug_mode('default')
+    for record in records:
+        if 'synchroniz' not in str(record.message):
+            continue
+        call_sites[f'{record.filename}:{record.lineno}'] += 1
+    return {site: count / iters for site, count in call_sites.items()}
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg = replace_cfg_vals(cfg)
+    update_data_root(cfg)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    cfg.model.bbox_head.debug = args.debug
+
+    samples_per_gpu = args.samples_per_gpu or cfg.data.samples_per_gpu
+    dataset = build_dataset(cfg.data.train)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu,
+        cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+    data_batch = next(iter(data_loader))
+
+    model = build_model(
+        cfg.model,
+        train_cfg=cfg.get('train_cfg'),
+        test_cfg=cfg.get('test_cfg'))
+    model.init_weights()
+    model = MMDataParallel(model.cuda(), device_ids=[0])
+    model.train()
+    optimizer = build_optimizer(model, cfg.optimizer)
+
+    for _ in range(args.warmup):
+        train_iter(model, optimizer, data_batch)
+    torch.cuda.synchronize()
+
+    events = count_profiler_events(model, optimizer, data_batch, args.iters)
+    print(f'sync events per iteration (debug={args.debug}):')
+    for key, count in sorted(events.items(), key=lambda x: -x[1]):
+        print(f'    {key:<40}{count:>10.1f}')
+
+    call_sites = count_sync_warnings(model, optimizer, data_batch,
+                                     args.iters)
+    total = sum(call_sites.values())
+    print(f'\nsyncs reported by sync debug mode per iteration: {total:.1f}')
+    for site, count in Counter(call_sites).most_common(args.topk):
+        print(f'    {count:>8.1f}  {site}')
+
+
+if __name__ == '__main__':
+    main()
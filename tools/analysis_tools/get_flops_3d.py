@@ -0,0 +1,393 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+# PETR3D的计算量、参数量与激活显存统计
+#   python tools/analysis_tools/get_flops_3d.py \
+#       configs/petr/petr_r50_16x2_100e_3d.py \
+#       --shapes 512x832 800x1333 --num-queries 100 300 --out flops.json
+# 与mmcv的get_model_complexity_info相同, FLOPs按乘加(MAC)计数。mmcv不支持
+# 的 nn.MultiheadAttention、mmcv MultiScaleDeformableAttention 与
+# MultiScaleDeformablePoseAttention3D 在这里有专门的计数函数, 其中的Linear
+# (value_proj、sampling_offsets、attention_weights、output_proj)单独计数,
+# 计数函数只统计采样位置、softmax、双线性采样与加权求和。
+# 运行的是 forward_dummy 的测试路径, 包括 encoder、decoder、proposal
+# heads以及对 max_per_img 个候选的 refine decoder, 不包括训练时的 heatmap
+# 分支。不在module中的函数式运算(位置编码、inverse_sigmoid等)不计入。
+# 激活显存为前向时autograd保存、用于反向传播的tensor大小(不含参数, 同一个
+# storage只计一次), 按最先保存它的module统计。
+import argparse
+import copy
+import json
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from mmcv import Config, DictAction
+from mmcv.ops.multi_scale_deform_attn import MultiScaleDeformableAttention
+from mmdet.utils import get_device, replace_cfg_vals, update_data_root
+
+from opera.models import build_model
+from opera.models.utils.transformer_3d import \
+    MultiScaleDeformablePoseAttention3D
+
+FLOPS_HANDLES = OrderedDict()
+
+
+def register_flops_handle(*module_types):
+    """注册module的计数函数, 按注册顺序用isinstance匹配。
+
+    计数函数接收 ``(module, args, kwargs, output)``, 返回这次调用的MAC数。
+    """
+
+    def wrapper(handle):
+        for module_type in module_types:
+            FLOPS_HANDLES[module_type] = handle
+        return handle
+
+    return wrapper
+
+
+def get_flops_handle(module):
+    for module_type, handle in FLOPS_HANDLES.items():
+        if isinstance(module, module_type):
+            return handle
+    return None
+
+
+def _get_arg(args, kwargs, index, name):
+    if len(args) > index:
+        return args[index]
+    return kwargs.get(name, None)
+
+
+@register_flops_handle(MultiScaleDeformableAttention,
+                       MultiScaleDeformablePoseAttention3D)
+def deformable_attention_flops(module, args, kwargs, output):
+    """多尺度可变形注意力中Linear之外的部分"""
+    query = _get_arg(args, kwargs, 0, 'query')
+    if module.batch_first:
+        bs, num_query = query.shape[:2]
+    else:
+        num_query, bs = query.shape[:2]
+    num_samples = bs * num_query * module.num_heads * module.num_levels * \
+        module.num_points
+    dim_per_head = module.embed_dims // module.num_heads
+    flops = num_samples * 2  # 采样位置: 参考点 + 偏移
+    flops += num_samples  # attention_weights的softmax
+    flops += num_samples * dim_per_head * 4  # 双线性插值, 每个点4个邻居
+    flops += num_samples * dim_per_head  # 按attention_weights加权求和
+    return flops
+
+
+@register_flops_handle(nn.MultiheadAttention)
+def multihead_attention_flops(module, args, kwargs, output):
+    """输入输出投影、QK^T、softmax与加权求和。
+
+    nn.MultiheadAttention直接使用out_proj的权重, out_proj不会被单独计数。
+    """
+    query = _get_arg(args, kwargs, 0, 'query')
+    key = _get_arg(args, kwargs, 1, 'key')
+    if key is None:
+        key = query
+    if getattr(module, 'batch_first', False):
+        bs, len_q = query.shape[:2]
+        len_k = key.shape[1]
+    else:
+        len_q, bs = query.shape[:2]
+        len_k = key.shape[0]
+    embed_dims = module.embed_dim
+    flops = len_q * embed_dims * embed_dims  # q投影
+    flops += len_k * (module.kdim + module.vdim) * embed_dims  # k, v投影
+    flops += len_q * len_k * embed_dims * 2  # QK^T 与 attn @ V
+    flops += module.num_heads * len_q * len_k  # softmax
+    flops += len_q * embed_dims * embed_dims  # out_proj
+    return bs * flops
+
+
+@register_flops_handle(nn.Conv1d, nn.Conv2d, nn.Conv3d)
+def conv_flops(module, args, kwargs, output):
+    kernel_flops = int(np.prod(module.kernel_size)) * \
+        module.in_channels // module.groups
+    flops = output.numel() * kernel_flops
+    if module.bias is not None:
+        flops += output.numel()
+    return flops
+
+
+@register_flops_handle(nn.Linear)
+def linear_flops(module, args, kwargs, output):
+    return args[0].numel() * module.out_features
+
+
+@register_flops_handle(nn.modules.batchnorm._BatchNorm, nn.GroupNorm,
+                       nn.LayerNorm, nn.modules.instancenorm._InstanceNorm)
+def norm_flops(module, args, kwargs, output):
+    affine = getattr(module, 'affine', False) or \
+        getattr(module, 'elementwise_affine', False)
+    return output.numel() * (2 if affine else 1)
+
+
+@register_flops_handle(nn.ReLU, nn.PReLU, nn.ELU, nn.LeakyReLU, nn.ReLU6,
+                       nn.GELU, nn.Sigmoid)
+def activation_flops(module, args, kwargs, output):
+    return output.numel()
+
+
+@register_flops_handle(nn.MaxPool1d, nn.MaxPool2d, nn.AvgPool1d,
+                       nn.AvgPool2d, nn.AdaptiveMaxPool2d,
+                       nn.AdaptiveAvgPool2d)
+def pool_flops(module, args, kwargs, output):
+    return args[0].numel()
+
+
+@register_flops_handle(nn.Upsample)
+def upsample_flops(module, args, kwargs, output):
+    return output.numel()
+
+
+def _storage_key(tensor):
+    if hasattr(tensor, 'untyped_storage'):
+        storage = tensor.untyped_storage()
+    else:
+        storage = tensor.storage()
+    return storage.data_ptr(), storage.nbytes()
+
+
+class ComplexityCounter:
+    """统计一次前向中每个module的MAC数与保存给反向传播的激活大小。
+
+    有计数函数的module通过替换实例的forward得到完整的参数(包括关键字参数);
+    所有module用forward pre/post hook维护调用栈, 激活保存在栈顶的module上。
+
+    Example:
+        >>> with ComplexityCounter(model) as counter:
+        >>>     model.forward_dummy(img)
+        >>> counter.flops, counter.activations
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.names = {m: name for name, m in model.named_modules()}
+        self.flops = OrderedDict()  # name -> MACs
+        self.activations = OrderedDict()  # name -> bytes
+        self._stack = []
+        self._handles = []
+        self._wrapped = []
+        self._saved = set()
+        self._param_keys = {_storage_key(p) for p in model.parameters()}
+        self._saved_tensors_hooks = None
+
+    def __enter__(self):
+        for module, name in self.names.items():
+            self._handles.append(
+                module.register_forward_pre_hook(self._push))
+            self._handles.append(module.register_forward_hook(self._pop))
+            handle = get_flops_handle(module)
+            if handle is not None:
+                self._wrap_forward(module, name, handle)
+        self._saved_tensors_hooks = torch.autograd.graph.saved_tensors_hooks(
+            self._pack, lambda x: x)
+        self._saved_tensors_hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._saved_tensors_hooks.__exit__(*args)
+        for handle in self._handles:
+            handle.remove()
+        for module, forward in self._wrapped:
+            # with_cp 等替换过实例forward的module恢复原来的实例forward
+            if forward is None:
+                del module.forward
+            else:
+                module.forward = forward
+        self._handles, self._wrapped = [], []
+
+    def _wrap_forward(self, module, name, handle):
+        forward = module.forward
+
+        def counted_forward(*args, **kwargs):
+            output = forward(*args, **kwargs)
+            self.flops[name] = self.flops.get(name, 0) + int(
+                handle(module, args, kwargs, output))
+            return output
+
+        self._wrapped.append((module, module.__dict__.get('forward')))
+        module.forward = counted_forward
+
+    def _push(self, module, args):
+        self._stack.append(self.names[module])
+
+    def _pop(self, module, args, output):
+        self._stack.pop()
+
+    def _pack(self, tensor):
+        key = _storage_key(tensor)
+        if key not in self._saved and key not in self._param_keys:
+            self._saved.add(key)
+            name = self._stack[-1] if self._stack else ''
+            self.activations[name] = self.activations.get(name, 0) + key[1]
+        return tensor
+
+
+def aggregate(values, depth):
+    """将各module的统计按名称的前 ``depth`` 级汇总"""
+    results = OrderedDict()
+    for name, value in values.items():
+        parts = name.split('.') if name else ['(model)']
+        key = '.'.join(parts[:depth])
+        results[key] = results.get(key, 0) + value
+    return results
+
+
+def count_params(model, depth):
+    params = OrderedDict()
+    for name, param in model.named_parameters():
+        module_name = name.rsplit('.', 1)[0] if '.' in name else ''
+        params[module_name] = params.get(module_name, 0) + param.numel()
+    return aggregate(params, depth)
+
+
+def build_flops_model(cfg, num_query, device):
+    cfg = copy.deepcopy(cfg)
+    cfg.model.pretrained = None
+    if cfg.model.get('backbone', {}).get('init_cfg') is not None:
+        cfg.model.backbone.init_cfg = None
+    cfg.model.train_cfg = None
+    if num_query is not None:
+        cfg.model.bbox_head.num_query = num_query
+        cfg.model.bbox_head.transformer.two_stage_num_proposals = num_query
+        test_cfg = cfg.model.get('test_cfg') or cfg.get('test_cfg')
+        if test_cfg is not None and \
+                test_cfg.get('max_per_img', num_query) > num_query:
+            test_cfg.max_per_img = num_query
+    model = build_model(cfg.model, test_cfg=cfg.get('test_cfg'))
+    return model.to(device).eval()
+
+
+def analyze(model, shape, batch_size, device, depth):
+    """返回一次forward_dummy的各module统计"""
+    img = torch.randn(batch_size, 3, *shape, device=device)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    # 开启梯度才能统计保存给反向传播的激活, 使用eval模式去掉dropout的随机性
+    with torch.enable_grad(), ComplexityCounter(model) as counter:
+        model.forward_dummy(img)
+    flops = aggregate(counter.flops, depth)
+    activations = aggregate(counter.activations, depth)
+    params = count_params(model, depth)
+    names = list(OrderedDict.fromkeys(
+        list(params) + list(flops) + list(activations)))
+    modules = OrderedDict(
+        (name,
+         dict(
+             params=params.get(name, 0),
+             gflops=flops.get(name, 0) / 1e9,
+             activation_mb=activations.get(name, 0) / 1024**2))
+        for name in names)
+    result = dict(
+        gflops=sum(counter.flops.values()) / 1e9,
+        params_m=sum(p.numel() for p in model.parameters()) / 1e6,
+        activation_mb=sum(counter.activations.values()) / 1024**2,
+        modules=modules)
+    if device == 'cuda':
+        result['peak_cuda_memory_mb'] = \
+            torch.cuda.max_memory_allocated() / 1024**2
+    return result
+
+
+def format_table(modules):
+    width = max([len(name) for name in modules] + [6]) + 2
+    lines = [
+        f'{"module":<{width}}{"params(M)":>12}{"GFLOPs":>12}'
+        f'{"act(MB)":>12}'
+    ]
+    for name, stats in modules.items():
+        lines.append(f'{name:<{width}}{stats["params"] / 1e6:>12.3f}'
+                     f'{stats["gflops"]:>12.3f}'
+                     f'{stats["activation_mb"]:>12.1f}')
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Count FLOPs, params and activation memory of PETR3D')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument(
+        '--shapes',
+        nargs='+',
+        default=['800x1333'],
+        help='input shapes HxW')
+    parser.add_argument(
+        '--num-queries',
+        type=int,
+        nargs='+',
+        default=[None],
+        help='num_query of the head, defaults to the config')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size')
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=3,
+        help='depth of the module names in the table, e.g. 3 gives '
+        'bbox_head.transformer.encoder')
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default=None,
+        help='defaults to cuda if available')
+    parser.add_argument('--out', help='output json file')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg = replace_cfg_vals(cfg)
+    update_data_root(cfg)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    device = args.device or get_device()
+    shapes = [tuple(int(x) for x in s.split('x')) for s in args.shapes]
+
+    records = []
+    for num_query in args.num_queries:
+        model = build_flops_model(cfg, num_query, device)
+        num_query = model.bbox_head.num_query
+        for shape in shapes:
+            result = analyze(model, shape, args.batch_size, device, args.depth)
+            records.append(
+                dict(shape=list(shape), num_query=num_query, **result))
+            print(f'\nshape={shape[0]}x{shape[1]} num_query={num_query} '
+                  f'batch_size={args.batch_size}: '
+                  f'{result["gflops"]:.2f} GFLOPs, '
+                  f'{result["params_m"]:.2f} M params, '
+                  f'{result["activation_mb"]:.1f} MB activations')
+            print(format_table(result['modules']))
+        del model
+
+    print(f'\n{"shape":<12}{"num_query":>10}{"GFLOPs":>12}{"act(MB)":>12}')
+    for record in records:
+        shape = 'x'.join(map(str, record['shape']))
+        print(f'{shape:<12}{record["num_query"]:>10}'
+              f'{record["gflops"]:>12.2f}{record["activation_mb"]:>12.1f}')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(
+                dict(
+                    config=args.config,
+                    batch_size=args.batch_size,
+                    depth=args.depth,
+                    results=records),
+                f,
+                indent=2)
+        print(f'results saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
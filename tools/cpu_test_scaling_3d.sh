@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+# 统计CPU测试吞吐随进程数的变化, 例如
+#   bash tools/cpu_test_scaling_3d.sh CONFIG CHECKPOINT "1 2 4 8" --stream-eval
+
+CONFIG=$1
+CHECKPOINT=$2
+NPROCS=${3:-"1 2 4"}
+PORT=${PORT:-29500}
+LOG_DIR=$(mktemp -d)
+
+for NPROC in $NPROCS; do
+    PORT=$PORT bash $(dirname "$0")/dist_test_3d_cpu.sh $CONFIG $CHECKPOINT \
+        $NPROC ${@:4} 2>&1 | tee $LOG_DIR/nproc_$NPROC.log
+    PORT=$((PORT + 1))
+done
+
+echo
+printf "%-8s%-12s%-10s\n" nproc "img/s" speedup
+BASE=""
+for NPROC in $NPROCS; do
+    FPS=$(grep -o 'throughput: [0-9.]*' $LOG_DIR/nproc_$NPROC.log \
+        | tail -n 1 | awk '{print $2}')
+    if [ -z "$FPS" ]; then
+        printf "%-8s%-12s\n" $NPROC failed
+        continue
+    fi
+    BASE=${BASE:-$FPS}
+    printf "%-8s%-12s%-10s\n" $NPROC $FPS \
+        $(awk -v a=$FPS -v b=$BASE 'BEGIN {printf "%.2f", a / b}')
+done
+rm -rf $LOG_DIR
@@ -0,0 +1,205 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+"""用冻结的backbone+neck预先计算训练集的多层特征, 以float16写入shard文件。
+
+Example:
+    python tools/dataset_converters/build_feat_cache.py \
+        configs/petr/petr_r50_16x2_100e_3d.py /path/to/petr.pth \
+        /path/to/feat_cache --scale 1333 800 --flip
+
+训练时使用 opera.FeatCacheDataset(cache_root='/path/to/feat_cache'),
+模型设置 freeze_feat=True 并加载同一个checkpoint, 只训练head,
+参考 configs/petr/petr_r50_16x2_100e_3d_feat_cache.py。
+
+每张图像按训练pipeline中的加载、标注处理与归一化步骤处理, 随机增强
+(颜色、旋转、随机尺度、裁剪)全部去掉, 缩放到固定的 --scale;
+--flip 时额外保存水平翻转的视角。特征较大, 1333x800时每个视角约11MB,
+可以先用 --max-images 生成子集做消融实验。
+"""
+import argparse
+import copy
+import warnings
+
+import mmcv
+import numpy as np
+import torch
+from mmcv import Config, DictAction
+from mmcv.parallel import DataContainer
+from mmcv.runner import load_checkpoint
+from mmdet.datasets.pipelines import Compose
+from mmdet.utils import get_device, replace_cfg_vals, update_data_root
+
+from opera.datasets import build_dataset
+from opera.datasets.smap_utils.feat_cache import FeatShardWriter
+from opera.models import build_model
+
+# 缓存中不保留的随机增强
+RANDOM_TRANSFORMS = ('PhotoMetricDistortion', 'AugRandomFlip',
+                     'AugRandomRotate', 'AutoAugment', 'AugResize', 'AugCrop')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build a float16 neck feature cache of the train set')
+    parser.add_argument('config', help='train config file path')
+    parser.add_argument(
+        'checkpoint', help='checkpoint of the frozen backbone and neck')
+    parser.add_argument('out_dir', help='output directory of the cache')
+    parser.add_argument(
+        '--scale',
+        type=int,
+        nargs=2,
+        default=[1333, 800],
+        help='(long edge, short edge) that images are resized to')
+    parser.add_argument(
+        '--flip',
+        action='store_true',
+        help='also cache the horizontally flipped view of each image')
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=4096,
+        help='approximate size of each shard file in MB')
+    parser.add_argument(
+        '--max-images',
+        type=int,
+        default=None,
+        help='only cache the first images, e.g. for ablations on a subset')
+    parser.add_argument(
+        '--device', default=None, help='defaults to cuda if available')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    return parser.parse_args()
+
+
+def build_cache_pipeline(train_pipeline, scale, flip):
+    """去掉训练pipeline中的随机增强, 在AugPostProcess之前固定翻转与缩放"""
+    pipeline = []
+    for transform in train_pipeline:
+        transform_type = transform['type'].split('.')[-1]
+        if transform_type in RANDOM_TRANSFORMS:
+            continue
+        if transform_type == 'AugPostProcess':
+            # flip_ratio=0.时也需要AugRandomFlip设置img_metas中的flip
+            pipeline.append(
+                dict(type='opera.AugRandomFlip', flip_ratio=float(flip)))
+            pipeline.append(
+                dict(type='opera.AugResize', img_scale=scale, keep_ratio=True))
+        pipeline.append(copy.deepcopy(transform))
+    assert any(t['type'] == 'opera.AugResize' for t in pipeline), \
+        'AugPostProcess is not found in the train pipeline'
+    return pipeline
+
+
+def build_train_datasets(cfg):
+    """构建训练集, 返回其中的JointDataset"""
+    data_cfg = copy.deepcopy(cfg.data.train)
+    # RepeatDataset等只改变采样, 缓存中每张图像只保存一次
+    while 'dataset' in data_cfg:
+        data_cfg = data_cfg['dataset']
+    data_cfg.pop('profile_pipeline', None)
+    dataset = build_dataset(data_cfg)
+    return getattr(dataset, 'datasets', [dataset]), data_cfg['pipeline']
+
+
+def prepare_view(dataset, idx):
+    """经过pipeline后的一个视角, 增强后没有gt时返回None(与训练时一样跳过)"""
+    data = dataset.prepare_train_img(idx)
+    if data is None or data['gt_bboxes'].data.shape[0] == 0:
+        return None
+    return data
+
+
+def to_view(data, feat):
+    view = dict(feat=feat, img_meta=data['img_metas'].data)
+    for key, value in data.items():
+        if key in ('img', 'img_metas'):
+            continue
+        if isinstance(value, DataContainer):
+            value = value.data
+        if isinstance(value, torch.Tensor):
+            value = value.numpy()
+        view[key] = value
+    return view
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg = replace_cfg_vals(cfg)
+    update_data_root(cfg)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    device = args.device or get_device()
+
+    cfg.model.pretrained = None
+    if cfg.model.get('backbone', {}).get('init_cfg') is not None:
+        cfg.model.backbone.init_cfg = None
+    cfg.model.train_cfg = None
+    model = build_model(cfg.model, test_cfg=cfg.get('test_cfg'))
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model = model.to(device).eval()
+
+    views = ['orig', 'flip'] if args.flip else ['orig']
+    datasets, train_pipeline = build_train_datasets(cfg)
+    view_pipelines = [
+        Compose(
+            build_cache_pipeline(train_pipeline, tuple(args.scale),
+                                 view == 'flip')) for view in views
+    ]
+    num_images = sum(len(dataset) for dataset in datasets)
+    if args.max_images is not None:
+        num_images = min(num_images, args.max_images)
+
+    writer = FeatShardWriter(args.out_dir, args.shard_size)
+    samples = []
+    num_skipped = num_nonfinite = 0
+    prog_bar = mmcv.ProgressBar(num_images)
+    with torch.no_grad():
+        for dataset in datasets:
+            for idx in range(len(dataset)):
+                if len(samples) + num_skipped >= num_images:
+                    break
+                prog_bar.update()
+                view_data = []
+                for pipeline in view_pipelines:
+                    dataset.pipeline = pipeline
+                    view_data.append(prepare_view(dataset, idx))
+                # 所有视角都有gt时才写入, 不留下无用的特征
+                if any(data is None for data in view_data):
+                    num_skipped += 1
+                    continue
+                sample_views = []
+                for data in view_data:
+                    img = data['img'].data[None].to(device)
+                    feats = [
+                        feat[0].half().cpu().numpy()
+                        for feat in model.extract_feat(img)
+                    ]
+                    num_nonfinite += sum(
+                        int((~np.isfinite(feat)).sum()) for feat in feats)
+                    sample_views.append(to_view(data, writer.add(feats)))
+                samples.append(dict(views=sample_views))
+
+    writer.close(
+        views=views,
+        scale=list(args.scale),
+        config=args.config,
+        checkpoint=args.checkpoint,
+        samples=samples)
+    num_views = len(samples) * len(views)
+    print(f'\n{len(samples)} images ({num_views} views) are written to '
+          f'{len(writer.shards)} shards in {args.out_dir}, '
+          f'{writer.total_bytes / 1024**3:.1f} GB, '
+          f'{writer.total_bytes / max(num_views, 1) / 1024**2:.1f} MB per '
+          f'view, {num_skipped} images without gt are skipped')
+    if num_nonfinite > 0:
+        warnings.warn(f'{num_nonfinite} feature values overflow float16')
+
+
+if __name__ == '__main__':
+    main()
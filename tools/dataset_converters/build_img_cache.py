@@ -0,0 +1,113 @@
+# Copyright (c) Hikvision Research Institute. All rights reserved.
+"""将SMAP格式数据集中的图像预缩放到最大训练尺度, 并顺序写入shard文件。
+
+Example:
+    python tools/dataset_converters/build_img_cache.py \
+        /path/to/MuCo.json /path/to/MuCo/ /path/to/muco_cache \
+        --max-scale 1400 1400
+
+训练时在数据集配置中设置 img_cache='/path/to/muco_cache' 即可,
+注释中的坐标与相机内参会按照index中记录的比例自动缩放。
+"""
+import argparse
+import os
+import os.path as osp
+
+import cv2
+import mmcv
+
+from opera.datasets.smap_utils.img_cache import (CACHE_INDEX, CACHE_VERSION)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build a pre-resized sharded image cache')
+    parser.add_argument('ann_file', help='SMAP format annotation file')
+    parser.add_argument('img_prefix', help='image root of the dataset')
+    parser.add_argument('out_dir', help='output directory of the cache')
+    parser.add_argument(
+        '--max-scale',
+        type=int,
+        nargs=2,
+        default=[1400, 1400],
+        help='maximum (long edge, short edge) used in training')
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=1024,
+        help='approximate size of each shard file in MB')
+    parser.add_argument(
+        '--quality', type=int, default=95, help='jpeg quality of resized images')
+    args = parser.parse_args()
+    return args
+
+
+def get_scale(img_w, img_h, max_scale):
+    """只缩小不放大, 与mmcv.imrescale的keep_ratio规则一致"""
+    max_long_edge, max_short_edge = max(max_scale), min(max_scale)
+    scale = min(max_long_edge / max(img_w, img_h),
+                max_short_edge / min(img_w, img_h), 1.)
+    return scale
+
+
+def main():
+    args = parse_args()
+    mmcv.mkdir_or_exist(args.out_dir)
+    data_infos = mmcv.load(args.ann_file)['root']
+    file_client = mmcv.FileClient(backend='disk')
+    shard_bytes = args.shard_size * 1024 * 1024
+
+    shards = []
+    images = dict()
+    shard_fp = None
+    offset = 0
+    prog_bar = mmcv.ProgressBar(len(data_infos))
+    for info in data_infos:
+        img_path = info['img_paths']
+        prog_bar.update()
+        if img_path in images:
+            continue
+        img_bytes = file_client.get(osp.join(args.img_prefix, img_path))
+        img = mmcv.imfrombytes(img_bytes, flag='color')
+        img_h, img_w = img.shape[:2]
+        scale = get_scale(img_w, img_h, args.max_scale)
+        if scale < 1.:
+            new_w, new_h = int(img_w * scale + 0.5), int(img_h * scale + 0.5)
+            img = mmcv.imresize(img, (new_w, new_h))
+            ok, buf = cv2.imencode(
+                '.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, args.quality])
+            assert ok, f'failed to encode {img_path}'
+            img_bytes = buf.tobytes()
+            scale_w, scale_h = new_w / img_w, new_h / img_h
+        else:
+            # 无需缩放的图像直接保存原始字节, 避免重复编码带来的损失
+            scale_w, scale_h = 1., 1.
+
+        if shard_fp is None or offset >= shard_bytes:
+            if shard_fp is not None:
+                shard_fp.close()
+            shards.append(f'shard_{len(shards):05d}.bin')
+            shard_fp = open(osp.join(args.out_dir, shards[-1]), 'wb')
+            offset = 0
+        shard_fp.write(img_bytes)
+        images[img_path] = [
+            len(shards) - 1, offset, len(img_bytes), scale_w, scale_h]
+        offset += len(img_bytes)
+
+    if shard_fp is not None:
+        shard_fp.close()
+
+    index = dict(
+        version=CACHE_VERSION,
+        max_scale=list(args.max_scale),
+        shards=shards,
+        images=images)
+    tmp_path = osp.join(args.out_dir, CACHE_INDEX + '.tmp')
+    mmcv.dump(index, tmp_path, file_format='json')
+    os.replace(tmp_path, osp.join(args.out_dir, CACHE_INDEX))
+    print(f'\n{len(images)} images are written to {len(shards)} shards '
+          f'in {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+# 在CPU节点上用gloo多进程训练, 多机时设置 NNODES / NODE_RANK / MASTER_ADDR
+
+CONFIG=$1
+NPROC=$2
+NNODES=${NNODES:-1}
+NODE_RANK=${NODE_RANK:-0}
+MASTER_ADDR=${MASTER_ADDR:-"127.0.0.1"}
+PORT=${PORT:-29500}
+
+PYTHONPATH="$(dirname $0)/..":$PYTHONPATH \
+python -m torch.distributed.launch --nnodes=$NNODES --node_rank=$NODE_RANK \
+    --master_addr=$MASTER_ADDR --nproc_per_node=$NPROC --master_port=$PORT \
+    $(dirname "$0")/train.py $CONFIG --launcher pytorch --device cpu ${@:3}
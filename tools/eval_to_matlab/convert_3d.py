@@ -1,12 +1,14 @@
+import argparse
+
 import numpy as np
 import scipy.io as scio
-import json
 
-def convert(path=''):
-    with open(path, 'r') as f:
-        data = json.load(f)
+from opera.core.evaluation import evaluate_mupots
+from opera.datasets.smap_utils.pose3d_result import (Pose3DResultReader,
+                                                     load_pose3d_pairs)
 
-    pairs_3d = data['3d_pairs']
+def convert(path=''):
+    pairs_3d = load_pose3d_pairs(path)
 
     pose3d = dict()
     pose2d = dict()
@@ -29,6 +31,36 @@ def convert(path=''):
         scio.savemat('./pose3d.mat', {'preds_3d_kpt':pose3d})
         scio.savemat('./pose2d.mat', {'preds_2d_kpt':pose2d})
 
+
+def evaluate(path='', nproc=1, vis_only=False):
+    """不经过MATLAB, 直接根据output.json或output.pose3d计算MuPoTS-3D指标"""
+    stats = evaluate_mupots(
+        list(load_pose3d_pairs(path)), nproc=nproc, vis_only=vis_only)
+    eval_results = stats.summary()
+    for k, v in eval_results.items():
+        print(f'{k}: {v:.2f}')
+    return eval_results
+
+
 if __name__ == "__main__":
-    file_path = "/home/notebook/code/personal/S9043252/wz/PETR_3D/work_dirs/3d_0930_train_result/output.json"
-    convert(file_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description='Convert 3D results to mat files or evaluate them')
+    parser.add_argument(
+        'file_path',
+        help='output.json or output.pose3d of JointDataset.evaluate')
+    parser.add_argument(
+        '--eval', action='store_true', help='compute MuPoTS-3D metrics')
+    parser.add_argument(
+        '--nproc', type=int, default=1, help='processes used by --eval')
+    parser.add_argument(
+        '--vis-only', action='store_true',
+        help='only evaluate joints visible in gt_2d')
+    parser.add_argument(
+        '--to-json', help='convert output.pose3d to the legacy output.json')
+    args = parser.parse_args()
+    if args.to_json:
+        Pose3DResultReader(args.file_path).to_legacy_json(args.to_json)
+    elif args.eval:
+        evaluate(args.file_path, args.nproc, args.vis_only)
+    else:
+        convert(args.file_path)
\ No newline at end of file
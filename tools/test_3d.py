@@ -17,7 +17,8 @@ from mmdet.utils import (build_ddp, build_dp, compat_cfg, get_device,
                             replace_cfg_vals, setup_multi_processes,
                             update_data_root)
 
-from opera.apis import multi_gpu_test_3d, single_gpu_test
+from opera.apis import (ShardedResults, init_dist_cpu, multi_gpu_test_3d,
+                        single_gpu_test)
 from opera.datasets import (build_dataloader, build_dataset,
                             replace_ImageToTensor)
 from opera.models import build_model
@@ -75,6 +76,19 @@ def parse_args():
         default=0,
         help='id of gpu to use '
         '(only applicable to non-distributed testing)')
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default=None,
+        help='device used for testing, defaults to cuda if available. With '
+        '"cpu" and a launcher, every process runs on CPU and communicates '
+        'with gloo')
+    parser.add_argument(
+        '--num-threads',
+        type=int,
+        default=None,
+        help='intra-op threads of every process on CPU, defaults to the '
+        'number of cores divided by the number of local processes')
     parser.add_argument(
         '--format-only',
         action='store_true',
@@ -89,15 +103,19 @@ def parse_args():
         ' "segm", "proposal" for COCO, and "mAP", "recall" for PASCAL VOC')
     parser.add_argument('--show', action='store_true', help='show results')
     parser.add_argument(
-        '--show-dir', 
-        help='directory where painted images will be saved',
-        default="/data/jupyter/PETR/results"
-    )
+        '--show-dir',
+        help='directory where painted images will be saved '
+        '(only applicable to non-distributed testing)')
     parser.add_argument(
         '--show-score-thr',
         type=float,
         default=0.3,
         help='score threshold (default: 0.3)')
+    parser.add_argument(
+        '--stream-eval',
+        action='store_true',
+        help='evaluate on the fly on every rank and all-reduce the metric '
+        'statistics, predictions are neither kept nor collected')
     parser.add_argument(
         '--gpu-collect',
         action='store_true',
@@ -153,10 +171,10 @@ def parse_args():
 def main():
     args = parse_args()
     assert args.out or args.eval or args.format_only or args.show \
-        or args.show_dir, \
+        or args.show_dir or args.stream_eval, \
         ('Please specify at least one operation (save/eval/format/show the '
             'results / save the results) with the argument "--out", "--eval"'
-            ', "--format-only", "--show" or "--show-dir"')
+            ', "--format-only", "--stream-eval", "--show" or "--show-dir"')
 
     if args.eval and args.format_only:
         raise ValueError('--eval and --format_only cannot be both specified')
@@ -207,16 +225,29 @@ def main():
                         'in `gpu_ids` now.')
     else:
         cfg.gpu_ids = [args.gpu_id]
-    cfg.device = get_device()
+    cfg.device = args.device or get_device()
     print("========================")
     print(f"device: {cfg.device}")
     # init distributed env first, since logger depends on the dist info.
     if args.launcher == 'none':
         distributed = False
+        if cfg.device == 'cpu' and args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+    elif cfg.device == 'cpu':
+        distributed = True
+        # CPU节点上使用gloo后端, 不绑定GPU
+        init_dist_cpu(
+            args.launcher,
+            num_threads=args.num_threads,
+            **dict(cfg.dist_params, backend='gloo'))
     else:
         distributed = True
         init_dist(args.launcher, **cfg.dist_params)
 
+    if (args.show or args.show_dir) and (distributed or args.stream_eval):
+        raise ValueError('--show and --show-dir are only supported in '
+                         'non-distributed testing without --stream-eval')
+
     test_dataloader_default_args = dict(
         samples_per_gpu=1, workers_per_gpu=2, dist=distributed, shuffle=False)
 
@@ -268,33 +299,72 @@ def main():
     else:
         model.CLASSES = dataset.CLASSES
 
+    gpu_collect = args.gpu_collect or cfg.evaluation.get('gpu_collect', False)
     if not distributed:
-        raise NotImplementedError
+        # 单进程时multi_gpu_test_3d不需要通信, 结果直接写到tmpdir
+        model = build_dp(model, cfg.device, device_ids=cfg.gpu_ids)
+        gpu_collect = False
+    elif cfg.device == 'cpu':
+        # 测试时没有梯度需要同步, 每个进程在CPU上用MMDataParallel即可
         model = build_dp(model, cfg.device, device_ids=cfg.gpu_ids)
-        outputs = single_gpu_test(model, data_loader, args.show, args.show_dir,
-                                    args.show_score_thr)
     else:
         model = build_ddp(
             model,
             cfg.device,
             device_ids=[int(os.environ['LOCAL_RANK'])],
             broadcast_buffers=False)
+    evaluator = None
+    if args.stream_eval:
+        # 推理过程中逐张图像写入output.pose3d, 不保留全部结果
+        evaluator = dataset.get_evaluator(
+            result_path=args.result_save_path + 'output.pose3d'
+            if args.result_save_path else None)
+    timing = dict()
+    if args.show or args.show_dir:
+        # 画图只支持单进程, 吞吐包括画图的时间
+        start = time.perf_counter()
+        outputs = single_gpu_test(model, data_loader, args.show,
+                                  args.show_dir, args.show_score_thr)
+        timing['inference'] = time.perf_counter() - start
+    else:
         outputs = multi_gpu_test_3d(
-            model, data_loader, args.tmpdir, args.gpu_collect
-            or cfg.evaluation.get('gpu_collect', False))
-
-    rank, _ = get_dist_info()
+            model,
+            data_loader,
+            args.tmpdir,
+            gpu_collect,
+            evaluator=evaluator,
+            timing=timing)
+    elapsed = timing['inference']
+
+    rank, world_size = get_dist_info()
     if rank == 0:
+        # tools/cpu_test_scaling_3d.sh 根据这一行统计吞吐
+        print(f'\nthroughput: {len(dataset) / elapsed:.2f} img/s, '
+              f'{world_size} process(es) on {cfg.device}, '
+              f'{torch.get_num_threads()} thread(s) per process')
+    if rank == 0 and args.stream_eval:
+        # outputs为流式评测得到的指标
+        print(outputs)
+        if args.work_dir is not None:
+            mmcv.dump(dict(config=args.config, metric=outputs), json_file)
+    elif rank == 0:
         if args.out:
             print(f'\nwriting results to {args.out}')
-            mmcv.dump(outputs, args.out)
+            # ShardedResults按需读取shard, 保存时转换为list
+            mmcv.dump(list(outputs), args.out)
 
         if args.format_only:
             pass
 
         if args.eval:
-            dataset.evaluate(outputs, args.result_save_path, args.mat_save_path)
-        
+            metric = dataset.evaluate(outputs, args.result_save_path,
+                                      args.mat_save_path)
+            print(metric)
+            if args.work_dir is not None:
+                mmcv.dump(dict(config=args.config, metric=metric), json_file)
+
+        if isinstance(outputs, ShardedResults):
+            outputs.cleanup()
 
 if __name__ == '__main__':
     main()
@@ -17,7 +17,8 @@ from mmdet.utils import (collect_env, get_device, get_root_logger,
                             update_data_root)
 
 from opera import __version__
-from opera.apis import init_random_seed, set_random_seed, train_model
+from opera.apis import (init_dist_cpu, init_random_seed, set_random_seed,
+                        train_model)
 from opera.datasets import build_dataset
 from opera.models import build_model
 
@@ -55,6 +56,24 @@ def parse_args():
         default=0,
         help='id of gpu to use '
         '(only applicable to non-distributed training)')
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default=None,
+        help='device used for training, defaults to cuda if available. With '
+        '"cpu" and a launcher, every process runs on CPU and communicates '
+        'with gloo')
+    parser.add_argument(
+        '--num-threads',
+        type=int,
+        default=None,
+        help='intra-op threads of every process on CPU, defaults to the '
+        'number of cores divided by the number of local processes')
+    parser.add_argument(
+        '--zero-optimizer',
+        action='store_true',
+        help='shard the optimizer state across processes '
+        '(ZeroRedundancyOptimizer), same as zero_optimizer.enable=True')
     parser.add_argument('--seed', type=int, default=None, help='random seed')
     parser.add_argument(
         '--diff-seed',
@@ -164,12 +183,25 @@ def main():
     if args.gpus is None and args.gpu_ids is None:
         cfg.gpu_ids = [args.gpu_id]
 
+    if args.zero_optimizer:
+        cfg.zero_optimizer = dict(cfg.get('zero_optimizer', {}), enable=True)
+
+    cfg.device = args.device or get_device()
     # init distributed env first, since logger depends on the dist info.
     if args.launcher == 'none':
         distributed = False
+        if cfg.device == 'cpu' and args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
     else:
         distributed = True
-        init_dist(args.launcher, **cfg.dist_params)
+        if cfg.device == 'cpu':
+            # CPU节点上使用gloo后端, 不绑定GPU, 支持多机
+            init_dist_cpu(
+                args.launcher,
+                num_threads=args.num_threads,
+                **dict(cfg.dist_params, backend='gloo'))
+        else:
+            init_dist(args.launcher, **cfg.dist_params)
         # re-set gpu_ids with distributed training mode
         _, world_size = get_dist_info()
         cfg.gpu_ids = range(world_size)
@@ -198,7 +230,6 @@ def main():
     logger.info(f'Distributed training: {distributed}')
     logger.info(f'Config:\n{cfg.pretty_text}')
 
-    cfg.device = get_device()
     # set random seeds
     seed = init_random_seed(args.seed, device=cfg.device)
     seed = seed + dist.get_rank() if args.diff_seed else seed
@@ -1,7 +1,8 @@
 # 获取数据集图片和网络输出，进行可视化
 import cv2 as cv
 import numpy as np
-import json
+
+from opera.datasets.smap_utils.pose3d_result import load_pose3d_pairs
 
 
 json_path = "/home/notebook/code/personal/S9043252/wz/PETR_3D/work_dirs/3d_0930_train_result/output.json"
@@ -9,8 +10,8 @@ dataset_path = "/home/notebook/data/group/wangxiong/smoothformer/hpe_data/data/M
 keys = ['gt_2d', 'gt_3d', 'pred_2d', 'pred_3d', 'root_d']
 
 
-with open(json_path, 'r') as fp:
-    anno = json.load(fp)['3d_pairs']
+# 兼容 output.json 与 output.pose3d
+anno = load_pose3d_pairs(json_path)
 
 for i in range(2000, len(anno)):
     img_path = dataset_path + anno[i]['image_path']